@@ -1,5 +1,5 @@
 from . import labels_table_cityscapes
-from .precomputed_file_transformations import PrecomputedDatasetFileTransformerBase
+from .precomputed_file_transformations import PrecomputedDatasetFileTransformerBase, write_atomically
 import numpy as np
 import os.path as osp
 import os
@@ -27,38 +27,34 @@ def convert_to_p_mode_file(old_file, new_file, palette, assert_inside_palette_ra
 
 
 class ConvertLblstoPModePILImages(PrecomputedDatasetFileTransformerBase):
+    """
+    Converts the semantic label file to a P-mode image (the instance label file is used as is)
+    """
     old_sem_file_tag = '.png'
     new_sem_file_tag = '_mode_p.png'
-    old_inst_file_tag = '.png'
-    new_inst_file_tag = '_mode_p.png'
 
     def __init__(self):
         self.semantic_palette = \
             labels_table_cityscapes.get_semantic_palette_image()
-        self.instance_palette = \
-            labels_table_cityscapes.get_instance_palette_image()
 
-    def transform(self, img_file, sem_lbl_file, inst_lbl_file):
-        assert self.old_sem_file_tag in sem_lbl_file and self.old_sem_file_tag in inst_lbl_file
+    def get_transformed_files(self, img_file, sem_lbl_file, inst_lbl_file):
+        assert self.old_sem_file_tag in sem_lbl_file
+        return img_file, sem_lbl_file.replace(self.old_sem_file_tag, self.new_sem_file_tag), inst_lbl_file
+
+    def generate_transformed_files(self, img_file, sem_lbl_file, inst_lbl_file):
         new_sem_lbl_file = sem_lbl_file.replace(self.old_sem_file_tag, self.new_sem_file_tag)
-        if not osp.isfile(new_sem_lbl_file):
-            assert osp.isfile(sem_lbl_file), '{} does not exist'.format(sem_lbl_file)
-            print('Creating {} from {}'.format(new_sem_lbl_file, sem_lbl_file))
-            convert_to_p_mode_file(sem_lbl_file, new_sem_lbl_file, palette=self.semantic_palette,
-                                   assert_inside_palette_range=True)
-        new_inst_lbl_file = inst_lbl_file.replace(self.old_inst_file_tag, self.new_inst_file_tag)
-        if not osp.isfile(new_inst_lbl_file):
-            assert osp.isfile(inst_lbl_file), '{} does not exist'.format(inst_lbl_file)
-            print('Creating {} from {}'.format(new_inst_lbl_file, inst_lbl_file))
-            convert_to_p_mode_file(inst_lbl_file, new_inst_lbl_file, palette=self.instance_palette,
-                                   assert_inside_palette_range=True)
-        return img_file, new_sem_lbl_file, inst_lbl_file
+        assert osp.isfile(sem_lbl_file), '{} does not exist'.format(sem_lbl_file)
+        print('Creating {} from {}'.format(new_sem_lbl_file, sem_lbl_file))
+        write_atomically(lambda out_file: convert_to_p_mode_file(sem_lbl_file, out_file, palette=self.semantic_palette,
+                                                                 assert_inside_palette_range=True), new_sem_lbl_file)
+
+    def get_source_files(self, img_file, sem_lbl_file, inst_lbl_file):
+        return [sem_lbl_file]
 
     def untransform(self, img_file, sem_lbl_file, inst_lbl_file):
         old_sem_lbl_file = sem_lbl_file.replace(self.new_sem_file_tag, self.old_sem_file_tag)
-        old_inst_lbl_file = inst_lbl_file.replace(self.new_inst_file_tag, self.old_inst_file_tag)
         assert osp.isfile(old_sem_lbl_file)
-        return img_file, old_sem_lbl_file, old_inst_lbl_file
+        return img_file, old_sem_lbl_file, inst_lbl_file
 
 
 class CityscapesMapRawtoTrainIdPrecomputedFileDatasetTransformer(PrecomputedDatasetFileTransformerBase):
@@ -68,6 +64,7 @@ class CityscapesMapRawtoTrainIdPrecomputedFileDatasetTransformer(PrecomputedData
     new_inst_file_tag = 'TrainIds'
     void_value = 255
     background_value = 0
+    keep_instance_value = -2  # semantic values whose instance labels raw_inst_to_train_inst_labels leaves alone
 
     def __init__(self):
         # Get dictionary of raw id assignments (semantic, instance, void, background)
@@ -78,23 +75,25 @@ class CityscapesMapRawtoTrainIdPrecomputedFileDatasetTransformer(PrecomputedData
             get_train_id_assignments(self._raw_id_assignments, void_value=self.void_value,
                                      background_value=self.background_value)
         self.original_semantic_class_names = None
-
-    def transform(self, img_file, sem_lbl_file, inst_lbl_file):
-        new_sem_lbl_file = sem_lbl_file.replace(self.old_sem_file_tag, self.new_sem_file_tag)
-        if not osp.isfile(new_sem_lbl_file):
-            print('Generating {}'.format(new_sem_lbl_file))
-            assert osp.isfile(sem_lbl_file), '{} does not exist'.format(sem_lbl_file)
-            self.generate_train_id_semantic_file(sem_lbl_file, new_sem_lbl_file)
-        new_inst_lbl_file = inst_lbl_file.replace(self.old_inst_file_tag, self.new_inst_file_tag)
-        if not osp.isfile(new_inst_lbl_file):
-            print('Generating {}'.format(new_inst_lbl_file))
-            assert osp.isfile(inst_lbl_file), '{} does not exist'.format(inst_lbl_file)
-            self.generate_train_id_instance_file(inst_lbl_file, new_inst_lbl_file, sem_lbl_file)
-        if 1:
-            assert osp.isfile(new_inst_lbl_file)
-            assert osp.isfile(new_sem_lbl_file)
-
-        return img_file, new_sem_lbl_file, new_inst_lbl_file
+        self._sem_remap_table = datasets.LabelRemapTable(old_values=self._raw_id_list,
+                                                         new_values=self._raw_id_to_train_id)
+        self._inst_override_remap_table = get_instance_override_remap_table(
+            self.train_id_list, self.train_id_assignments, keep_value=self.keep_instance_value)
+
+    def get_transformed_files(self, img_file, sem_lbl_file, inst_lbl_file):
+        return img_file, sem_lbl_file.replace(self.old_sem_file_tag, self.new_sem_file_tag), \
+            inst_lbl_file.replace(self.old_inst_file_tag, self.new_inst_file_tag)
+
+    def generate_transformed_files(self, img_file, sem_lbl_file, inst_lbl_file):
+        _, new_sem_lbl_file, new_inst_lbl_file = self.get_transformed_files(img_file, sem_lbl_file, inst_lbl_file)
+        print('Generating {}'.format(new_sem_lbl_file))
+        assert osp.isfile(sem_lbl_file), '{} does not exist'.format(sem_lbl_file)
+        write_atomically(lambda out_file: self.generate_train_id_semantic_file(sem_lbl_file, out_file),
+                         new_sem_lbl_file)
+        print('Generating {}'.format(new_inst_lbl_file))
+        assert osp.isfile(inst_lbl_file), '{} does not exist'.format(inst_lbl_file)
+        write_atomically(lambda out_file: self.generate_train_id_instance_file(inst_lbl_file, out_file, sem_lbl_file),
+                         new_inst_lbl_file)
 
     def untransform(self, img_file, sem_lbl_file, inst_lbl_file):
         old_sem_lbl_file = sem_lbl_file.replace(self.new_sem_file_tag, self.old_sem_file_tag)
@@ -108,15 +107,9 @@ class CityscapesMapRawtoTrainIdPrecomputedFileDatasetTransformer(PrecomputedData
         n_instances)
         """
         inst_lbl = map_raw_inst_labels_to_instance_count(inst_lbl)
-        for (sem_train_id, is_instance, is_semantic) in \
-                zip(self.train_id_list, self.train_id_assignments['instance'],
-                    self.train_id_assignments['semantic']):
-            if not is_instance and is_semantic:
-                inst_lbl[sem_lbl == sem_train_id] = 0
-            elif not is_semantic:
-                inst_lbl[sem_lbl == sem_train_id] = -1
-            else:
-                pass
+        inst_overrides = self._inst_override_remap_table.remap(sem_lbl)
+        inst_lbl = np.where(inst_overrides == self.keep_instance_value, inst_lbl, inst_overrides).astype(
+            inst_lbl.dtype, copy=False)
         return inst_lbl
 
     def generate_train_id_instance_file(self, raw_format_inst_lbl_file, new_format_inst_lbl_file, sem_lbl_file):
@@ -138,8 +131,7 @@ class CityscapesMapRawtoTrainIdPrecomputedFileDatasetTransformer(PrecomputedData
     def generate_train_id_semantic_file(self, raw_id_sem_lbl_file, new_train_id_sem_lbl_file):
         print('Generating per-semantic instance file: {}'.format(new_train_id_sem_lbl_file))
         sem_lbl = datasets.load_img_as_dtype(raw_id_sem_lbl_file, np.int32)
-        sem_lbl = map_raw_sem_ids_to_train_ids(sem_lbl, old_values=self._raw_id_list,
-                                               new_values_from_old_values=self._raw_id_to_train_id)
+        sem_lbl = self._sem_remap_table.remap(sem_lbl)
         datasets.write_np_array_as_img_with_borrowed_colormap_palette(
             sem_lbl, new_train_id_sem_lbl_file, filename_for_colormap=raw_id_sem_lbl_file)
 
@@ -284,20 +276,22 @@ def map_raw_sem_ids_to_train_ids(sem_lbl, old_values, new_values_from_old_values
     so they 'remap' them onto actual training classes.  Leads to very silly remapping after
     loading...
 
-    WARNING: We map iteratively (less memory-intensive than copying sem_lbl or making masks).
-    For this to work, train_ids must be <= ids, background_value <= background_ids,
-    void_value <= void_ids.
+    Returns a remapped copy of sem_lbl (values not in old_values are unchanged).  To remap many labels, build the
+    datasets.LabelRemapTable once instead.
+    """
+    return datasets.LabelRemapTable(old_values=old_values, new_values=new_values_from_old_values).remap(sem_lbl)
+
+
+def get_instance_override_remap_table(train_id_list, train_id_assignments, keep_value):
+    """
+    Maps each semantic value to the instance value all its pixels get (0 for semantic classes without instances, -1
+    for void), or to keep_value for classes whose instance labels are kept.
     """
-    new_value_sorted_idxs = np.argsort(new_values_from_old_values)
-    old_values = [old_values[i] for i in new_value_sorted_idxs]
-    new_values_from_old_values = [new_values_from_old_values[i] for i in new_value_sorted_idxs]
-    assert len(old_values) == len(new_values_from_old_values)
-    if all([new <= old for old, new in zip(old_values, new_values_from_old_values)]):
-        # map ids to train_ids (e.g. - tunnel (id=16) is unused, so maps to 255.
-        for old_val, new_val in zip(old_values, new_values_from_old_values):
-            sem_lbl[sem_lbl == old_val] = new_val
-    else:  # less efficient method
-        sem_lbl_old = sem_lbl.copy()
-        for old_val, new_val in zip(old_values, new_values_from_old_values):
-            sem_lbl[sem_lbl_old == old_val] = new_val
-    return sem_lbl
+    old_values, new_values = [], []
+    for (sem_train_id, is_instance, is_semantic) in \
+            zip(train_id_list, train_id_assignments['instance'], train_id_assignments['semantic']):
+        if not is_instance and is_semantic:
+            old_values.append(sem_train_id), new_values.append(0)
+        elif not is_semantic:
+            old_values.append(sem_train_id), new_values.append(-1)
+    return datasets.LabelRemapTable(old_values=old_values, new_values=new_values, default_value=keep_value)
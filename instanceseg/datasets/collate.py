@@ -0,0 +1,57 @@
+"""
+Collation of variable-size (img, lbl) samples into mini-batches, for DataLoader(..., collate_fn=...).
+Images are C x H x W; lbl is [sem_lbl, inst_lbl] (or just sem_lbl), each H x W.
+"""
+from torch.utils.data.dataloader import default_collate
+
+COLLATE_MODES = ('pad', 'crop')
+IMG_PAD_VALUE = 0  # the mean, for images with the mean subtracted
+# Not void (-1): like void, padding is never a target (labels < 0), but soft IoU unions and the instance metrics count
+# void pixels and must still leave the padding out.
+LBL_PAD_VALUE = -2
+
+
+def get_collate_fn(collate_mode='pad'):
+    assert collate_mode in COLLATE_MODES, ValueError('collate_mode must be one of {}; got {}'.format(
+        COLLATE_MODES, collate_mode))
+    return pad_collate if collate_mode == 'pad' else crop_collate
+
+
+def pad_collate(samples):
+    """
+    Pads every image (bottom / right) to the largest height and width in the batch; labels are padded with
+    LBL_PAD_VALUE.
+    """
+    height = max(img.size(-2) for img, _ in samples)
+    width = max(img.size(-1) for img, _ in samples)
+    return default_collate([resize_sample_by_padding_or_cropping(img, lbl, height, width) for img, lbl in samples])
+
+
+def crop_collate(samples):
+    """
+    Crops every image (from the top left corner) to the smallest height and width in the batch.
+    """
+    height = min(img.size(-2) for img, _ in samples)
+    width = min(img.size(-1) for img, _ in samples)
+    return default_collate([resize_sample_by_padding_or_cropping(img, lbl, height, width) for img, lbl in samples])
+
+
+def resize_sample_by_padding_or_cropping(img, lbl, height, width):
+    img = pad_or_crop(img, height, width, IMG_PAD_VALUE)
+    if isinstance(lbl, (list, tuple)):
+        lbl = [pad_or_crop(l, height, width, LBL_PAD_VALUE) for l in lbl]
+    else:
+        lbl = pad_or_crop(lbl, height, width, LBL_PAD_VALUE)
+    return img, lbl
+
+
+def pad_or_crop(tensor, height, width, pad_value):
+    """
+    Top left height x width corner of tensor (... x H x W), padded with pad_value where it's smaller.
+    """
+    if tensor.size(-2) == height and tensor.size(-1) == width:
+        return tensor
+    resized = tensor.new_full(tensor.size()[:-2] + (height, width), pad_value)
+    h, w = min(height, tensor.size(-2)), min(width, tensor.size(-1))
+    resized[..., :h, :w] = tensor[..., :h, :w]
+    return resized
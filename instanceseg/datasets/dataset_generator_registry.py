@@ -1,7 +1,9 @@
+import os
+
 from scripts.configurations import voc_cfg, cityscapes_cfg
 from instanceseg.utils import datasets
 from instanceseg.datasets import precomputed_file_transformations, runtime_transformations
-from instanceseg.datasets import voc, synthetic, cityscapes
+from instanceseg.datasets import voc, synthetic, cityscapes, packed_dataset
 from instanceseg.utils.misc import pop_without_del
 from instanceseg.utils.misc import value_as_string
 
@@ -78,9 +80,26 @@ def get_dataset(dataset_type, cfg, transform=True):
             intermediate_write_path=intermediate_write_path, transform=transform)
     else:
         raise NotImplementedError('Generator for dataset type {} not implemented.')
+    if cfg.get('pack_dataset', False) and transform:
+        if dataset_type == 'synthetic':
+            print(Warning('Synthetic datasets are generated on the fly; not packing them.'))
+        else:
+            train_dataset, val_dataset = [get_packed_dataset(dataset, dataset_path)
+                                          for dataset in (train_dataset, val_dataset)]
     return train_dataset, val_dataset
 
 
+def get_packed_dataset(dataset, dataset_path):
+    """
+    dataset, read from its pack (see packed_dataset) in <dataset_path>/packed/<split>_<transformer tag>; packed first if
+    it isn't there yet.  The tag covers the transformations whose output is packed.
+    """
+    packed_transformation, _ = packed_dataset.split_runtime_transformation(dataset.runtime_transformation)
+    transformer_tag = get_transformer_identifier_tag(dataset.precomputed_file_transformation, packed_transformation)
+    pack_dir = os.path.join(dataset_path, 'packed', '{}_{}'.format(dataset.raw_dataset.split, transformer_tag))
+    return packed_dataset.PackedInstanceDataset(dataset, pack_dir)
+
+
 def get_transformations(cfg, original_semantic_class_names=None):
     # Get transformation parameters
     semantic_subset = cfg['semantic_subset']
@@ -1,3 +1,5 @@
+import os
+
 import numpy as np
 import torch
 import tqdm
@@ -169,6 +171,29 @@ def compute_instance_counts(dataset, semantic_classes=None):
     return instance_counts
 
 
+def get_image_sizes(dataset, image_size_file=None):
+    """
+    N x 2 array of the (H, W) of every image, as the dataset returns it.  Read from image_size_file if it exists;
+    otherwise computed (one pass over the dataset) and written there.
+    """
+    if image_size_file is not None and os.path.isfile(image_size_file):
+        print('Reading from image sizes file {}'.format(image_size_file))
+        return np.load(image_size_file)
+    image_sizes = compute_image_sizes(dataset)
+    if image_size_file is not None:
+        print('Writing image sizes file {}'.format(image_size_file))
+        np.save(image_size_file, image_sizes)
+    return image_sizes
+
+
+def compute_image_sizes(dataset):
+    image_sizes = np.zeros((len(dataset), 2), dtype=int)
+    for idx, (img, _) in tqdm.tqdm(enumerate(dataset), total=len(dataset), desc='Computing image sizes',
+                                   leave=False):
+        image_sizes[idx, :] = img.size()[-2:]
+    return image_sizes
+
+
 def filter_images_by_non_bground(dataset, bground_val=0, void_val=-1):
     valid_indices = []
     for index, (img, (sem_lbl, _)) in enumerate(dataset):
@@ -1,6 +1,8 @@
 import abc
+import os.path as osp
 
 from torch.utils import data
+from . import precomputed_file_builder
 from .runtime_transformations import GenericSequenceRuntimeDatasetTransformer
 
 
@@ -20,10 +22,13 @@ class TransformedInstanceDataset(InstanceDatasetBase):
     __metaclass__ = data.Dataset
 
     def __init__(self, raw_dataset, raw_dataset_returns_images=False, precomputed_file_transformation=None,
-                 runtime_transformation=None):
+                 runtime_transformation=None, precomputed_files=None):
         """
         :param raw_dataset_returns_images: Set to false for standard datasets that load from files; set to true for
         synthetic datasets that directly return images and labels.
+        :param precomputed_files: (img_file, sem_lbl_file, inst_lbl_file) of each item after
+        precomputed_file_transformation (e.g. - from precomputed_file_builder.build_precomputed_files).  Looked up
+        here if None (see lookup_precomputed_files).
         """
 
         if raw_dataset_returns_images:
@@ -33,6 +38,14 @@ class TransformedInstanceDataset(InstanceDatasetBase):
         self.raw_dataset = raw_dataset
         self.precomputed_file_transformation = precomputed_file_transformation
         self.runtime_transformation = runtime_transformation
+        # Looked up once, in this process, so loader workers (which get a copy of the dataset each epoch) only index it
+        if precomputed_files is None and precomputed_file_transformation is not None and \
+                not raw_dataset_returns_images:
+            precomputed_files = self.lookup_precomputed_files()
+        assert precomputed_files is None or len(precomputed_files) == len(raw_dataset), \
+            ValueError('Got precomputed files for {} items; dataset has {}'.format(len(precomputed_files),
+                                                                                  len(raw_dataset)))
+        self.precomputed_files = precomputed_files
         self.should_use_precompute_transform = True
         self.should_use_runtime_transform = True
 
@@ -83,7 +96,10 @@ class TransformedInstanceDataset(InstanceDatasetBase):
         img_file, sem_lbl_file, inst_lbl_file = data_file['img'], data_file['sem_lbl'], data_file['inst_lbl']
 
         # Get the right file
-        if precomputed_file_transformation is not None:
+        if precomputed_file_transformation is self.precomputed_file_transformation and \
+                precomputed_file_transformation is not None:
+            img_file, sem_lbl_file, inst_lbl_file = self.get_precomputed_files(index)
+        elif precomputed_file_transformation is not None:
             img_file, sem_lbl_file, inst_lbl_file = \
                 precomputed_file_transformation.transform(img_file=img_file, sem_lbl_file=sem_lbl_file,
                                                           inst_lbl_file=inst_lbl_file)
@@ -92,6 +108,31 @@ class TransformedInstanceDataset(InstanceDatasetBase):
         img, lbl = self.load_files(img_file, sem_lbl_file, inst_lbl_file)
         return img, lbl
 
+    def get_precomputed_files(self, index):
+        """
+        Files of item index after self.precomputed_file_transformation
+        """
+        return self.precomputed_files[index]
+
+    def lookup_precomputed_files(self):
+        """
+        Files of every item after self.precomputed_file_transformation.  Only their names are looked up; the items with
+        missing files are built with precomputed_file_builder (in a process pool).  To build them ahead of time, or
+        rebuild them when their sources change, run scripts/build_precomputed_files.py.
+        """
+        data_files = self.raw_dataset.files
+        precomputed_files = [self.precomputed_file_transformation.get_transformed_files(
+            img_file=data_file['img'], sem_lbl_file=data_file['sem_lbl'], inst_lbl_file=data_file['inst_lbl'])
+            for data_file in data_files]
+        missing_idxs = [idx for idx, files in enumerate(precomputed_files) if not all([osp.isfile(f) for f in files])]
+        if len(missing_idxs) > 0:
+            print('Building the missing precomputed files of {} of {} items (to build them ahead of time, see '
+                  'scripts/build_precomputed_files.py)'.format(len(missing_idxs), len(data_files)))
+            precomputed_file_builder.build_precomputed_files(self.precomputed_file_transformation,
+                                                             [data_files[idx] for idx in missing_idxs],
+                                                             manifest_file=None)
+        return precomputed_files
+
     def get_item(self, index, precomputed_file_transformation=None, runtime_transformation=None):
         if not self.raw_dataset_returns_images:
             img, lbl = self.get_item_from_files(index, precomputed_file_transformation)
@@ -0,0 +1,163 @@
+"""
+Packed dataset cache: the decoded (and resized, if the runtime transformation resizes) images and labels of a
+TransformedInstanceDataset, written once into memory-mapped shards, so later epochs don't decode any image files.
+
+Layout of a pack directory:
+    shard_<i>.img: uint8 images (H x W x C), back to back
+    shard_<i>.lbl: labels (2 x H x W: semantic, then instance; int16 unless they don't fit), back to back
+    index.npz: 'index' (N x 6: shard, image offset, label offset, H, W, C) and 'lbl_dtype'.  Written last, so a pack
+        without it is incomplete.
+"""
+import os
+
+import numpy as np
+import tqdm
+
+from instanceseg.datasets.instance_dataset import TransformedInstanceDataset
+from instanceseg.datasets.runtime_transformations import GenericSequenceRuntimeDatasetTransformer, \
+    ResizeRuntimeDatasetTransformer
+
+INDEX_FILENAME = 'index.npz'
+SHARD_SIZE_BYTES = 2 ** 30
+
+
+def split_runtime_transformation(runtime_transformation):
+    """
+    Splits a runtime transformation into the part that's packed (the resizes at the start, which work on the decoded
+    numpy arrays) and the part that still runs on every __getitem__ (tensor conversion, label remapping, ...).
+    Either can be None.
+    """
+    transformer_sequence = runtime_transformation.transformer_sequence \
+        if isinstance(runtime_transformation, GenericSequenceRuntimeDatasetTransformer) \
+        else [runtime_transformation] if runtime_transformation is not None else []
+    n_packed = 0
+    while n_packed < len(transformer_sequence) and \
+            isinstance(transformer_sequence[n_packed], ResizeRuntimeDatasetTransformer):
+        n_packed += 1
+    return make_transformation(transformer_sequence[:n_packed]), make_transformation(transformer_sequence[n_packed:])
+
+
+def make_transformation(transformer_sequence):
+    if len(transformer_sequence) == 0:
+        return None
+    elif len(transformer_sequence) == 1:
+        return transformer_sequence[0]
+    else:
+        return GenericSequenceRuntimeDatasetTransformer(transformer_sequence=transformer_sequence)
+
+
+def is_packed(pack_dir):
+    return os.path.isfile(os.path.join(pack_dir, INDEX_FILENAME))
+
+
+def pack_dataset(dataset: TransformedInstanceDataset, pack_dir, lbl_dtype=np.int16,
+                 shard_size_bytes=SHARD_SIZE_BYTES):
+    """
+    Writes the pack of dataset to pack_dir (see the module docstring).  Labels are widened to int32 (and the pack
+    restarted) if they don't fit in lbl_dtype.
+    """
+    packed_transformation, _ = split_runtime_transformation(dataset.runtime_transformation)
+    if not os.path.isdir(pack_dir):
+        os.makedirs(pack_dir)
+    index = np.zeros((len(dataset), 6), dtype=np.int64)
+    dtype_info = np.iinfo(lbl_dtype)
+    shard_idx, img_file, lbl_file = -1, None, None
+    img_offset, lbl_offset, shard_n_bytes = 0, 0, 0
+    lbls_fit = True
+    try:
+        for idx in tqdm.tqdm(range(len(dataset)), desc='Packing dataset into {}'.format(pack_dir), leave=False):
+            img, (sem_lbl, inst_lbl) = dataset.get_item(idx, dataset.precomputed_file_transformation,
+                                                        packed_transformation)
+            lbl = np.stack([sem_lbl, inst_lbl])
+            if lbl.min() < dtype_info.min or lbl.max() > dtype_info.max:
+                lbls_fit = False
+                break
+            img = np.ascontiguousarray(img, dtype=np.uint8)
+            lbl = np.ascontiguousarray(lbl, dtype=lbl_dtype)
+            if img_file is None or (shard_n_bytes > 0 and shard_n_bytes + img.nbytes + lbl.nbytes > shard_size_bytes):
+                if img_file is not None:
+                    img_file.close(), lbl_file.close()
+                shard_idx += 1
+                img_file = open(get_shard_filename(pack_dir, shard_idx, 'img'), 'wb')
+                lbl_file = open(get_shard_filename(pack_dir, shard_idx, 'lbl'), 'wb')
+                img_offset, lbl_offset, shard_n_bytes = 0, 0, 0
+            index[idx, :] = (shard_idx, img_offset, lbl_offset, img.shape[0], img.shape[1],
+                             img.shape[2] if img.ndim == 3 else 0)
+            img_file.write(img.tobytes())
+            lbl_file.write(lbl.tobytes())
+            img_offset, lbl_offset = img_offset + img.size, lbl_offset + lbl.size
+            shard_n_bytes += img.nbytes + lbl.nbytes
+    finally:
+        if img_file is not None:
+            img_file.close(), lbl_file.close()
+    if not lbls_fit:
+        assert np.dtype(lbl_dtype) != np.int32, ValueError('Labels don\'t fit in int32')
+        print(Warning('Labels don\'t fit in {}; packing them as int32 instead'.format(np.dtype(lbl_dtype).name)))
+        return pack_dataset(dataset, pack_dir, lbl_dtype=np.int32, shard_size_bytes=shard_size_bytes)
+    tmp_index_file = os.path.join(pack_dir, INDEX_FILENAME + '.tmp')
+    with open(tmp_index_file, 'wb') as f:
+        np.savez(f, index=index, lbl_dtype=np.dtype(lbl_dtype).name)
+    os.rename(tmp_index_file, os.path.join(pack_dir, INDEX_FILENAME))
+
+
+def get_shard_filename(pack_dir, shard_idx, kind):
+    return os.path.join(pack_dir, 'shard_{:04d}.{}'.format(shard_idx, kind))
+
+
+class PackedInstanceDataset(TransformedInstanceDataset):
+    """
+    Reads the items of a TransformedInstanceDataset from its pack (packing it first if pack_dir doesn't have one):
+    images and labels are copy-on-write views into memory-mapped shards (so transformations that work in place never
+    touch the pack), and only the unpacked part of the runtime transformation (see split_runtime_transformation) runs
+    on them.  Keeps the original dataset's transformations (transformer tags, class names and untransform are
+    unchanged).
+    """
+    def __init__(self, dataset: TransformedInstanceDataset, pack_dir):
+        assert dataset.should_use_precompute_transform and dataset.should_use_runtime_transform, \
+            ValueError('Only datasets with their transformations on can be packed')
+        super(PackedInstanceDataset, self).__init__(
+            raw_dataset=dataset.raw_dataset, raw_dataset_returns_images=dataset.raw_dataset_returns_images,
+            precomputed_file_transformation=dataset.precomputed_file_transformation,
+            runtime_transformation=dataset.runtime_transformation, precomputed_files=dataset.precomputed_files)
+        self.pack_dir = pack_dir
+        if not is_packed(pack_dir):
+            pack_dataset(dataset, pack_dir)
+        _, self.unpacked_transformation = split_runtime_transformation(dataset.runtime_transformation)
+        with np.load(os.path.join(pack_dir, INDEX_FILENAME)) as index_file:
+            self.index = index_file['index']
+            self.lbl_dtype = np.dtype(str(index_file['lbl_dtype']))
+        assert len(self.index) == len(dataset), ValueError('Pack in {} has {} images; dataset has {}'.format(
+            pack_dir, len(self.index), len(dataset)))
+        self.shards = {}  # opened on first use (e.g. - in each loader worker)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['shards'] = {}
+        return state
+
+    def get_shard(self, shard_idx):
+        if shard_idx not in self.shards:
+            self.shards[shard_idx] = (
+                np.memmap(get_shard_filename(self.pack_dir, shard_idx, 'img'), dtype=np.uint8, mode='c'),
+                np.memmap(get_shard_filename(self.pack_dir, shard_idx, 'lbl'), dtype=self.lbl_dtype, mode='c'))
+        return self.shards[shard_idx]
+
+    def get_packed_item(self, index):
+        """
+        img: H x W x C uint8; lbl: (sem_lbl, inst_lbl), H x W each -- copy-on-write views into the pack
+        """
+        shard_idx, img_offset, lbl_offset, height, width, n_channels = self.index[index]
+        shard_imgs, shard_lbls = self.get_shard(shard_idx)
+        img_shape = (height, width, n_channels) if n_channels > 0 else (height, width)
+        img = shard_imgs[img_offset:(img_offset + int(np.prod(img_shape)))].reshape(img_shape)
+        lbl = shard_lbls[lbl_offset:(lbl_offset + 2 * height * width)].reshape(2, height, width)
+        return img, (lbl[0], lbl[1])
+
+    def __getitem__(self, index):
+        img, lbl = self.get_packed_item(index)
+        if self.unpacked_transformation is not None:
+            img, lbl = self.unpacked_transformation.transform(img, lbl)
+        return img, lbl
+
+    def load_files(self, img_file, sem_lbl_file, inst_lbl_file):
+        raise NotImplementedError('Packed datasets are read from their pack (see get_packed_item)')
@@ -0,0 +1,132 @@
+"""
+Builds the files of a precomputed file transformation (see precomputed_file_transformations) for a whole split ahead of
+training, in a process pool, so the datasets only look them up.  A file is only rebuilt if it's missing or the files it
+was computed from changed since it was built (their mtime changed, and then their md5 too).  The manifest records, for
+each built file, the mtime and md5 of its source files:
+    {<transformed file>: {<source file>: [<mtime>, <md5>]}}
+"""
+import hashlib
+import json
+import multiprocessing
+import os
+
+import tqdm
+
+from instanceseg.datasets.precomputed_file_transformations import GenericSequencePrecomputedDatasetFileTransformer, \
+    write_atomically
+
+_worker_state = {}  # set in each worker by init_worker
+
+
+def get_transformation_steps(transformation):
+    if transformation is None:
+        return []
+    elif isinstance(transformation, GenericSequencePrecomputedDatasetFileTransformer):
+        return [step for transformer in transformation.transformer_sequence
+                for step in get_transformation_steps(transformer)]
+    else:
+        return [transformation]
+
+
+def load_manifest(manifest_file):
+    if manifest_file is None or not os.path.isfile(manifest_file):
+        return {}
+    with open(manifest_file, 'r') as f:
+        return json.load(f)
+
+
+def save_manifest(manifest, manifest_file):
+    def write(filename):
+        with open(filename, 'w') as f:
+            json.dump(manifest, f)
+    write_atomically(write, manifest_file)
+
+
+def get_md5(filename, chunk_size=2 ** 20):
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def get_source_record(source_file, old_record=None):
+    """
+    [mtime, md5] of source_file; the md5 is only recomputed if the mtime changed since old_record.
+    """
+    mtime = os.path.getmtime(source_file)
+    if old_record is not None and old_record[0] == mtime:
+        return [mtime, old_record[1]]
+    return [mtime, get_md5(source_file)]
+
+
+def is_up_to_date(transformed_file, source_records, manifest_entry):
+    if not os.path.isfile(transformed_file) or manifest_entry is None or \
+            set(manifest_entry.keys()) != set(source_records.keys()):
+        return False
+    return all([manifest_entry[source_file][1] == record[1] for source_file, record in source_records.items()])
+
+
+def build_item_files(steps, files, manifest):
+    """
+    Runs each step on files (img_file, sem_lbl_file, inst_lbl_file), (re)generating its files if they're out of date.
+    Returns the transformed files, the new manifest entries of the files the steps make and how many steps had to
+    generate their files.
+    """
+    new_entries, n_generated = {}, 0
+    for step in steps:
+        transformed_files = step.get_transformed_files(*files)
+        new_files = [f for f in transformed_files if f not in files]
+        if len(new_files) > 0:
+            old_entries = [manifest.get(f) for f in new_files]
+            source_records = {}
+            for source_file in step.get_source_files(*files):
+                old_records = [e[source_file] for e in old_entries if e is not None and source_file in e]
+                source_records[source_file] = get_source_record(source_file,
+                                                                old_records[0] if len(old_records) > 0 else None)
+            if not all([is_up_to_date(f, source_records, e) for f, e in zip(new_files, old_entries)]):
+                step.generate_transformed_files(*files)
+                n_generated += 1
+            new_entries.update({f: source_records for f in new_files})
+        files = transformed_files
+    return files, new_entries, n_generated
+
+
+def init_worker(steps, manifest):
+    _worker_state['steps'] = steps
+    _worker_state['manifest'] = manifest
+
+
+def build_item_files_in_worker(files):
+    return build_item_files(_worker_state['steps'], files, _worker_state['manifest'])
+
+
+def build_precomputed_files(transformation, data_files, manifest_file, n_processes=None):
+    """
+    data_files: the raw dataset's files ([{'img': ..., 'sem_lbl': ..., 'inst_lbl': ...}, ...])
+    n_processes: defaults to the number of CPUs; 0 builds in this process.
+    Returns the transformed (img_file, sem_lbl_file, inst_lbl_file) of each item, which can be handed to the dataset
+    (TransformedInstanceDataset's precomputed_files argument) so it doesn't have to look them up.
+    """
+    steps = get_transformation_steps(transformation)
+    manifest = load_manifest(manifest_file)
+    item_files = [(f['img'], f['sem_lbl'], f['inst_lbl']) for f in data_files]
+    transformed_item_files, n_generated = [], 0
+    pool = multiprocessing.Pool(n_processes, initializer=init_worker, initargs=(steps, manifest)) \
+        if n_processes != 0 else None
+    try:
+        results = pool.imap(build_item_files_in_worker, item_files, chunksize=8) if pool is not None \
+            else (build_item_files(steps, files, manifest) for files in item_files)
+        for files, new_entries, n_item_generated in tqdm.tqdm(results, total=len(item_files),
+                                                              desc='Building precomputed files', leave=False):
+            transformed_item_files.append(files)
+            manifest.update(new_entries)
+            n_generated += n_item_generated
+    finally:
+        if pool is not None:
+            pool.terminate()
+        if manifest_file is not None:
+            save_manifest(manifest, manifest_file)  # even if interrupted, so finished files aren't rebuilt
+    print('Generated the files of {} of {} (image, step) pairs; the rest were up to date.'.format(
+        n_generated, len(item_files) * len(steps)))
+    return transformed_item_files
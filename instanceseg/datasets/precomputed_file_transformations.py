@@ -1,22 +1,47 @@
 from instanceseg.utils import datasets
+import os
 import os.path as osp
 import inspect
 
 
 class PrecomputedDatasetFileTransformerBase(object):
+    """
+    Transforms the files of a dataset item into derived files (e.g. - reordered instance labels), generated once and
+    then reused.  Subclasses implement get_transformed_files (a lookup) and generate_transformed_files (writes them,
+    with write_atomically); transform generates the transformed files only if they're missing.  To generate them ahead
+    of time (in parallel, and again when their sources change), see precomputed_file_builder.
+    """
     # def __init__(self):
     #    self.original_semantic_class_names = None
 
     def transform(self, img_file, sem_lbl_file, inst_lbl_file):
+        transformed_files = self.get_transformed_files(img_file, sem_lbl_file, inst_lbl_file)
+        if not all([osp.isfile(f) for f in transformed_files]):
+            self.generate_transformed_files(img_file, sem_lbl_file, inst_lbl_file)
+        return transformed_files
+
+    def get_transformed_files(self, img_file, sem_lbl_file, inst_lbl_file):
+        """
+        The files transform returns (without generating them)
+        """
         ## Template:
-        # new_sem_lbl_file = sem_lbl_file.replace(<ext>, <new_file_ext>)
-        # if not osp.isfile(new_sem_lbl_file ):
-        #   assert osp.isfile(sem_lbl_file)
-        #   <create_new_sem_file()>
+        # return img_file, sem_lbl_file.replace(<ext>, <new_file_ext>), inst_lbl_file
+        raise NotImplementedError
 
-        # return img_file, new_sem_lbl_file, inst_lbl_file
+    def generate_transformed_files(self, img_file, sem_lbl_file, inst_lbl_file):
+        """
+        (Re)writes the files get_transformed_files names that differ from the input files
+        """
+        ## Template:
+        # write_atomically(lambda f: <create_new_sem_file(sem_lbl_file, f)>, <new_sem_lbl_file>)
         raise NotImplementedError
 
+    def get_source_files(self, img_file, sem_lbl_file, inst_lbl_file):
+        """
+        The input files the transformed files are computed from (they're regenerated when these change)
+        """
+        return [sem_lbl_file, inst_lbl_file]
+
     def untransform(self, img_file, sem_lbl_file, inst_lbl_file):
         ## Template:
         # old_sem_lbl_file = sem_lbl_file.replace(<new_file_ext>, <ext>)
@@ -68,25 +93,26 @@ class InstanceOrderingPrecomputedDatasetFileTransformation(PrecomputedDatasetFil
     def __init__(self, ordering=None):
         self.ordering = ordering  # 'lr', 'big_to_small'
 
-    def transform(self, img_file, sem_lbl_file, inst_lbl_file):
+    def get_transformed_files(self, img_file, sem_lbl_file, inst_lbl_file):
+        if self.ordering is None:
+            return img_file, sem_lbl_file, inst_lbl_file
+        elif self.ordering.lower() in ('lr', 'big_to_small', 'bigsmall'):
+            return img_file, sem_lbl_file, inst_lbl_file.replace('.png', self.postfix + '.png')
+        else:
+            raise ValueError('ordering={} not recognized'.format(self.ordering))
+
+    def generate_transformed_files(self, img_file, sem_lbl_file, inst_lbl_file):
         inst_lbl_file_unordered = inst_lbl_file
+        _, _, inst_lbl_file_ordered = self.get_transformed_files(img_file, sem_lbl_file, inst_lbl_file)
         if self.ordering is None:
-            inst_lbl_file_ordered = inst_lbl_file_unordered
+            return
         elif self.ordering.lower() == 'lr':
-            inst_lbl_file_ordered = inst_lbl_file_unordered.replace('.png', self.postfix + '.png')
-            if not osp.isfile(inst_lbl_file_ordered):
-                datasets.generate_ordered_instance_file(inst_lbl_file_unordered,
-                                                        sem_lbl_file, inst_lbl_file_ordered, ordering='lr',
-                                                        increasing='True')
-        elif self.ordering.lower() == 'big_to_small' or self.ordering.lower() == 'bigsmall':
-            inst_lbl_file_ordered = inst_lbl_file_unordered.replace('.png', self.postfix + '.png')
-            if not osp.isfile(inst_lbl_file_ordered):
-                datasets.generate_ordered_instance_file(inst_lbl_file_unordered,
-                                                        sem_lbl_file, inst_lbl_file_ordered,
-                                                        ordering='size', increasing=False)
+            ordering, increasing = 'lr', 'True'
         else:
-            raise ValueError('ordering={} not recognized'.format(self.ordering))
-        return img_file, sem_lbl_file, inst_lbl_file_ordered
+            ordering, increasing = 'size', False
+        write_atomically(lambda out_file: datasets.generate_ordered_instance_file(
+            inst_lbl_file_unordered, sem_lbl_file, out_file, ordering=ordering, increasing=increasing),
+                         inst_lbl_file_ordered)
 
     def untransform(self, img_file, sem_lbl_file, inst_lbl_file):
         inst_lbl_file_ordered = inst_lbl_file
@@ -121,6 +147,15 @@ class GenericSequencePrecomputedDatasetFileTransformer(PrecomputedDatasetFileTra
                 img_file, sem_lbl_file, inst_lbl_file = transformer.transform(img_file, sem_lbl_file, inst_lbl_file)
         return img_file, sem_lbl_file, inst_lbl_file
 
+    def get_transformed_files(self, img_file, sem_lbl_file, inst_lbl_file):
+        assert all([isinstance(transformer, PrecomputedDatasetFileTransformerBase)
+                    for transformer in self.transformer_sequence]), \
+            ValueError('Plain functions in the sequence have to be called to know their files (use transform)')
+        for transformer in self.transformer_sequence:
+            img_file, sem_lbl_file, inst_lbl_file = transformer.get_transformed_files(img_file, sem_lbl_file,
+                                                                                      inst_lbl_file)
+        return img_file, sem_lbl_file, inst_lbl_file
+
     def untransform(self, img_file, sem_lbl_file, inst_lbl_file):
         assert all([isinstance(transformer, PrecomputedDatasetFileTransformerBase)
                     for transformer in self.transformer_sequence]), \
@@ -137,3 +172,17 @@ class GenericSequencePrecomputedDatasetFileTransformer(PrecomputedDatasetFileTra
             attributes += a
         return attributes
 
+
+def write_atomically(write_fcn, filename):
+    """
+    write_fcn(tmp_filename) writes the file, which is then renamed to filename: readers (e.g. - loader workers
+    generating the same file at the same time) only ever see a complete file.
+    """
+    directory, basename = osp.split(filename)
+    tmp_filename = osp.join(directory, '.tmp{}_{}'.format(os.getpid(), basename))  # same extension, for PIL
+    try:
+        write_fcn(tmp_filename)
+        os.replace(tmp_filename, filename)
+    finally:
+        if osp.lexists(tmp_filename):
+            os.remove(tmp_filename)
@@ -1,6 +1,8 @@
 from instanceseg.utils import datasets
 import inspect
 
+import torch
+
 
 DEBUG_ASSERT = True
 
@@ -20,6 +22,20 @@ class RuntimeDatasetTransformerBase(object):
         attributes = [a for a in attributes if not(a[0].startswith('__') and a[0].endswith('__')) and not callable(a)]
         return attributes
 
+    def is_pointwise_label_transformer(self):
+        """
+        True for transformers that only change the labels, each (sem, inst) pair of values depending on nothing else.
+        They implement transform_lbl (transform without any checks) and get_invalid_lbl_mask (the pairs transform
+        rejects), so GenericSequenceRuntimeDatasetTransformer can fuse them (FusedLabelRuntimeDatasetTransformer).
+        """
+        return False
+
+    def transform_lbl(self, sem_lbl, inst_lbl):
+        raise NotImplementedError
+
+    def get_invalid_lbl_mask(self, sem_lbl, inst_lbl):
+        return None
+
     # def transform_semantic_class_names(self, original_semantic_class_names):
     # """ If exists, gets called whenever the dataset's semantic class names are queried. """
     #     self.original_semantic_class_names = original_semantic_class_names
@@ -71,8 +87,14 @@ def runtime_transformer_factory(resize=None, resize_size=None, mean_bgr=None, re
 
 class SemanticAgreementForInstanceLabelsRuntimeDatasetTransformer(RuntimeDatasetTransformerBase):
     def transform(self, img, lbl):
-        new_inst_lbl = self.impose_semantic_constraints_on_instance_label(lbl[0], lbl[1])
-        return img, (lbl[0], new_inst_lbl)
+        return img, self.transform_lbl(lbl[0], lbl[1])
+
+    def is_pointwise_label_transformer(self):
+        return True
+
+    def transform_lbl(self, sem_lbl, inst_lbl):
+        new_inst_lbl = self.impose_semantic_constraints_on_instance_label(sem_lbl, inst_lbl)
+        return sem_lbl, new_inst_lbl
 
     def untransform(self, img, lbl):
         print(Warning('It\'s not possible to recover the initial instance labels.  Returning the existing ones.'))
@@ -117,9 +139,15 @@ class InstanceNumberCapRuntimeDatasetTransformer(RuntimeDatasetTransformerBase):
         self.instance_id_for_excluded_instances = instance_id_for_excluded_instances
 
     def transform(self, img, lbl):
-        new_inst_lbl = lbl[1]
+        return img, self.transform_lbl(lbl[0], lbl[1])
+
+    def is_pointwise_label_transformer(self):
+        return True
+
+    def transform_lbl(self, sem_lbl, inst_lbl):
+        new_inst_lbl = inst_lbl
         new_inst_lbl[new_inst_lbl > self.n_inst_cap_per_class] = self.instance_id_for_excluded_instances
-        return img, (lbl[0], new_inst_lbl)
+        return sem_lbl, new_inst_lbl
 
     def untransform(self, img, lbl):
         print(Warning('It\'s not possible to recover the initial instance labels (many-to-one mapping).  Returning the '
@@ -138,9 +166,24 @@ class SingleInstanceMapperRuntimeDatasetTransformer(RuntimeDatasetTransformerBas
             for bv in self.background_values:
                 # Make sure the initial background value instance labels were either 0 or -1
                 assert ((new_inst_lbl != 0)[sem_lbl == bv]).sum() == ((new_inst_lbl == -1)[sem_lbl == bv]).sum()
+        return img, self.transform_lbl(sem_lbl, new_inst_lbl)
+
+    def is_pointwise_label_transformer(self):
+        return True
+
+    def transform_lbl(self, sem_lbl, inst_lbl):
+        new_inst_lbl = inst_lbl
         # Set objects to instance value 1
         new_inst_lbl[new_inst_lbl > 1] = 1
-        return img, (lbl[0], new_inst_lbl)
+        return sem_lbl, new_inst_lbl
+
+    def get_invalid_lbl_mask(self, sem_lbl, inst_lbl):
+        if not DEBUG_ASSERT:
+            return None
+        is_invalid = sem_lbl != sem_lbl
+        for bv in self.background_values:
+            is_invalid[(sem_lbl == bv) & (inst_lbl != 0) & (inst_lbl != -1)] = 1
+        return is_invalid
 
     def untransform(self, img, lbl):
         print(Warning('It\'s not possible to recover the initial instance labels (many-to-one mapping).  Returning the '
@@ -161,6 +204,25 @@ class SemanticSubsetRuntimeDatasetTransformer(RuntimeDatasetTransformerBase):
         lbl = (sem_fcn(lbl[0]), lbl[1])
         return img, lbl
 
+    def is_pointwise_label_transformer(self):
+        return True
+
+    def transform_lbl(self, sem_lbl, inst_lbl):
+        # map_other_classes_to_bground=False only adds a check (labels outside the subset raise); the remapping of the
+        # labels that pass it is the same.  transform_lbl runs without checks -- the fused tables are built from every
+        # pair of values in a range -- and get_invalid_lbl_mask is that check, so those labels still go through
+        # transform (and raise) when self.map_other_classes_to_bground is False.
+        return datasets.remap_to_reduced_semantic_classes(sem_lbl, reduced_class_idxs=self.reduced_class_idxs,
+                                                          map_other_classes_to_bground=True), inst_lbl
+
+    def get_invalid_lbl_mask(self, sem_lbl, inst_lbl):
+        if self.map_other_classes_to_bground:
+            return None
+        is_invalid = sem_lbl != -1
+        for old_class_idx in self.reduced_class_idxs:
+            is_invalid[sem_lbl == old_class_idx] = 0
+        return is_invalid
+
     def untransform(self, img, lbl):
         raise NotImplementedError('Implement here if needed.')
 
@@ -211,15 +273,44 @@ class BasicRuntimeDatasetTransformer(RuntimeDatasetTransformerBase):
 
 
 class GenericSequenceRuntimeDatasetTransformer(RuntimeDatasetTransformerBase):
-    def __init__(self, transformer_sequence):
+    def __init__(self, transformer_sequence, fuse_label_transformers=True):
         """
         :param transformer_sequence:   list of functions of type transform(img, lbl)
                                                 or RuntimeDatasetTransformerBase objects
+        :param fuse_label_transformers: transform runs consecutive pointwise label transformers as one lookup (see
+        compile_transformer_sequence); the output is the same.
         """
         self.transformer_sequence = transformer_sequence
+        self.fuse_label_transformers = fuse_label_transformers
+        self.compiled_transformer_sequence = None
+
+    def compile_transformer_sequence(self):
+        """
+        transformer_sequence, with each run of consecutive pointwise label transformers replaced by a
+        FusedLabelRuntimeDatasetTransformer.
+        """
+        compiled_sequence, run = [], []
+        for transformer in self.transformer_sequence + [None]:
+            if isinstance(transformer, RuntimeDatasetTransformerBase) and transformer.is_pointwise_label_transformer():
+                run.append(transformer)
+                continue
+            if len(run) > 1:
+                compiled_sequence.append(FusedLabelRuntimeDatasetTransformer(run))
+            else:
+                compiled_sequence += run
+            run = []
+            if transformer is not None:
+                compiled_sequence.append(transformer)
+        return compiled_sequence
 
     def transform(self, img, lbl):
-        for transformer in self.transformer_sequence:
+        if self.fuse_label_transformers:
+            if self.compiled_transformer_sequence is None:
+                self.compiled_transformer_sequence = self.compile_transformer_sequence()
+            transformer_sequence = self.compiled_transformer_sequence
+        else:
+            transformer_sequence = self.transformer_sequence
+        for transformer in transformer_sequence:
             if callable(transformer):
                 img, lbl = transformer(img, lbl)
             elif isinstance(transformer, RuntimeDatasetTransformerBase):
@@ -242,6 +333,91 @@ class GenericSequenceRuntimeDatasetTransformer(RuntimeDatasetTransformerBase):
         return attributes
 
 
+class FusedLabelRuntimeDatasetTransformer(RuntimeDatasetTransformerBase):
+    """
+    A sequence of pointwise label transformers (see RuntimeDatasetTransformerBase.is_pointwise_label_transformer) as
+    one lookup table from (sem, inst) to (sem', inst'): one gather per label instead of a few full-image passes per
+    transformer.  The tables are made by running the transformers on every pair of values in a range, and remade
+    (covering more values) when a label falls outside it.  Labels the transformers would reject, and labels that aren't
+    CPU tensors, go through the transformers one by one, so the output (or the error) is always theirs.
+    """
+    max_table_size = 2 ** 22
+
+    def __init__(self, transformer_sequence):
+        self.transformer_sequence = transformer_sequence
+        self.sem_range, self.inst_range = None, None  # (min, max) of the values the tables cover
+        self.sem_table, self.inst_table, self.is_valid_table = None, None, None
+        self.has_invalid_pairs = False
+
+    def transform(self, img, lbl):
+        sem_lbl, inst_lbl = lbl
+        if not (torch.is_tensor(sem_lbl) and torch.is_tensor(inst_lbl)) or sem_lbl.is_cuda or inst_lbl.is_cuda or \
+                sem_lbl.numel() == 0:
+            return self.transform_unfused(img, lbl)
+        sem_range, inst_range = self.get_range(sem_lbl), self.get_range(inst_lbl)
+        if not self.covers(sem_range, inst_range):
+            sem_range, inst_range = self.get_union_range(self.sem_range, sem_range), \
+                                    self.get_union_range(self.inst_range, inst_range)
+            if (sem_range[1] - sem_range[0] + 1) * (inst_range[1] - inst_range[0] + 1) > self.max_table_size:
+                return self.transform_unfused(img, lbl)
+            self.build_tables(sem_range, inst_range)
+        n_inst_values = self.inst_range[1] - self.inst_range[0] + 1
+        idxs = sem_lbl.long() * n_inst_values
+        idxs = idxs.add_(inst_lbl.long()).sub_(self.sem_range[0] * n_inst_values + self.inst_range[0])
+        idxs = idxs.contiguous().view(-1)
+        if self.has_invalid_pairs and not bool(self.is_valid_table.index_select(0, idxs).all()):
+            return self.transform_unfused(img, lbl)
+        return img, (self.sem_table.index_select(0, idxs).view_as(sem_lbl).type_as(sem_lbl),
+                     self.inst_table.index_select(0, idxs).view_as(inst_lbl).type_as(inst_lbl))
+
+    def transform_unfused(self, img, lbl):
+        for transformer in self.transformer_sequence:
+            img, lbl = transformer.transform(img, lbl)
+        return img, lbl
+
+    def untransform(self, img, lbl):
+        for transformer in self.transformer_sequence[::-1]:
+            img, lbl = transformer.untransform(img, lbl)
+        return img, lbl
+
+    @staticmethod
+    def get_range(lbl):
+        if hasattr(torch, 'aminmax'):
+            lbl_min, lbl_max = torch.aminmax(lbl)
+            return int(lbl_min), int(lbl_max)
+        return int(lbl.min()), int(lbl.max())
+
+    def covers(self, sem_range, inst_range):
+        return self.sem_range is not None and \
+            self.sem_range[0] <= sem_range[0] and sem_range[1] <= self.sem_range[1] and \
+            self.inst_range[0] <= inst_range[0] and inst_range[1] <= self.inst_range[1]
+
+    @staticmethod
+    def get_union_range(range_a, range_b):
+        return range_b if range_a is None else (min(range_a[0], range_b[0]), max(range_a[1], range_b[1]))
+
+    def build_tables(self, sem_range, inst_range):
+        n_sem_values, n_inst_values = sem_range[1] - sem_range[0] + 1, inst_range[1] - inst_range[0] + 1
+        sem_lbl = torch.arange(sem_range[0], sem_range[1] + 1).long().view(-1, 1).repeat(1, n_inst_values)
+        inst_lbl = torch.arange(inst_range[0], inst_range[1] + 1).long().view(1, -1).repeat(n_sem_values, 1)
+        is_valid = sem_lbl == sem_lbl
+        for transformer in self.transformer_sequence:
+            is_invalid = transformer.get_invalid_lbl_mask(sem_lbl, inst_lbl)
+            if is_invalid is not None:
+                is_valid[is_invalid] = 0
+            sem_lbl, inst_lbl = transformer.transform_lbl(sem_lbl, inst_lbl)
+        self.sem_table, self.inst_table = sem_lbl.contiguous().view(-1), inst_lbl.contiguous().view(-1)
+        self.is_valid_table = is_valid.view(-1)
+        self.has_invalid_pairs = not bool(is_valid.all())
+        self.sem_range, self.inst_range = sem_range, inst_range
+
+    def get_attribute_items(self):
+        attributes = []
+        for transformer in self.transformer_sequence:
+            attributes += transformer.get_attribute_items()
+        return attributes
+
+
 def generate_transformer_from_functions(img_transform_function=None, sem_lbl_transform_function=None,
                                         inst_lbl_transform_function=None, img_untransform_function=None,
                                         sem_lbl_untransform_function=None, inst_lbl_untransform_function=None,
@@ -1,3 +1,6 @@
+import collections
+
+import numpy as np
 import torch
 from torch.utils.data import sampler
 
@@ -16,7 +19,7 @@ def sampler_factory(sequential, index_weights=None, bool_index_subset=None):
             self.indices = self.get_sample_indices_from_initial(self.initial_indices)
 
         def __iter__(self):
-            if sequential:
+            if self.sequential:
                 return iter(self.indices)
             else:
                 return iter(self.indices[x] for x in torch.randperm(len(self.indices)).long())
@@ -48,6 +51,68 @@ def sampler_factory(sequential, index_weights=None, bool_index_subset=None):
     return SubsetWeightedSampler
 
 
+class SizeBucketBatchSampler(sampler.Sampler):
+    """
+    Batch sampler (DataLoader(..., batch_sampler=...)) that only batches together images of the same size, so batches
+    need little or no padding.  Indices come from index_sampler (e.g. - a SubsetWeightedSampler) and are dropped into
+    one bucket per (H, W); a bucket is returned as a batch as soon as it has batch_size indices.  The partial buckets
+    left at the end are returned last, in the order they were started.  So the batches (and their order) are the same
+    every pass if index_sampler is sequential.
+
+    image_sizes: N x 2; (H, W) of every image in the dataset (e.g. - from dataset_statistics.get_image_sizes)
+    size_granularity: sizes are rounded up to a multiple of this before bucketing (> 1 trades a little padding for
+        fuller batches)
+    """
+    def __init__(self, index_sampler, batch_size, image_sizes, drop_last=False, size_granularity=1):
+        self.index_sampler = index_sampler
+        self.batch_size = batch_size
+        self.image_sizes = np.asarray(image_sizes)
+        self.drop_last = drop_last
+        self.size_granularity = size_granularity
+        # index_sampler returns the same indices each pass (maybe reordered), so the number of batches is fixed
+        bucket_counts = collections.Counter(self.get_bucket_key(index) for index in self.index_sampler)
+        self.n_batches = sum((count // batch_size) if drop_last else int(np.ceil(count / batch_size))
+                             for count in bucket_counts.values())
+
+    @property
+    def sequential(self):
+        return is_sequential(self.index_sampler)
+
+    def get_bucket_key(self, index):
+        height, width = self.image_sizes[index]
+        return int(np.ceil(height / self.size_granularity)), int(np.ceil(width / self.size_granularity))
+
+    def __iter__(self):
+        buckets = collections.OrderedDict()
+        for index in self.index_sampler:
+            bucket_key = self.get_bucket_key(index)
+            bucket = buckets.setdefault(bucket_key, [])
+            bucket.append(index)
+            if len(bucket) == self.batch_size:
+                yield bucket
+                buckets[bucket_key] = []
+        if not self.drop_last:
+            for bucket in buckets.values():
+                if len(bucket) > 0:
+                    yield bucket
+
+    def __len__(self):
+        return self.n_batches
+
+
+def is_sequential(my_sampler):
+    return isinstance(my_sampler, sampler.SequentialSampler) or getattr(my_sampler, 'sequential', False)
+
+
+def get_loader_sampler(data_loader):
+    """
+    The sampler that decides the order of data_loader's images: its batch sampler, if it's a SizeBucketBatchSampler.
+    """
+    if isinstance(data_loader.batch_sampler, SizeBucketBatchSampler):
+        return data_loader.batch_sampler
+    return data_loader.sampler
+
+
 class SamplerConfig(object):
     def __init__(self, n_images=None, sem_cls_filter=None, n_instances_range=None):
         self.n_images = n_images
@@ -6,6 +6,7 @@ import numpy as np
 
 from instanceseg.utils import datasets
 from instanceseg.datasets.instance_dataset import InstanceDatasetBase, TransformedInstanceDataset
+from instanceseg.datasets.precomputed_file_transformations import write_atomically
 
 # TODO(allie): Allow for permuting the instance order at the beginning, and copying each filename
 #  multiple times with the assigned permutation.  That way you can train in batches that have
@@ -117,7 +118,8 @@ def get_raw_voc_files(dataset_dir, split):
             if not osp.isfile(inst_absolute_lbl_file):
                 raise Exception('This image does not exist')
             print('Generating per-semantic instance file: {}'.format(inst_lbl_file_unordered))
-            datasets.generate_per_sem_instance_file(inst_absolute_lbl_file, sem_lbl_file, inst_lbl_file_unordered)
+            write_atomically(lambda out_file: datasets.generate_per_sem_instance_file(
+                inst_absolute_lbl_file, sem_lbl_file, out_file), inst_lbl_file_unordered)
 
         files.append({
             'img': img_file,
@@ -161,7 +163,9 @@ class TransformedVOC(TransformedInstanceDataset):
 
     def __init__(self, root, split, precomputed_file_transformation=None, runtime_transformation=None):
         raw_dataset = RawVOCBase(root, split=split)
-        super(TransformedVOC, self).__init__(raw_dataset, precomputed_file_transformation, runtime_transformation)
+        super(TransformedVOC, self).__init__(raw_dataset=raw_dataset, raw_dataset_returns_images=False,
+                                             precomputed_file_transformation=precomputed_file_transformation,
+                                             runtime_transformation=runtime_transformation)
 
     def load_files(self, img_file, sem_lbl_file, inst_lbl_file):
         return load_voc_files(img_file, sem_lbl_file, inst_lbl_file)
@@ -3,7 +3,7 @@ import os
 import numpy as np
 import torch
 
-from instanceseg.datasets import dataset_generator_registry, sampler, dataset_registry
+from instanceseg.datasets import dataset_generator_registry, sampler, dataset_registry, collate, dataset_statistics
 from instanceseg.utils.misc import pop_without_del
 from instanceseg.factory.samplers import get_configured_sampler
 
@@ -28,11 +28,30 @@ def get_dataloaders(cfg, dataset_type, cuda, sampler_cfg=None):
 
     # Create dataloaders from datasets and samplers
     loader_kwargs = {'num_workers': 4, 'pin_memory': True} if cuda else {}
-
-    train_loader = torch.utils.data.DataLoader(train_dataset, batch_size=1, sampler=train_sampler, **loader_kwargs)
-    val_loader = torch.utils.data.DataLoader(val_dataset, batch_size=1, sampler=val_sampler, **loader_kwargs)
-    train_loader_for_val = torch.utils.data.DataLoader(train_dataset, batch_size=1,
-                                                       sampler=train_for_val_sampler, **loader_kwargs)
+    # Images of different sizes are padded (labels with void) or cropped to a common size within a batch
+    loader_kwargs['collate_fn'] = collate.get_collate_fn(cfg.get('collate_mode', 'pad'))
+    train_batch_size = cfg.get('batch_size', 1)
+    val_batch_size = cfg.get('val_batch_size', 1)
+
+    if cfg.get('bucket_by_size', False):
+        # Batches of same-size images (see sampler.SizeBucketBatchSampler)
+        granularity = cfg.get('bucket_size_granularity', 1)
+        train_image_sizes = get_image_sizes(dataset_type, train_dataset, 'train')
+        val_image_sizes = train_image_sizes if val_dataset is train_dataset \
+            else get_image_sizes(dataset_type, val_dataset, 'val')
+        train_loader = torch.utils.data.DataLoader(train_dataset, batch_sampler=sampler.SizeBucketBatchSampler(
+            train_sampler, train_batch_size, train_image_sizes, size_granularity=granularity), **loader_kwargs)
+        val_loader = torch.utils.data.DataLoader(val_dataset, batch_sampler=sampler.SizeBucketBatchSampler(
+            val_sampler, val_batch_size, val_image_sizes, size_granularity=granularity), **loader_kwargs)
+        train_loader_for_val = torch.utils.data.DataLoader(train_dataset, batch_sampler=sampler.SizeBucketBatchSampler(
+            train_for_val_sampler, val_batch_size, train_image_sizes, size_granularity=granularity), **loader_kwargs)
+    else:
+        train_loader = torch.utils.data.DataLoader(train_dataset, batch_size=train_batch_size,
+                                                   sampler=train_sampler, **loader_kwargs)
+        val_loader = torch.utils.data.DataLoader(val_dataset, batch_size=val_batch_size, sampler=val_sampler,
+                                                 **loader_kwargs)
+        train_loader_for_val = torch.utils.data.DataLoader(train_dataset, batch_size=val_batch_size,
+                                                           sampler=train_for_val_sampler, **loader_kwargs)
 
     if DEBUG_ASSERTS:
         try:
@@ -47,6 +66,21 @@ def get_dataloaders(cfg, dataset_type, cuda, sampler_cfg=None):
     }
 
 
+def get_image_sizes(dataset_type, dataset, split):
+    """
+    (H, W) of every image in dataset, cached next to the dataset (except for synthetic datasets, which are generated on
+    the fly).
+    """
+    if dataset_type == 'synthetic':
+        image_size_file = None
+    else:
+        transformer_tag = dataset_generator_registry.get_transformer_identifier_tag(
+            dataset.precomputed_file_transformation, dataset.runtime_transformation)
+        image_size_file = os.path.join(dataset_registry.REGISTRY[dataset_type].dataset_path,
+                                       '{}_image_sizes_{}.npy'.format(split, transformer_tag))
+    return dataset_statistics.get_image_sizes(dataset, image_size_file)
+
+
 def get_samplers(dataset_type, sampler_cfg, train_dataset, val_dataset):
 
     if sampler_cfg is None:
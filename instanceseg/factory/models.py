@@ -3,7 +3,7 @@ import os
 import torch
 
 import instanceseg
-from instanceseg.utils import instance_utils
+from instanceseg.utils import instance_utils, precision
 from instanceseg.models import model_utils
 
 
@@ -49,6 +49,8 @@ def get_model(cfg, problem_config, checkpoint_file, semantic_init, cuda):
             model.copy_params_from_vgg16(vgg16)
     if cuda:
         model = model.cuda()
+    if cfg.get('channels_last', False):
+        model = precision.to_channels_last(model)
 
     if cfg['freeze_vgg']:
         model_utils.freeze_vgg_module_subset(model)
@@ -17,5 +17,17 @@ def get_trainer(cfg, cuda, model, optim, dataloaders, problem_config, out_dir, s
                                   write_instance_metrics=cfg['write_instance_metrics'],
                                   generate_new_synthetic_data_each_epoch=(
                                               cfg['dataset'] == 'synthetic' and cfg['infinite_synthetic']),
-                                  lr_scheduler=scheduler)
+                                  lr_scheduler=scheduler, matching_solver=cfg['matching_solver'],
+                                  matching_solver_threads=cfg['matching_solver_threads'],
+                                  instance_metrics_in_background=cfg['instance_metrics_in_background'],
+                                  instance_metrics_queue_size=cfg['instance_metrics_queue_size'],
+                                  telemetry_scalar_interval=cfg['telemetry_scalar_interval'],
+                                  telemetry_summary_interval=cfg['telemetry_summary_interval'],
+                                  telemetry_histogram_interval=cfg['telemetry_histogram_interval'],
+                                  telemetry_overhead_budget=cfg['telemetry_overhead_budget'],
+                                  loss_updates_interval=cfg['loss_updates_interval'],
+                                  loss_updates_mode=cfg['loss_updates_mode'],
+                                  train_metrics_interval=cfg['train_metrics_interval'],
+                                  precision=cfg['precision'], channels_last=cfg['channels_last'],
+                                  grad_accumulation_steps=cfg['grad_accumulation_steps'])
     return trainer
@@ -0,0 +1,174 @@
+import numpy as np
+import torch
+
+from instanceseg.datasets import collate
+from instanceseg.losses.xentropy import DEBUG_ASSERTS
+from instanceseg.models.model_utils import any_nan
+from instanceseg.utils import instance_utils
+
+
+def get_sem_cls_channel_blocks(semantic_instance_labels):
+    """
+    Groups channel indices by semantic value (0, ..., max(semantic_instance_labels)), padded with -1 so every
+    semantic class gets a block of the same size.
+    Example:
+        input: [0, 1, 1, 1, 2, 2, 2]
+        returns: [[0, -1, -1],
+                  [1, 2, 3],
+                  [4, 5, 6]]
+    """
+    n_semantic_values = max(semantic_instance_labels) + 1
+    idxs_by_sem_val = [[i for i, sem_val in enumerate(semantic_instance_labels) if sem_val == s]
+                       for s in range(n_semantic_values)]
+    block_size = max([len(idxs) for idxs in idxs_by_sem_val])
+    return np.array([idxs + [-1] * (block_size - len(idxs)) for idxs in idxs_by_sem_val], dtype=int)
+
+
+def get_channel_block_coordinates(channel_blocks):
+    """
+    Inverse of get_sem_cls_channel_blocks: for each channel c, the (sem_val, position) such that
+    channel_blocks[sem_val, position] == c.
+    Example:
+        input: [[0, -1, -1],
+                [1, 2, 3],
+                [4, 5, 6]]
+        returns: [0, 1, 1, 1, 2, 2, 2], [0, 0, 1, 2, 0, 1, 2]
+    """
+    sem_vals, positions = np.nonzero(channel_blocks >= 0)
+    channel_order = np.argsort(channel_blocks[sem_vals, positions])
+    return sem_vals[channel_order], positions[channel_order]
+
+
+def gather_channel_blocks(x, channel_blocks):
+    """
+    x: ... x C x P
+    channel_blocks: S x K (indices into C; -1 for padding)
+    returns: ... x S x K x P, with zeros in the padded rows
+    """
+    n_blocks, block_size = channel_blocks.shape
+    channel_dim = x.dim() - 2
+    padded_x = torch.cat([x.new_zeros(x.size()[:channel_dim] + (1, x.size(-1))), x], dim=channel_dim)  # 0 <- pad
+    block_idxs = torch.from_numpy(channel_blocks.reshape(-1) + 1).long()
+    if x.is_cuda:
+        block_idxs = block_idxs.cuda()
+    return padded_x.index_select(channel_dim, block_idxs).view(x.size()[:channel_dim] +
+                                                                (n_blocks, block_size, x.size(-1)))
+
+
+def get_channel_labels(sem_lbl, inst_lbl, semantic_instance_labels, instance_id_labels, lookup_table=None,
+                       lookup_table_tensors=None):
+    """
+    The channel each pixel's ground truth belongs to (-1 for void).
+    lookup_table: instance_utils.get_semantic_instance_lookup_table(...), if already computed
+    lookup_table_tensors: its copies by device (see instance_utils.apply_semantic_instance_lookup_table)
+    """
+    return instance_utils.combine_semantic_and_instance_labels(sem_lbl, inst_lbl, semantic_instance_labels,
+                                                               instance_id_labels, void_value=-1,
+                                                               lookup_table=lookup_table,
+                                                               lookup_table_tensors=lookup_table_tensors)
+
+
+def get_present_channels(channel_lbl, n_channels):
+    """
+    Finds the channels with ground truth pixels in each image with one unique pass over the whole batch.
+    channel_lbl: N x H x W (from get_channel_labels)
+    returns: N x C bool numpy array
+    """
+    n_images = channel_lbl.size(0)
+    image_offsets = (torch.arange(0, n_images) * (n_channels + 1)).type_as(channel_lbl).view(-1, 1, 1)
+    present_ids = torch.unique(channel_lbl + 1 + image_offsets).cpu().numpy()
+    is_present = np.zeros(n_images * (n_channels + 1), dtype=bool)
+    is_present[present_ids] = True
+    return is_present.reshape(n_images, n_channels + 1)[:, 1:]  # drop void
+
+
+def get_present_blocks(present_channels, channel_blocks):
+    """
+    present_channels: N x C bool (from get_present_channels)
+    channel_blocks: S x K (from get_sem_cls_channel_blocks)
+    returns: N x S bool; True where any ground truth instance of that semantic class is in the image
+    """
+    padded_present_channels = np.concatenate([np.zeros((present_channels.shape[0], 1), dtype=bool),
+                                              present_channels], axis=1)  # 0 <- padding
+    return padded_present_channels[:, channel_blocks + 1].any(axis=2)
+
+
+def get_binary_gt_for_all_channels(sem_lbl, inst_lbl, semantic_instance_labels, instance_id_labels,
+                                   channel_lbl=None):
+    """
+    One-hot ground truth for every channel at once (each pixel belongs to at most one channel; void to none).
+    sem_lbl, inst_lbl: H x W, or N x H x W for a batch
+    channel_lbl: get_channel_labels(sem_lbl, inst_lbl, ...), if already computed
+    returns: C x (H*W) float tensor (N x C x (H*W) for a batch)
+    """
+    n_channels = len(semantic_instance_labels)
+    leading_size = sem_lbl.size()[:-2]
+    if channel_lbl is None:
+        channel_lbl = get_channel_labels(sem_lbl, inst_lbl, semantic_instance_labels, instance_id_labels)
+    channel_lbl = channel_lbl.contiguous().view(leading_size + (1, -1)) + 1  # void (-1) lands in channel 0: dropped
+    channel_dim = len(leading_size)
+    binary_gt = torch.zeros(leading_size + (n_channels + 1, channel_lbl.size(-1)))
+    if channel_lbl.is_cuda:
+        binary_gt = binary_gt.cuda()
+    binary_gt.scatter_(channel_dim, channel_lbl, 1)
+    return binary_gt.narrow(channel_dim, 1, n_channels)
+
+
+def mask_padded_predictions(predictions, inst_lbl):
+    """
+    predictions (... x C x H x W) with 0 on the pixels collate.pad_collate added to inst_lbl (... x H x W).  Void
+    pixels keep their predictions, so unpadded batches are unchanged.
+    """
+    return predictions * (inst_lbl.data != collate.LBL_PAD_VALUE).unsqueeze(-3).type_as(predictions.data)
+
+
+def create_pytorch_cost_blocks(cost_block_fcn, predictions, sem_lbl, inst_lbl, semantic_instance_labels,
+                               instance_id_labels, size_average=True, channel_blocks=None, channel_lbl=None):
+    """
+    Batched replacement for match.create_pytorch_cost_matrix: builds the cost matrices of all semantic classes (and
+    all images, if given a batch) with one tensor op instead of one component loss call per (prediction, ground truth)
+    pair.
+
+    :param cost_block_fcn: f(yhat_blocks, binary_y_blocks) where both are ... x K x P; returns ... x K x K costs
+        (e.g. - xentropy.nll2d_cost_block, iou.my_soft_iou_loss_cost_block)
+    :param predictions: C,H,W or N,C,H,W
+    :param sem_lbl: (H,W) or (N,H,W)
+    :param inst_lbl: (H,W) or (N,H,W)
+    :param semantic_instance_labels:
+    :param instance_id_labels:
+    :param size_average:
+    :param channel_blocks: S x K from get_sem_cls_channel_blocks (computed here if None)
+    :param channel_lbl: get_channel_labels(sem_lbl, inst_lbl, ...) (computed here if None)
+    :return:
+        cost_blocks[sem_val][prediction][ground_truth] (S x K x K, or N x S x K x K); padded entries are 0.
+    Predictions on the padding of collate.pad_collate are ignored, so an image's costs don't depend on the rest of its
+    batch.
+    """
+    if DEBUG_ASSERTS:
+        assert inst_lbl.size() == sem_lbl.size()
+        assert predictions.size()[-2:] == inst_lbl.size()[-2:]
+        assert predictions.size()[:-3] == inst_lbl.size()[:-2]
+    if channel_blocks is None:
+        channel_blocks = get_sem_cls_channel_blocks(semantic_instance_labels)
+    leading_size = predictions.size()[:-3]
+    n_channels = predictions.size(-3)
+    binary_gt = get_binary_gt_for_all_channels(sem_lbl.data, inst_lbl.data, semantic_instance_labels,
+                                               instance_id_labels, channel_lbl=channel_lbl).type_as(predictions)
+    predictions = mask_padded_predictions(predictions, inst_lbl)
+    prediction_blocks = gather_channel_blocks(predictions.contiguous().view(leading_size + (n_channels, -1)),
+                                              channel_blocks)
+    binary_gt_blocks = gather_channel_blocks(binary_gt, channel_blocks)
+    cost_blocks = cost_block_fcn(prediction_blocks, binary_gt_blocks)
+
+    if size_average:
+        normalizer = (inst_lbl.data >= 0).contiguous().view(leading_size + (-1,)).float().sum(dim=-1)
+        is_all_void = (normalizer == 0).float()
+        if is_all_void.sum() > 0:
+            print(Warning('WARNING: image contained all void class.  Setting error to 0 for all channels.'))
+        normalizer = (normalizer + is_all_void).view(leading_size + (1, 1, 1)).type_as(cost_blocks.data)
+        not_void = (1 - is_all_void).view(leading_size + (1, 1, 1)).type_as(cost_blocks.data)
+        cost_blocks = cost_blocks * (not_void / normalizer)
+    if DEBUG_ASSERTS:
+        if any_nan(cost_blocks.data):
+            raise Exception('costs reached nan')
+    return cost_blocks
@@ -20,7 +20,7 @@ def my_soft_iou_loss(predictions_as_probabilities, binary_target):
     num_nonzero_pixels = binary_target.sum()
     # if num_nonzero_pixels.data.item() == 0:
     assert torch.numel(num_nonzero_pixels) == 1
-    if num_nonzero_pixels.data[0] == 0:
+    if float(num_nonzero_pixels) == 0:
         return num_nonzero_pixels
         # return Variable(type(predictions_as_probabilities)([0]))  # 0 in the correct format (tensor, variable)
     else:
@@ -41,6 +41,24 @@ def my_soft_iou(predictions_as_probabilities, binary_target):
     return intersection / union
 
 
+def my_soft_iou_loss_cost_block(predictions_as_probabilities_blocks, binary_target_blocks):
+    """
+    Batched equivalent of my_soft_iou_loss for every (prediction, ground truth) pair in a block.
+    predictions_as_probabilities_blocks: ... x K x P (K prediction channels, P pixels)
+    binary_target_blocks: ... x K x P (K ground truth instances, P pixels)
+    returns: ... x K x K, where cost_block[..., pred, gt] = my_soft_iou_loss(pp[..., pred, :], bt[..., gt, :])
+    """
+    pp = predictions_as_probabilities_blocks
+    bt = binary_target_blocks
+    intersection = torch.matmul(pp, bt.transpose(-1, -2))
+    num_nonzero_pixels = bt.sum(dim=-1).unsqueeze(-2)
+    union = pp.sum(dim=-1).unsqueeze(-1) + num_nonzero_pixels - intersection
+    # Empty ground truth has zero cost (as in my_soft_iou_loss); keep the denominator nonzero so gradients stay finite.
+    is_present = (num_nonzero_pixels > 0).float()
+    union = union + (union == 0).float()
+    return (1.0 - intersection / union) * is_present
+
+
 def lovasz_grad(gt_sorted):
     """
     Computes gradient of the Lovasz extension w.r.t sorted errors
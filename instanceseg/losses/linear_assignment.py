@@ -0,0 +1,147 @@
+"""
+Linear assignment backends for the matching loss.  Every solver takes a float cost_matrix[prediction][ground_truth]
+(K x K numpy array) and returns pred_for_gt, where pred_for_gt[gt] is the prediction assigned to that ground truth.
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from instanceseg.losses import match
+
+try:
+    from scipy.optimize import linear_sum_assignment
+except ImportError:
+    linear_sum_assignment = None
+
+
+def solve_with_numpy(cost_matrix):
+    """
+    Shortest augmenting path (Jonker-Volgenant) solver; one Dijkstra-like search per ground truth, vectorized over
+    predictions.  Exact on float costs -- no integer conversion needed.
+    """
+    cost = np.asarray(cost_matrix, dtype=np.float64).T  # rows: ground truth, columns: predictions
+    n = cost.shape[0]
+    assert cost.shape == (n, n), ValueError('cost matrix must be square; got {}'.format(cost.shape))
+    u, v = np.zeros(n), np.zeros(n)
+    col_for_row = np.full(n, -1, dtype=int)
+    row_for_col = np.full(n, -1, dtype=int)
+    for cur_row in range(n):
+        shortest_path_costs = np.full(n, np.inf)
+        path = np.full(n, -1, dtype=int)
+        unvisited = np.ones(n, dtype=bool)
+        scanned_rows = []
+        min_val, i, sink = 0.0, cur_row, -1
+        while sink == -1:
+            scanned_rows.append(i)
+            reduced_costs = min_val + cost[i, :] - u[i] - v
+            improved = unvisited & (reduced_costs < shortest_path_costs)
+            shortest_path_costs[improved] = reduced_costs[improved]
+            path[improved] = i
+            unvisited_cols = np.flatnonzero(unvisited)
+            j = unvisited_cols[np.argmin(shortest_path_costs[unvisited_cols])]
+            min_val = shortest_path_costs[j]
+            if min_val == np.inf:
+                raise Exception('No assignment is possible.')
+            unvisited[j] = False
+            if row_for_col[j] == -1:
+                sink = j
+            else:
+                i = row_for_col[j]
+
+        # Update dual variables
+        u[cur_row] += min_val
+        other_scanned_rows = np.array(scanned_rows[1:], dtype=int)
+        u[other_scanned_rows] += min_val - shortest_path_costs[col_for_row[other_scanned_rows]]
+        visited = ~unvisited
+        v[visited] -= min_val - shortest_path_costs[visited]
+
+        # Augment along the path back to cur_row
+        j = sink
+        while True:
+            i = path[j]
+            row_for_col[j] = i
+            col_for_row[i], j = j, col_for_row[i]
+            if i == cur_row:
+                break
+    return col_for_row
+
+
+def solve_with_scipy(cost_matrix):
+    if linear_sum_assignment is None:
+        raise ImportError('scipy is required for the \'scipy\' matching solver')
+    # Transpose so rows are ground truth; scipy returns rows in order.
+    _, pred_for_gt = linear_sum_assignment(np.asarray(cost_matrix, dtype=np.float64).T)
+    return pred_for_gt
+
+
+def solve_with_ortools(cost_matrix):
+    """
+    The original solver: quantizes costs to ints for pywrapgraph.LinearSumAssignment.
+    """
+    cost_matrix_int, multiplier = match.convert_float_costs_to_ints(np.asarray(cost_matrix, dtype=np.float64))
+    assignment = match.solve_matching_problem(cost_matrix_int, multiplier)
+    return np.array([assignment.RightMate(gt) for gt in range(len(cost_matrix_int))], dtype=int)
+
+
+def solve_cost_blocks(solver, cost_blocks, block_sizes, present_blocks=None, pool=None):
+    """
+    Solves every assignment problem in a batch of padded cost blocks: the blocks that need the solver are gathered
+    first, then mapped through pool (e.g. - get_solver_pool(n_threads)) in one call.  The scipy solver releases the
+    GIL, so its blocks are solved in parallel; the numpy solver holds it, so it only gains from the gathering.  Without
+    a pool, the blocks are solved one after the other in this thread (cheaper for a few small blocks).
+    cost_blocks: N x S x K x K numpy array (see cost_blocks.create_pytorch_cost_blocks)
+    block_sizes: length S; the number of real (unpadded) channels in each semantic class' block
+    present_blocks: N x S bool (see cost_blocks.get_present_blocks).  Blocks of absent semantic classes have no ground
+        truth, so every assignment costs the same; they get the identity assignment without calling the solver.
+    returns: pred_for_gt, N x S x K; pred_for_gt[n, s, :block_sizes[s]] solves block (n, s) (padding is -1)
+    """
+    n_images, n_blocks, block_size = cost_blocks.shape[:3]
+    block_sizes = np.asarray(block_sizes, dtype=int)
+    is_real_channel = np.arange(block_size)[np.newaxis, :] < block_sizes[:, np.newaxis]  # S x K
+    # Identity for every real channel (blocks of size 1 and absent classes); overwritten below where solved
+    pred_for_gt = np.where(is_real_channel, np.arange(block_size)[np.newaxis, :], -1)
+    pred_for_gt = np.repeat(pred_for_gt[np.newaxis, ...], n_images, axis=0)
+    needs_solver = np.repeat((block_sizes > 1)[np.newaxis, :], n_images, axis=0)
+    if present_blocks is not None:
+        needs_solver &= present_blocks
+    image_idxs, sem_vals = np.nonzero(needs_solver)
+    cost_matrices = [cost_blocks[i, sem_val, :block_sizes[sem_val], :block_sizes[sem_val]]
+                     for i, sem_val in zip(image_idxs, sem_vals)]
+    solutions = map(solver, cost_matrices) if pool is None or len(cost_matrices) <= 1 \
+        else pool.map(solver, cost_matrices)
+    for i, sem_val, solution in zip(image_idxs, sem_vals, solutions):
+        pred_for_gt[i, sem_val, :block_sizes[sem_val]] = solution
+    return pred_for_gt
+
+
+_SOLVER_POOLS = {}
+
+
+def get_solver_pool(n_threads):
+    """
+    The shared thread pool for solve_cost_blocks with n_threads workers; None (solve in the calling thread) if
+    n_threads <= 1.
+    """
+    if n_threads is None or n_threads <= 1:
+        return None
+    if n_threads not in _SOLVER_POOLS:
+        _SOLVER_POOLS[n_threads] = ThreadPoolExecutor(max_workers=n_threads)
+    return _SOLVER_POOLS[n_threads]
+
+
+MATCHING_SOLVERS = {
+    'numpy': solve_with_numpy,
+    'scipy': solve_with_scipy,
+    'ortools': solve_with_ortools,
+}
+
+
+def get_matching_solver(matching_solver):
+    if matching_solver not in MATCHING_SOLVERS:
+        raise ValueError('matching_solver must be one of {}; got {}'.format(list(MATCHING_SOLVERS.keys()),
+                                                                           matching_solver))
+    if matching_solver == 'scipy' and linear_sum_assignment is None:
+        raise ImportError('scipy is required for the \'scipy\' matching solver')
+    if matching_solver == 'ortools' and match.pywrapgraph is None:
+        raise ImportError('ortools is required for the \'ortools\' matching solver')
+    return MATCHING_SOLVERS[matching_solver]
@@ -4,7 +4,10 @@ from torch.nn import functional as F
 
 from instanceseg.losses import match
 from instanceseg.losses import xentropy, iou
+from instanceseg.losses import cost_blocks
+from instanceseg.losses import linear_assignment
 from instanceseg.losses.xentropy import DEBUG_ASSERTS
+from instanceseg.utils import instance_utils
 
 
 # TODO(allie): Implement test: Compare component loss function with full loss function when matching is off
@@ -17,13 +20,17 @@ def get_subclasses(cls):
 #                                     for loss_class in get_subclasses(ComponentMatchingLossBase)}
 
 
-def loss_object_factory(loss_type, semantic_instance_class_list, instance_id_count_list, matching, size_average):
+def loss_object_factory(loss_type, semantic_instance_class_list, instance_id_count_list, matching, size_average,
+                        matching_solver='scipy', matching_solver_threads=1):
 
     if loss_type == 'cross_entropy':
         loss_object = CrossEntropyComponentMatchingLoss(semantic_instance_class_list, instance_id_count_list, matching,
-                                                        size_average)
+                                                        size_average, matching_solver=matching_solver,
+                                                        matching_solver_threads=matching_solver_threads)
     elif loss_type == 'soft_iou':
-        loss_object = SoftIOUComponentMatchingLoss(semantic_instance_class_list, instance_id_count_list, matching, size_average)
+        loss_object = SoftIOUComponentMatchingLoss(semantic_instance_class_list, instance_id_count_list, matching, size_average,
+                                                   matching_solver=matching_solver,
+                                                   matching_solver_threads=matching_solver_threads)
     else:
         raise NotImplementedError
 
@@ -57,8 +64,10 @@ class ComponentMatchingLossBase(ComponentLossAbstractInterface):
     matching loss object out of it.
     """
     loss_type = None
+    nonmatching_needs_prediction_sums = None
 
-    def __init__(self, semantic_instance_labels=None, instance_id_labels=None, matching=True, size_average=True):
+    def __init__(self, semantic_instance_labels=None, instance_id_labels=None, matching=True, size_average=True,
+                 matching_solver='scipy', matching_solver_threads=1):
         if matching:
             assert semantic_instance_labels is not None and instance_id_labels is not None, ValueError(
                 'We need semantic and instance ids to perform matching')
@@ -67,6 +76,23 @@ class ComponentMatchingLossBase(ComponentLossAbstractInterface):
         self.instance_id_labels = instance_id_labels
         self.size_average = size_average
         self.only_present = True
+        self.matching_solver = matching_solver
+        self.solve_assignment = linear_assignment.get_matching_solver(matching_solver)
+        self.matching_solver_threads = matching_solver_threads
+        self.solver_pool = linear_assignment.get_solver_pool(matching_solver_threads)
+        self.semantic_instance_lookup_table = instance_utils.get_semantic_instance_lookup_table(
+            semantic_instance_labels, instance_id_labels) if semantic_instance_labels is not None else None
+        self.semantic_instance_lookup_table_tensors = {}  # copies of semantic_instance_lookup_table, by device
+        self.sem_cls_channel_blocks = cost_blocks.get_sem_cls_channel_blocks(semantic_instance_labels) \
+            if semantic_instance_labels is not None else None
+        self.sem_cls_block_sizes = (self.sem_cls_channel_blocks >= 0).sum(axis=1) \
+            if semantic_instance_labels is not None else None
+        self.channel_block_coordinates = cost_blocks.get_channel_block_coordinates(self.sem_cls_channel_blocks) \
+            if semantic_instance_labels is not None else None
+        # Instrumentation: assignment problems sent to the solver vs. skipped because the class was absent
+        self.n_solver_calls, self.n_solver_calls_avoided = 0, 0
+        self.count_solver_calls = True  # set to False to leave calls out of the counts (e.g. - extra evaluations)
+        self.n_bytes_to_host = 0  # size of the cost blocks copied to the host for the solver
         if self.loss_type is None:
             raise NotImplementedError('Loss type should be defined in subclass of {}'.format(__class__))
 
@@ -83,6 +109,13 @@ class ComponentMatchingLossBase(ComponentLossAbstractInterface):
     def component_loss(self, single_channel_prediction, binary_target):
         raise NotImplementedError
 
+    def component_cost_block(self, prediction_blocks, binary_target_blocks):
+        """
+        Batched component_loss: returns cost_block[..., pred, gt] = component_loss(prediction_blocks[..., pred, :],
+        binary_target_blocks[..., gt, :]) for ... x K x P inputs.
+        """
+        raise NotImplementedError
+
     def compute_matching_loss(self, predictions, sem_lbl, inst_lbl):
         pred_permutations, total_loss, loss_components = self.matching_loss(predictions, sem_lbl, inst_lbl)
         return pred_permutations, total_loss, loss_components
@@ -92,32 +125,44 @@ class ComponentMatchingLossBase(ComponentLossAbstractInterface):
         return ((sem_lbl == sem_val) * (inst_lbl == inst_val)).float()
 
     def compute_nonmatching_loss(self, predictions, sem_lbl, inst_lbl):
+        """
+        Loss without matching (channel c is compared to ground truth channel c).  Computed from per-channel pixel sums
+        gathered in one pass over the image, rather than one binary mask per channel.
+        total_loss: mean over channels of the component loss over the whole batch
+        loss_components: NxC; per-image component losses (0 for channels absent from the image)
+        """
         batch_sz, n_channels = predictions.size(0), predictions.size(1)
         pred_permutations = np.empty((batch_sz, n_channels), dtype=int)
         for i in range(batch_sz):
             pred_permutations[i, :] = range(n_channels)
 
-        losses = []
-        component_losses = []
-        n_channels = len(self.semantic_instance_labels)
-        for channel_idx in range(n_channels):
-            binary_target_single_instance_cls = self.get_binary_gt_for_channel(sem_lbl, inst_lbl, channel_idx).view(-1)
-            predictions_single_instance_cls = predictions[:, channel_idx, :, :].view(-1)
-            new_loss = self.component_loss(binary_target_single_instance_cls, predictions_single_instance_cls)
-            losses.append(new_loss)
-            if self.only_present and binary_target_single_instance_cls.sum() == 0:
-                component_losses.append(0)
-                continue
-            component_losses.append(new_loss)  # TODO(allie): Fix if we move away from batch size 1
-
-        losses = torch.cat([c[torch.np.newaxis, :] for c in losses], dim=0).float()
-        loss = sum(losses)
+        channel_lbl = cost_blocks.get_channel_labels(sem_lbl.data, inst_lbl.data, self.semantic_instance_labels,
+                                                     self.instance_id_labels,
+                                                     lookup_table=self.semantic_instance_lookup_table,
+                                                     lookup_table_tensors=self.semantic_instance_lookup_table_tensors)
+        own_channel_sums, gt_pixel_counts = xentropy.sum_predictions_by_gt_channel(predictions, channel_lbl,
+                                                                                   n_channels)
+        prediction_sums = cost_blocks.mask_padded_predictions(predictions, inst_lbl).contiguous().view(
+            batch_sz, n_channels, -1).sum(dim=2) if self.nonmatching_needs_prediction_sums else None
+        component_losses = self.component_losses_from_pixel_sums(own_channel_sums, gt_pixel_counts, prediction_sums)
+        if self.only_present:
+            component_losses = component_losses * (gt_pixel_counts > 0).type_as(component_losses.data)
+
+        losses = self.component_losses_from_pixel_sums(
+            own_channel_sums.sum(dim=0), gt_pixel_counts.sum(dim=0),
+            prediction_sums.sum(dim=0) if prediction_sums is not None else None).float()
         if self.size_average:
             normalizer = (inst_lbl >= 0).data.float().sum()
-            loss /= normalizer
             losses /= normalizer
 
-        return pred_permutations, iou.mean(losses), component_losses
+        return pred_permutations, losses.mean(), component_losses
+
+    def component_losses_from_pixel_sums(self, own_channel_sums, gt_pixel_counts, prediction_sums=None):
+        """
+        component_loss for every channel, from the sums computed by xentropy.sum_predictions_by_gt_channel (and the sum
+        of each prediction channel, if nonmatching_needs_prediction_sums).  Used by compute_nonmatching_loss.
+        """
+        raise NotImplementedError
 
     def loss_fcn(self, scores, sem_lbl, inst_lbl):
         predictions = self.transform_scores_to_predictions(scores)
@@ -133,22 +178,27 @@ class ComponentMatchingLossBase(ComponentLossAbstractInterface):
         Note: predictions should be 'preprocessed' -- take softmax / log as needed for whatever form
             single_class_component_loss_fcn expects.
         Note: returned loss components indexed by ground truth order
-        """
 
-        # Allocate memory
+        Builds the cost blocks of every (image, semantic class) in the batch at once, moves them to the host in one
+        copy, and solves all the assignment problems in one call.
+        """
         batch_sz, n_channels = predictions.size(0), predictions.size(1)
-        all_gt_indices = np.empty((batch_sz, n_channels), dtype=int)
-        all_pred_permutations = np.empty((batch_sz, n_channels), dtype=int)
-        all_costs = []  # dataset_utils.zeros_like(log_predictions, (n, c))
-
-        # Compute optimal match & costs for each image in the batch
-        for i in range(batch_sz):
-            gt_indices, pred_permutation, costs = \
-                self.compute_optimal_match_loss_single_img(predictions[i, ...], sem_lbl[i, ...], inst_lbl[i, ...])
-            all_gt_indices[i, ...] = gt_indices
-            all_pred_permutations[i, ...] = pred_permutation
-            all_costs.append(torch.cat(costs))
-        all_costs = torch.cat([c[torch.np.newaxis, :] for c in all_costs], dim=0).float()
+        assert len(self.semantic_instance_labels) == n_channels, \
+            'second dimension of predictions should be the number of channels.  It is {} instead.'.format(n_channels)
+        channel_lbl = cost_blocks.get_channel_labels(sem_lbl.data, inst_lbl.data, self.semantic_instance_labels,
+                                                     self.instance_id_labels,
+                                                     lookup_table=self.semantic_instance_lookup_table,
+                                                     lookup_table_tensors=self.semantic_instance_lookup_table_tensors)
+        present_blocks = cost_blocks.get_present_blocks(cost_blocks.get_present_channels(channel_lbl, n_channels),
+                                                        self.sem_cls_channel_blocks)
+        self.update_solver_call_counts(present_blocks)
+        all_cost_blocks = self.build_cost_blocks(predictions, sem_lbl, inst_lbl, channel_lbl=channel_lbl)
+        self.n_bytes_to_host += all_cost_blocks.numel() * all_cost_blocks.element_size()
+        pred_for_gt = linear_assignment.solve_cost_blocks(self.solve_assignment, all_cost_blocks.data.cpu().numpy(),
+                                                          self.sem_cls_block_sizes, present_blocks=present_blocks,
+                                                          pool=self.solver_pool)
+        all_pred_permutations, all_costs = self.gather_matched_costs(all_cost_blocks, pred_for_gt)
+        all_costs = all_costs.float()
         loss_train = all_costs.sum()
         if DEBUG_ASSERTS:
             if all_costs.size(1) != len(self.semantic_instance_labels):
@@ -157,6 +207,36 @@ class ComponentMatchingLossBase(ComponentLossAbstractInterface):
                 raise Exception
         return all_pred_permutations, loss_train, all_costs
 
+    def update_solver_call_counts(self, present_blocks):
+        if not self.count_solver_calls:
+            return
+        needs_solver = (self.sem_cls_block_sizes > 1)[np.newaxis, :]
+        self.n_solver_calls += int((present_blocks & needs_solver).sum())
+        self.n_solver_calls_avoided += int((~present_blocks & needs_solver).sum())
+
+    def reset_solver_call_counts(self):
+        self.n_solver_calls, self.n_solver_calls_avoided = 0, 0
+
+    def gather_matched_costs(self, all_cost_blocks, pred_for_gt):
+        """
+        all_cost_blocks: N x S x K x K (cost_blocks[n][sem_val][prediction][ground_truth])
+        pred_for_gt: N x S x K (from linear_assignment.solve_cost_blocks)
+        returns: pred_permutations (N x C numpy array of channel indices), costs (N x C, differentiable) -- both
+            indexed by ground truth channel.
+        """
+        batch_sz = all_cost_blocks.size(0)
+        n_blocks, block_size = self.sem_cls_channel_blocks.shape
+        sem_vals, gt_positions = self.channel_block_coordinates
+        pred_positions = pred_for_gt[:, sem_vals, gt_positions]  # N x C
+        pred_permutations = self.sem_cls_channel_blocks[sem_vals[np.newaxis, :], pred_positions]
+        flat_idxs = ((np.arange(batch_sz)[:, np.newaxis] * n_blocks + sem_vals[np.newaxis, :]) * block_size +
+                     pred_positions) * block_size + gt_positions[np.newaxis, :]
+        flat_idxs = torch.from_numpy(flat_idxs.reshape(-1)).long()
+        if all_cost_blocks.is_cuda:
+            flat_idxs = flat_idxs.cuda()
+        costs = all_cost_blocks.contiguous().view(-1).index_select(0, flat_idxs).view(batch_sz, -1)
+        return pred_permutations, costs
+
     def compute_optimal_match_loss_single_img(self, predictions, sem_lbl, inst_lbl):
         """
         Note: this function returns optimal match loss for a single image (not a batch)
@@ -168,33 +248,13 @@ class ComponentMatchingLossBase(ComponentLossAbstractInterface):
          matches.
         costs -- cost of each of the matches (also length C)
         """
-        semantic_instance_labels = self.semantic_instance_labels
-        assert len(semantic_instance_labels) == predictions.size(0), \
+        assert len(self.semantic_instance_labels) == predictions.size(0), \
             'first dimension of predictions should be the number of channels.  It is {} instead. ' \
             'Are you trying to pass an entire batch into the loss function?'.format(predictions.size(0))
-        gt_indices, pred_permutations, costs = [], [], []
-        num_inst_classes = len(semantic_instance_labels)
-        unique_semantic_values = range(max(semantic_instance_labels) + 1)
-        for sem_val in unique_semantic_values:
-            idxs = [i for i in range(num_inst_classes) if (semantic_instance_labels[i] == sem_val)]
-
-            assignment, cost_list_2d = self.compute_optimal_match_loss_for_one_sem_cls(predictions, sem_lbl,
-                                                                                       inst_lbl, sem_val)
-            gt_indices += idxs
-            pred_permutations += [idxs[assignment.RightMate(i)] for i in range(len(idxs))]
-            costs += [cost_list_2d[assignment.RightMate(i)][i] for i in range(len(idxs))]
-        sorted_indices = np.argsort(gt_indices)
-        gt_indices = np.array(gt_indices)[sorted_indices]
-        pred_permutations = np.array(pred_permutations)[sorted_indices]
-        costs = [costs[i] for i in sorted_indices]
-        return gt_indices, pred_permutations, costs
-
-    def compute_optimal_match_loss_for_one_sem_cls(self, predictions, sem_lbl, inst_lbl, sem_val):
-
-        cost_matrix, multiplier, cost_list_2d = self.build_cost_matrix_for_one_sem_cls(
-            predictions, sem_lbl, inst_lbl, sem_val)
-        assignment = match.solve_matching_problem(cost_matrix, multiplier)
-        return assignment, cost_list_2d
+        pred_permutations, _, costs = self.matching_loss(predictions.unsqueeze(0), sem_lbl.unsqueeze(0),
+                                                         inst_lbl.unsqueeze(0))
+        gt_indices = np.arange(len(self.semantic_instance_labels))
+        return gt_indices, pred_permutations[0, :], costs[0, :]
 
     def build_all_sem_cls_cost_matrices_as_tensor_data(self, predictions, sem_lbl, inst_lbl, cost_list_only=True):
         if len(predictions.size()) == 4:
@@ -203,32 +263,42 @@ class ComponentMatchingLossBase(ComponentLossAbstractInterface):
                                 'Yours is formatted as a minibatch, with size {}'.format(predictions.size()))
             else:
                 raise Exception('predictions, sem_lbl, and inst_lbl should be a 3-D tensor (not 4-D)')
+        all_cost_blocks = self.build_cost_blocks(predictions, sem_lbl, inst_lbl)
         unique_semantic_values = range(max(self.semantic_instance_labels) + 1)
-        cost_matrix_tuples = [self.build_cost_matrix_for_one_sem_cls(predictions, sem_lbl, inst_lbl, sem_val=sem_val)
+        cost_matrix_tuples = [self.build_cost_matrix_for_one_sem_cls(all_cost_blocks, sem_val=sem_val)
                               for sem_val in unique_semantic_values]
         if not cost_list_only:
             return cost_matrix_tuples
         else:
-            cost_matrices_as_lists_of_variables = [c[2] for c in cost_matrix_tuples]
-            cost_matrices_as_tensors = [torch.stack([torch.stack([cij.data for cij in ci])
-                                                     for ci in c]) for c in cost_matrices_as_lists_of_variables
-                                        ]
+            cost_matrices_as_tensors = [c[2].data for c in cost_matrix_tuples]
             return cost_matrices_as_tensors
 
-    def build_cost_matrix_for_one_sem_cls(self, predictions, sem_lbl, inst_lbl, sem_val):
-        cost_list_2d = match.create_pytorch_cost_matrix(self.component_loss, predictions,
-                                                        sem_lbl, inst_lbl, self.semantic_instance_labels,
-                                                        self.instance_id_labels, sem_val,
-                                                        size_average=self.size_average)
-        cost_matrix, multiplier = match.convert_pytorch_costs_to_ints(cost_list_2d)
-        return cost_matrix, multiplier, cost_list_2d
+    def build_cost_blocks(self, predictions, sem_lbl, inst_lbl, channel_lbl=None):
+        """
+        Cost matrices for every semantic class, as one S x K x K tensor (N x S x K x K for a batch) (see
+        cost_blocks.create_pytorch_cost_blocks).
+        """
+        return cost_blocks.create_pytorch_cost_blocks(self.component_cost_block, predictions, sem_lbl, inst_lbl,
+                                                      self.semantic_instance_labels, self.instance_id_labels,
+                                                      size_average=self.size_average,
+                                                      channel_blocks=self.sem_cls_channel_blocks,
+                                                      channel_lbl=channel_lbl)
+
+    def build_cost_matrix_for_one_sem_cls(self, all_cost_blocks, sem_val):
+        n_channels_for_this_class = self.sem_cls_block_sizes[sem_val]
+        cost_block = all_cost_blocks[sem_val, :n_channels_for_this_class, :n_channels_for_this_class]
+        cost_matrix, multiplier = match.convert_pytorch_costs_to_ints(cost_block)
+        return cost_matrix, multiplier, cost_block
 
 
 class CrossEntropyComponentMatchingLoss(ComponentMatchingLossBase):
     loss_type = 'cross_entropy'
+    nonmatching_needs_prediction_sums = False
 
-    def __init__(self, semantic_instance_labels=None, instance_id_labels=None, matching=True, size_average=True):
-        super().__init__(semantic_instance_labels, instance_id_labels, matching, size_average)
+    def __init__(self, semantic_instance_labels=None, instance_id_labels=None, matching=True, size_average=True,
+                 matching_solver='scipy', matching_solver_threads=1):
+        super().__init__(semantic_instance_labels, instance_id_labels, matching, size_average, matching_solver,
+                         matching_solver_threads)
 
     def transform_scores_to_predictions(self, scores):
         assert len(scores.size()) == 4
@@ -237,14 +307,23 @@ class CrossEntropyComponentMatchingLoss(ComponentMatchingLossBase):
     def component_loss(self, single_channel_prediction, binary_target):
         return xentropy.nll2d_single_class_term(single_channel_prediction, binary_target)
 
+    def component_cost_block(self, prediction_blocks, binary_target_blocks):
+        return xentropy.nll2d_cost_block(prediction_blocks, binary_target_blocks)
+
+    def component_losses_from_pixel_sums(self, own_channel_sums, gt_pixel_counts, prediction_sums=None):
+        return -own_channel_sums
+
 
 class SoftIOUComponentMatchingLoss(ComponentMatchingLossBase):
     loss_type = 'soft_iou'
+    nonmatching_needs_prediction_sums = True
 
-    def __init__(self, semantic_instance_labels=None, instance_id_labels=None, matching=True, size_average=False):
+    def __init__(self, semantic_instance_labels=None, instance_id_labels=None, matching=True, size_average=False,
+                 matching_solver='scipy', matching_solver_threads=1):
         if size_average:
             raise Exception('Pretty sure you didn\'t want size_average to be True since it\'s already embedded in iou.')
-        super().__init__(semantic_instance_labels, instance_id_labels, matching, size_average)
+        super().__init__(semantic_instance_labels, instance_id_labels, matching, size_average, matching_solver,
+                         matching_solver_threads)
 
     def transform_scores_to_predictions(self, scores):
         assert len(scores.size()) == 4
@@ -252,3 +331,14 @@ class SoftIOUComponentMatchingLoss(ComponentMatchingLossBase):
 
     def component_loss(self, single_channel_prediction, binary_target):
         return iou.my_soft_iou_loss(single_channel_prediction, binary_target)
+
+    def component_cost_block(self, prediction_blocks, binary_target_blocks):
+        return iou.my_soft_iou_loss_cost_block(prediction_blocks, binary_target_blocks)
+
+    def component_losses_from_pixel_sums(self, own_channel_sums, gt_pixel_counts, prediction_sums=None):
+        # Same as the per-channel component_loss(binary_target, prediction) call this replaces: the loss is 0 only when
+        # the prediction is empty.
+        union = prediction_sums + gt_pixel_counts - own_channel_sums
+        is_nonzero = (prediction_sums.data != 0).type_as(union.data)
+        union = union + (union.data == 0).type_as(union.data)
+        return (1.0 - own_channel_sums / union) * is_nonzero
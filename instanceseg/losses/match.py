@@ -1,5 +1,10 @@
 import numpy as np
-from ortools.graph import pywrapgraph
+import torch
+
+try:
+    from ortools.graph import pywrapgraph
+except ImportError:  # only needed for the 'ortools' matching solver (see linear_assignment.py)
+    pywrapgraph = None
 
 from instanceseg.losses.xentropy import DEBUG_ASSERTS
 from instanceseg.models.model_utils import any_nan, is_nan
@@ -80,25 +85,34 @@ def create_pytorch_cost_matrix(single_class_component_loss_fcn, predictions, sem
 
 
 def convert_pytorch_costs_to_ints(cost_list_2d_variables, multiplier=None):
+    """
+    cost_list_2d_variables: K x K tensor/Variable (e.g. - one block of cost_blocks.create_pytorch_cost_blocks), or the
+    older list of lists of 1-element Variables from create_pytorch_cost_matrix.
+    """
+    if torch.is_tensor(cost_list_2d_variables) or hasattr(cost_list_2d_variables, 'data'):
+        costs = cost_list_2d_variables.data.cpu().numpy().astype(np.float64)
+    else:
+        costs = np.array([[float(c) for c in cl] for cl in cost_list_2d_variables], dtype=np.float64)
+    return convert_float_costs_to_ints(costs, multiplier)
+
+
+def convert_float_costs_to_ints(costs, multiplier=None):
+    """
+    costs: K x K float numpy array (cost[prediction][ground_truth])
+    """
     infinity_cap = 1e15
     log_infinity_cap = np.log10(infinity_cap)
     if multiplier is None:
         # Choose multiplier that keeps as many digits of precision as possible without creating
         # overflow errors
-        absolute_max = float(0.0)
-        for cl in cost_list_2d_variables:
-            for c in cl:
-                absolute_max = max(absolute_max, abs(c.data[0]))
+        absolute_max = float(np.abs(costs).max()) if costs.size > 0 else 0.0
         if absolute_max == 0:
             multiplier = 1
             # multiplier = 10 ** 10
         else:
             multiplier = 10 ** (log_infinity_cap - int(np.log10(absolute_max)))
 
-    num_classes = len(cost_list_2d_variables)
-    cost_matrix_int = [[int(multiplier * cost_list_2d_variables[r_pred][c_gt].data[0])
-                        for c_gt in range(num_classes)]
-                       for r_pred in range(num_classes)]
+    cost_matrix_int = (multiplier * costs).astype(np.int64).tolist()
     if DEBUG_ASSERTS:
         try:
             assert all([not is_nan(cost_list_1d[j])
@@ -1,5 +1,7 @@
 import torch
 
+from instanceseg.utils import instance_utils
+
 # TODO(allie): Enable exporting of cost matrices through tensorboard as images
 # TODO(allie): Compute other losses ('mixing', 'wrong identity', 'poor shape') along with some
 # image stats like between-instance distance
@@ -43,14 +45,12 @@ def cross_entropy2d_without_matching(log_predictions, sem_lbl, inst_lbl, semanti
     assert sem_lbl.size() == inst_lbl.size()
     assert (log_predictions.size(0), log_predictions.size(2), log_predictions.size(3)) == sem_lbl.size()
     assert weight is None, NotImplementedError
-    losses = []
-    for sem_inst_idx, (sem_val, inst_val) in enumerate(zip(semantic_instance_labels, instance_id_labels)):
-        binary_target_single_instance_cls = ((sem_lbl == sem_val) * (inst_lbl == inst_val)).float()
-        log_predictions_single_instance_cls = log_predictions[:, sem_inst_idx, :, :]
-        losses.append(nll2d_single_class_term(log_predictions_single_instance_cls,
-                                              binary_target_single_instance_cls))
-    losses = torch.cat([c[torch.np.newaxis, :] for c in losses], dim=0).float()
-    loss = sum(losses)
+    channel_lbl = instance_utils.combine_semantic_and_instance_labels(sem_lbl.data, inst_lbl.data,
+                                                                      semantic_instance_labels, instance_id_labels,
+                                                                      void_value=-1)
+    own_channel_sums, _ = sum_predictions_by_gt_channel(log_predictions, channel_lbl, len(semantic_instance_labels))
+    losses = -own_channel_sums.sum(dim=0).float()
+    loss = losses.sum()
     if size_average:
         normalizer = (inst_lbl >= 0).data.float().sum()
         loss /= normalizer
@@ -67,3 +67,33 @@ def nll2d_single_class_term(log_predictions_single_instance_cls, binary_target_s
     bt = binary_target_single_instance_cls
     res = -torch.sum(lp.view(-1, ) * bt.view(-1, ))
     return res
+
+
+def nll2d_cost_block(log_predictions_blocks, binary_target_blocks):
+    """
+    Batched equivalent of nll2d_single_class_term for every (prediction, ground truth) pair in a block.
+    log_predictions_blocks: ... x K x P (K prediction channels, P pixels)
+    binary_target_blocks: ... x K x P (K ground truth instances, P pixels)
+    returns: ... x K x K, where cost_block[..., pred, gt] = nll2d_single_class_term(lp[..., pred, :], bt[..., gt, :])
+    """
+    return -torch.matmul(log_predictions_blocks, binary_target_blocks.transpose(-1, -2))
+
+
+def sum_predictions_by_gt_channel(predictions, channel_lbl, n_channels):
+    """
+    For every ground truth channel c, sums predictions[:, c] over the pixels labeled c, with one gather and one
+    scatter_add (O(HW), independent of the number of channels).
+    predictions: N x C x H x W
+    channel_lbl: N x H x W (channel index of each pixel's ground truth; -1 for void)
+    returns: own_channel_sums (N x C), gt_pixel_counts (N x C)
+    """
+    n_images = predictions.size(0)
+    channel_lbl = channel_lbl.contiguous().view(n_images, -1)
+    gathered = predictions.contiguous().view(n_images, n_channels, -1).gather(
+        1, channel_lbl.clamp(min=0).unsqueeze(1)).squeeze(1)  # N x HW: prediction for each pixel's own channel
+    gathered = gathered * (channel_lbl >= 0).type_as(gathered.data)
+    scatter_idxs = channel_lbl + 1  # void -> 0, which we drop
+    own_channel_sums = gathered.new_zeros((n_images, n_channels + 1)).scatter_add(1, scatter_idxs, gathered)
+    gt_pixel_counts = gathered.data.new_zeros((n_images, n_channels + 1)).scatter_add_(
+        1, scatter_idxs, gathered.data.new_ones(gathered.size()))
+    return own_channel_sums[:, 1:], gt_pixel_counts[:, 1:]
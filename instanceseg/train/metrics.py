@@ -1,19 +1,85 @@
+import numpy as np
 import torch
 import tqdm
 
 from torch.autograd import Variable
 from torch.utils.data import sampler
 
-from instanceseg.utils.tensors import softmax_scores, argmax_scores, center_crop_to_reduced_size
+from instanceseg.datasets.collate import LBL_PAD_VALUE
+from instanceseg.datasets.sampler import get_loader_sampler, is_sequential
+from instanceseg.utils import instance_utils
+from instanceseg.utils.misc import _fast_hist, label_accuracy_score_from_hist
+from instanceseg.utils.tensors import softmax_scores, argmax_scores
 
 
-def is_sequential(my_sampler):
-    return isinstance(my_sampler, sampler.SequentialSampler) or my_sampler.sequential
+class ConfusionAccumulator(object):
+    """
+    Streaming version of misc.label_accuracy_score: each batch is folded into an n_class x n_class histogram as soon as
+    it's evaluated, so the label maps can be discarded and memory doesn't grow with the size of the dataset.
+    Label maps given as tensors are histogrammed where they live (e.g. - on the GPU); only the histogram is copied to
+    the host, once, in get_scores.
+    """
+    def __init__(self, n_class):
+        self.n_class = n_class
+        self.hist = np.zeros((n_class, n_class))
+        self.device_hist = None
+        self.n_bytes_to_host = 0  # size of the device histograms copied to the host
+
+    def reset(self):
+        self.hist[...] = 0
+        self.device_hist = None
+        self.n_bytes_to_host = 0
+
+    def update(self, label_trues, label_preds, permutations=None):
+        """
+        label_trues, label_preds: lists (or N x H x W arrays) of label maps, or N x H x W LongTensors
+        permutations: N x C; if given, label_preds[i] is permuted by permutations[i, :] (see
+            instance_utils.permute_labels) before it's compared to label_trues[i]
+        """
+        if torch.is_tensor(label_trues):
+            self.update_with_tensors(label_trues, label_preds, permutations)
+            return
+        for idx, (lt, lp) in enumerate(zip(label_trues, label_preds)):
+            if permutations is not None:
+                lp = instance_utils.permute_labels(lp, permutations[idx:(idx + 1), :])
+            self.hist += _fast_hist(lt.flatten(), lp.flatten(), self.n_class)
+
+    def update_with_tensors(self, label_trues, label_preds, permutations=None):
+        if permutations is not None:
+            label_preds = instance_utils.permute_labels(label_preds, permutations)
+        hist = fast_hist_torch(label_trues.view(-1), label_preds.view(-1), self.n_class)
+        self.device_hist = hist if self.device_hist is None else self.device_hist + hist
+
+    def get_scores(self):
+        """
+        returns acc, acc_cls, mean_iu, fwavacc
+        """
+        if self.device_hist is not None:
+            self.n_bytes_to_host += self.device_hist.numel() * self.device_hist.element_size()
+            self.hist += self.device_hist.cpu().numpy()
+            self.device_hist = None
+        return label_accuracy_score_from_hist(self.hist)
+
+
+def fast_hist_torch(label_true, label_pred, n_class):
+    """
+    misc._fast_hist for (flattened) LongTensors; stays on label_true's device.
+    """
+    mask = (label_true >= 0) * (label_true < n_class)
+    hist = torch.bincount(n_class * label_true[mask] + label_pred[mask], minlength=n_class ** 2)
+    return hist[:(n_class ** 2)].view(n_class, n_class)
 
 
 # Disabling this inspection because IntTensor(R, C) gives a warning all over the place.
 # noinspection PyArgumentList
 class InstanceMetrics(object):
+    """
+    Instance metrics computed from a stream of (score, sem_lbl, inst_lbl, pred_permutations) batches -- e.g. - the
+    ones Trainer.validate_split produces anyway (see update), so computing them costs no extra forward passes or image
+    loads.  compute_metrics(model) produces the stream itself with one pass over data_loader.
+    Each batch is reduced to running per-channel sums and a few counts per image as it arrives, so the scores are never
+    kept around: memory doesn't depend on the image size and only grows by O(C) per image.
+    """
     def __init__(self, data_loader, problem_config, component_loss_function=None,
                  augment_function_img_sem=None, flag_write_channel_utilization=True,
                  flag_write_loss_distributions=True):
@@ -24,23 +90,26 @@ class InstanceMetrics(object):
         self.component_loss_function = component_loss_function
         self.variables_to_preserve = ('problem_config', 'data_loader', 'component_loss_function',
                                       'variables_to_preserve', 'augment_function_img_sem',
-                                      'flag_write_channel_utilization')
+                                      'flag_write_channel_utilization', 'flag_write_loss_distributions')
         self.flag_write_channel_utilization = flag_write_channel_utilization
         self.flag_write_loss_distributions = flag_write_loss_distributions
 
-        assert not isinstance(self.data_loader.sampler, sampler.RandomSampler), \
+        loader_sampler = get_loader_sampler(self.data_loader)
+        assert not isinstance(loader_sampler, sampler.RandomSampler), \
             'Sampler is instance of RandomSampler. Please set shuffle to False on data_loader'
-        assert is_sequential(self.data_loader.sampler), NotImplementedError
-        self.scores = None
+        assert is_sequential(loader_sampler), NotImplementedError
         self.losses = None
         self.loss_components = None
-        self.assignments = None
-        self.softmaxed_scores = None
+        self.pred_permutations = None
+        self.mean_softmax_for_assigned_pixels = None
+        self.mean_fraction_of_sem_cls_for_assigned_pixels = None
+        self.mean_score_for_assigned_pixels = None
         self.n_pixels_assigned_per_channel = None
         self.n_instances_assigned_per_sem_cls = None
         self.n_found_per_sem_cls, self.n_missed_per_sem_cls, self.channels_of_majority_assignments = None, None, None
         self.metrics_computed = False
         self.augment_function_img_sem = augment_function_img_sem
+        self.stream = None
 
     def clear(self, variables_to_preserve=None):
         """
@@ -52,83 +121,165 @@ class InstanceMetrics(object):
             if attr_name in variables_to_preserve:
                 continue
             setattr(self, attr_name, None)
+        self.metrics_computed = False
+
+    def reset_stream(self):
+        self.clear()
+        self.n_bytes_to_host = 0  # size of the per-batch reductions update copied to the host
+        n_channels = len(self.problem_config.semantic_instance_class_list)
+        self.stream = {
+            # Per image
+            'n_pixels_assigned_per_channel': [], 'n_found_per_sem_cls': [], 'n_missed_per_sem_cls': [],
+            'channels_of_majority_assignments': [], 'pred_permutations': [], 'losses': [], 'loss_components': [],
+            # Running sums over assigned pixels, per channel
+            'softmax_sum_for_assigned_pixels': torch.zeros(n_channels).double(),
+            'fraction_of_sem_cls_sum_for_assigned_pixels': torch.zeros(n_channels).double(),
+            'score_sum_for_assigned_pixels': torch.zeros(n_channels).double(),
+        }
+
+    def update(self, scores, sem_lbl, inst_lbl, pred_permutations=None, total_loss=None, loss_components=None):
+        """
+        Folds a batch into the stream's running sums.
+        scores: N x C x H x W; sem_lbl, inst_lbl: N x H x W
+        Pixels padded by collate.pad_collate (LBL_PAD_VALUE) aren't counted, so an image's metrics don't depend on its batch.
+        pred_permutations: N x C
+        total_loss: the batch's total_loss from component_loss_function (recorded for every image in the batch)
+        loss_components: N x C
+        """
+        if self.stream is None:
+            self.reset_stream()
+        n_images, n_channels = scores.size(0), scores.size(1)
+        sem_cls_of_channel = torch.LongTensor(self.problem_config.semantic_instance_class_list)
+        if scores.is_cuda:
+            sem_cls_of_channel = sem_cls_of_channel.cuda()
+        assignments = argmax_scores(scores).view(n_images, 1, -1)
+        softmaxed_scores = softmax_scores(scores).view(n_images, n_channels, -1)
+        softmax_per_sem_cls = softmaxed_scores.new_zeros((n_images, self.problem_config.n_semantic_classes,
+                                                          softmaxed_scores.size(2)))
+        softmax_per_sem_cls.index_add_(1, sem_cls_of_channel, softmaxed_scores)
+
+        # Each pixel's value in the channel it's assigned to
+        assigned_channels = assignments.view(-1)
+        assigned_softmax = softmaxed_scores.gather(1, assignments).view(-1)
+        assigned_sem_cls_softmax = softmax_per_sem_cls.gather(
+            1, sem_cls_of_channel.index_select(0, assigned_channels).view(n_images, 1, -1)).view(-1)
+        assigned_score = scores.contiguous().view(n_images, n_channels, -1).gather(1, assignments).view(-1)
+        is_unpadded = sem_lbl.contiguous().view(-1) != LBL_PAD_VALUE
+        for name, values in [('softmax_sum_for_assigned_pixels', assigned_softmax),
+                             ('fraction_of_sem_cls_sum_for_assigned_pixels', assigned_softmax / assigned_sem_cls_softmax),
+                             ('score_sum_for_assigned_pixels', assigned_score)]:
+            self.stream[name] += self.copy_to_host(torch.bincount(
+                assigned_channels[is_unpadded], weights=values[is_unpadded].double(),
+                minlength=n_channels))[:n_channels]
+
+        image_offsets = (torch.arange(0, n_images) * n_channels).type_as(assignments).view(-1, 1, 1)
+        self.stream['n_pixels_assigned_per_channel'].append(self.copy_to_host(
+            torch.bincount((assignments + image_offsets).view(-1)[is_unpadded],
+                           minlength=n_images * n_channels).view(n_images, n_channels).int()))
+        if self.flag_write_channel_utilization:
+            n_found_per_sem_cls, n_missed_per_sem_cls, channels_of_majority_assignments = \
+                self._compute_majority_assignment_stats(assignments.view(sem_lbl.size()), sem_lbl, inst_lbl)
+            self.stream['n_found_per_sem_cls'].append(n_found_per_sem_cls)
+            self.stream['n_missed_per_sem_cls'].append(n_missed_per_sem_cls)
+            self.stream['channels_of_majority_assignments'].append(channels_of_majority_assignments)
+        if pred_permutations is not None:
+            self.stream['pred_permutations'].append(pred_permutations)
+        if total_loss is not None:
+            self.stream['losses'].append(torch.ones(n_images) * float(total_loss))
+        if loss_components is not None:
+            self.stream['loss_components'].append(self.copy_to_host(loss_components))
+
+    def copy_to_host(self, tensor):
+        """
+        tensor.cpu(), counted in self.n_bytes_to_host (see TrainerExporter.copy_to_host)
+        """
+        self.n_bytes_to_host += tensor.numel() * tensor.element_size()
+        return tensor.cpu()
 
     def compute_metrics(self, model):
-        compiled_scores, compiled_losses, compiled_loss_components = self._compile_scores_and_losses(model)
-        self.assignments = argmax_scores(compiled_scores)
-        self.softmaxed_scores = softmax_scores(compiled_scores)
+        self.stream_model(model)
+        self.compute_metrics_from_stream()
+
+    def stream_model(self, model):
+        """
+        Streams the model's scores and losses on data_loader (one pass).
+        """
+        self.reset_stream()
+        for scores, sem_lbl, inst_lbl, pred_permutations, total_loss, loss_components in iterate_scores_and_losses(
+                model, self.data_loader, self.component_loss_function, self.augment_function_img_sem):
+            self.update(scores, sem_lbl, inst_lbl, pred_permutations, total_loss, loss_components)
+
+    def compute_metrics_from_stream(self):
+        """
+        Computes the metrics from every batch given to update since reset_stream.
+        """
+        assert self.stream is not None and len(self.stream['n_pixels_assigned_per_channel']) > 0, \
+            'Nothing was streamed to update'
+        stream, self.stream = self.stream, None
+
+        def cat_if_any(tensors):
+            return torch.cat(tensors, dim=0) if len(tensors) > 0 else None
+
+        self.n_pixels_assigned_per_channel = cat_if_any(stream['n_pixels_assigned_per_channel'])
+        n_assigned_pixels = self.n_pixels_assigned_per_channel.sum(dim=0).double().clamp(min=1)  # sums are 0 if 0
+        self.mean_softmax_for_assigned_pixels = stream['softmax_sum_for_assigned_pixels'] / n_assigned_pixels
+        self.mean_fraction_of_sem_cls_for_assigned_pixels = \
+            stream['fraction_of_sem_cls_sum_for_assigned_pixels'] / n_assigned_pixels
+        self.mean_score_for_assigned_pixels = stream['score_sum_for_assigned_pixels'] / n_assigned_pixels
         if self.flag_write_channel_utilization:
-            self.n_pixels_assigned_per_channel = self._compute_pixels_assigned_per_channel(self.assignments)
             self.n_instances_assigned_per_sem_cls = \
                 self._compute_instances_assigned_per_sem_cls(self.n_pixels_assigned_per_channel)
-            self.n_found_per_sem_cls, self.n_missed_per_sem_cls, self.channels_of_majority_assignments = \
-                self._compute_majority_assignment_stats(self.assignments)
+            self.n_found_per_sem_cls = cat_if_any(stream['n_found_per_sem_cls'])
+            self.n_missed_per_sem_cls = cat_if_any(stream['n_missed_per_sem_cls'])
+            self.channels_of_majority_assignments = cat_if_any(stream['channels_of_majority_assignments'])
+        self.pred_permutations = np.concatenate(stream['pred_permutations'], axis=0) \
+            if len(stream['pred_permutations']) > 0 else None
+        self.losses = cat_if_any(stream['losses'])
+        self.loss_components = cat_if_any(stream['loss_components'])
         self.metrics_computed = True
-        self.scores = compiled_scores
-        self.losses = compiled_losses
-        self.loss_components = compiled_loss_components
-
-    def _compile_scores_and_losses(self, model):
-        compiled_scores, compiled_losses, compiled_loss_components = compile_scores_and_losses(
-            model, self.data_loader, self.component_loss_function, self.augment_function_img_sem)
-        return compiled_scores, compiled_losses, compiled_loss_components
-
-    def _compute_pixels_assigned_per_channel(self, assignments):
-        n_images = len(self.data_loader)
-        n_inst_classes = len(self.problem_config.semantic_instance_class_list)
-        n_pixels_assigned_per_channel = torch.IntTensor(n_images, n_inst_classes).zero_()
-        for channel_idx, (sem_cls, inst_id) in enumerate(zip(self.problem_config.semantic_instance_class_list,
-                                                             self.problem_config.instance_count_id_list)):
-            n_pixels_assigned_per_channel[:, channel_idx] = \
-                (assignments[:, :, :] == channel_idx).int().sum(dim=2).sum(dim=1)
-        return n_pixels_assigned_per_channel
 
     def _compute_instances_assigned_per_sem_cls(self, pixels_assigned_per_channel):
-        n_images = len(self.data_loader)
+        n_images = pixels_assigned_per_channel.size(0)
         instances_found_per_channel = torch.IntTensor(n_images, self.problem_config.n_semantic_classes).zero_()
         for channel_idx, (sem_cls, inst_id) in enumerate(zip(self.problem_config.semantic_instance_class_list,
                                                              self.problem_config.instance_count_id_list)):
             instances_found_per_channel[:, sem_cls] += (pixels_assigned_per_channel[:, channel_idx] > 0).int()
         return instances_found_per_channel
 
-    def _compute_majority_assignment_stats(self, assignments, majority_fraction=0.5):
-        n_images = len(self.data_loader)
+    def _compute_majority_assignment_stats(self, assignments, sem_lbls, inst_lbls, majority_fraction=0.5):
+        """
+        assignments, sem_lbls, inst_lbls: N x H x W
+        Everything is read off each image's (ground truth channel, assigned channel) pixel co-occurrence table, built
+        with one bincount over the batch: the majority assignment of a ground truth instance is the argmax of its row.
+        """
+        n_images = assignments.size(0)
+        n_channels = len(self.problem_config.semantic_instance_class_list)
         n_found_per_sem_cls = torch.IntTensor(n_images, self.problem_config.n_semantic_classes).zero_()
         n_missed_per_sem_cls = torch.IntTensor(n_images, self.problem_config.n_semantic_classes).zero_()
-        channels_of_majority_assignments = \
-            torch.IntTensor(n_images, len(self.problem_config.semantic_instance_class_list)).zero_()
-
-        already_matched_pred_channels = torch.ByteTensor(len(self.problem_config.semantic_instance_class_list))
-        assumed_image_size = (assignments.size(1), assignments.size(2))
-        for data_idx, (_, (sem_lbl, inst_lbl)) in enumerate(self.data_loader):
-            already_matched_pred_channels.zero_()
-            for gt_channel_idx, (sem_cls, inst_id) in enumerate(zip(self.problem_config.semantic_instance_class_list,
-                                                                    self.problem_config.instance_count_id_list)):
-                instance_mask = (sem_lbl == sem_cls) * (inst_lbl == inst_id)
-                if (instance_mask.size(1), instance_mask.size(2)) != assumed_image_size:
-                    instance_mask = center_crop_to_reduced_size(instance_mask, assumed_image_size, rc_axes=(1, 2))
-
-                # Find majority assignment for this gt instance
-                if instance_mask.sum() == 0:
+        channels_of_majority_assignments = torch.IntTensor(n_images, n_channels).zero_()
+
+        contingency_tables = self.copy_to_host(get_contingency_tables(
+            self.problem_config.combine_semantic_and_instance_labels(sem_lbls, inst_lbls), assignments,
+            n_channels)).numpy()
+        already_matched_pred_channels = np.zeros(n_channels, dtype=bool)
+        for data_idx, contingency_table in enumerate(contingency_tables):
+            already_matched_pred_channels[:] = False
+            n_instance_pixels_per_gt_channel = contingency_table.sum(axis=1)
+            majority_pred_channels = contingency_table.argmax(axis=1)  # ties go to the lowest channel, like torch.mode
+            for gt_channel_idx, sem_cls in enumerate(self.problem_config.semantic_instance_class_list):
+                n_instance_pixels = n_instance_pixels_per_gt_channel[gt_channel_idx]
+                if n_instance_pixels == 0:
                     continue
-                instance_assignments = assignments[data_idx, :, :][instance_mask]
-                try:
-                    mode_as_torch_tensor = torch.mode(instance_assignments)[0]
-                except:
-                    import ipdb;
-                    ipdb.set_trace()
-                    raise Exception
-                pred_channel_idx = mode_as_torch_tensor.numpy().item()  # mode returns (val, idx)
+                pred_channel_idx = majority_pred_channels[gt_channel_idx]
                 if already_matched_pred_channels[pred_channel_idx]:
                     # We've already assigned this channel to an instance; can't double-count.
                     n_missed_per_sem_cls[data_idx, sem_cls] += 1
                 else:
                     # Check whether the majority assignment comprises over half of the pixels
-                    n_instance_pixels = instance_mask.float().sum()
-                    n_pixels_assigned = (instance_assignments == pred_channel_idx).float().sum()
+                    n_pixels_assigned = contingency_table[gt_channel_idx, pred_channel_idx]
                     if n_pixels_assigned >= n_instance_pixels * majority_fraction:  # is_majority
                         n_found_per_sem_cls[data_idx, sem_cls] += 1
-                        channels_of_majority_assignments[data_idx, pred_channel_idx] += 1
+                        channels_of_majority_assignments[data_idx, int(pred_channel_idx)] += 1
                         already_matched_pred_channels[pred_channel_idx] = True
                     else:
                         n_missed_per_sem_cls[data_idx, sem_cls] += 1
@@ -142,13 +293,6 @@ class InstanceMetrics(object):
         assert self.metrics_computed, 'Run compute_metrics first'
         channel_labels = self.problem_config.get_channel_labels('{}_{}')
         sem_labels = self.problem_config.semantic_class_names
-        sz_score_by_sem = list(self.softmaxed_scores.size())
-        sz_score_by_sem[1] = self.problem_config.n_semantic_classes
-        softmax_scores_per_sem_cls = torch.zeros(tuple(sz_score_by_sem))
-        for sem_cls in range(self.problem_config.n_semantic_classes):
-            chs = [ci for ci, sc in
-                   enumerate(self.problem_config.semantic_instance_class_list) if sc == sem_cls]
-            softmax_scores_per_sem_cls[:, sem_cls, ...] = self.softmaxed_scores[:, chs, ...].sum(dim=1)
         metrics_dict = {
             'n_instances_assigned_per_sem_cls':
                 {
@@ -180,25 +324,19 @@ class InstanceMetrics(object):
                     },
                     'softmax_score': {
                         'value_for_assigned_pixels': {
-                            channel_labels[channel_idx] + '_mean':
-                                0 if (self.assignments == channel_idx).sum() == 0
-                                else (self.softmaxed_scores[:, channel_idx, :, :][self.assignments ==
-                                                                                  channel_idx]).mean()
-                            for channel_idx in range(self.softmaxed_scores.size(1))
+                            channel_labels[channel_idx] + '_mean': self.mean_softmax_for_assigned_pixels[channel_idx]
+                            for channel_idx in range(self.mean_softmax_for_assigned_pixels.size(0))
                         },
                         'fraction_of_sem_cls_for_assigned_pixels': {
-                            channel_labels[channel_idx] + '_mean': 0 if (self.assignments == channel_idx).sum() == 0
-                            else ((self.softmaxed_scores[:, channel_idx, :, :][self.assignments == channel_idx]) /
-                                  softmax_scores_per_sem_cls[:, sem_cls, :, :][self.assignments == channel_idx]).mean()
-                            for channel_idx, sem_cls in enumerate(self.problem_config.semantic_instance_class_list)
+                            channel_labels[channel_idx] + '_mean':
+                                self.mean_fraction_of_sem_cls_for_assigned_pixels[channel_idx]
+                            for channel_idx in range(self.mean_fraction_of_sem_cls_for_assigned_pixels.size(0))
                         },
                     },
                     'score': {
                         'value_for_assigned_pixels': {
-                            channel_labels[channel_idx] + '_max':
-                                0 if (self.assignments == channel_idx).sum() == 0
-                                else (self.scores[:, channel_idx, :, :][self.assignments == channel_idx]).mean()
-                            for channel_idx in range(self.softmaxed_scores.size(1))
+                            channel_labels[channel_idx] + '_max': self.mean_score_for_assigned_pixels[channel_idx]
+                            for channel_idx in range(self.mean_score_for_assigned_pixels.size(0))
                         },
                     },
                 },
@@ -225,14 +363,6 @@ class InstanceMetrics(object):
 
         assert self.metrics_computed, 'Run compute_metrics first'
         channel_labels = self.problem_config.get_channel_labels('{}_{}')
-        sem_labels = self.problem_config.semantic_class_names
-        sz_score_by_sem = list(self.softmaxed_scores.size())
-        sz_score_by_sem[1] = self.problem_config.n_semantic_classes
-        softmax_scores_per_sem_cls = torch.zeros(tuple(sz_score_by_sem))
-        for sem_cls in range(self.problem_config.n_semantic_classes):
-            chs = [ci for ci, sc in
-                   enumerate(self.problem_config.semantic_instance_class_list) if sc == sem_cls]
-            softmax_scores_per_sem_cls[:, sem_cls, ...] = self.softmaxed_scores[:, chs, ...].sum(dim=1)
         histogram_metrics_dict = {
             'loss_per_image':
                 {
@@ -256,6 +386,20 @@ class InstanceMetrics(object):
         return image_characteristics
 
 
+def get_contingency_tables(gt_channel_lbls, pred_channel_lbls, n_channels):
+    """
+    Per-image pixel co-occurrence counts of ground truth and predicted channels, with one bincount for the batch.
+    gt_channel_lbls, pred_channel_lbls: N x H x W LongTensors (ground truth void (-1) is ignored)
+    returns: N x C x C; [n, gt, pred] = # pixels of image n in ground truth channel gt assigned to channel pred
+    """
+    n_images = gt_channel_lbls.size(0)
+    image_offsets = (torch.arange(0, n_images) * n_channels ** 2).type_as(gt_channel_lbls).view(-1, 1, 1)
+    is_valid = (gt_channel_lbls >= 0) * (gt_channel_lbls < n_channels)
+    flat_idxs = (image_offsets + n_channels * gt_channel_lbls + pred_channel_lbls)[is_valid]
+    return torch.bincount(flat_idxs, minlength=n_images * n_channels ** 2)[:(n_images * n_channels ** 2)].view(
+        n_images, n_channels, n_channels)
+
+
 def get_same_sem_cls_channels(channel_idx, semantic_instance_class_list):
     return [ci for ci, sc in enumerate(semantic_instance_class_list)
             if sc == semantic_instance_class_list[channel_idx]]
@@ -266,27 +410,16 @@ def cat_dictionaries(dictionary, dictionary_to_add):
     return dictionary
 
 
-def compile_scores_and_losses(model, data_loader, component_loss_function,
-                              augment_function_img_sem=None):
+def iterate_scores_and_losses(model, data_loader, component_loss_function, augment_function_img_sem=None):
     """
+    Runs the dataset through the model once, yielding one
+    (scores, sem_lbl, inst_lbl, pred_permutations, total_loss, loss_components) tuple per batch (the InstanceMetrics
+    stream).
     component_loss_function: must be of the form loss_function(scores, sem_lbl, inst_lbl)
     """
     assert component_loss_function is not None
     training = model.training
     model.eval()
-    n_images = data_loader.batch_size * len(data_loader)
-    n_channels = model.n_output_channels
-    batch_size = data_loader.batch_size
-    min_image_size, max_image_size = (torch.np.inf, torch.np.inf), (0, 0)
-    for batch_idx, (img_data, (sem_lbl, inst_lbl)) in tqdm.tqdm(
-            enumerate(data_loader), total=len(data_loader), desc='Running dataset through model', ncols=80,
-            leave=False):
-        min_image_size = (min(min_image_size[0], img_data.size(2)), min(min_image_size[1], img_data.size(3)))
-        max_image_size = (max(max_image_size[0], img_data.size(2)), min(max_image_size[1], img_data.size(3)))
-
-    compiled_scores = torch.ones(n_images, n_channels, *list(min_image_size))
-    compiled_losses = torch.ones(n_images) if component_loss_function is not None else None
-    compiled_loss_components = torch.ones(n_images, n_channels) if component_loss_function is not None else None
     for batch_idx, (img_data, (sem_lbl, inst_lbl)) in tqdm.tqdm(
             enumerate(data_loader), total=len(data_loader), desc='Running dataset through model', ncols=80,
             leave=False):
@@ -298,33 +431,9 @@ def compile_scores_and_losses(model, data_loader, component_loss_function,
             full_data = img_data
         full_data, sem_lbl, inst_lbl = Variable(full_data, volatile=True), Variable(sem_lbl), Variable(inst_lbl)
         scores = model(full_data)
-        try:
-            compiled_scores[(batch_idx * batch_size):((batch_idx + 1) * batch_size), ...] = scores.data
-        except:
-            if all([s1 > s2 for s1, s2 in zip(
-                    compiled_scores[(batch_idx * batch_size):((batch_idx + 1) * batch_size), ...].size(),
-                    scores.size())]):
-                import ipdb;
-                ipdb.set_trace()
-                raise
-            else:
-                # print(Warning('Cropping image from size {} to {} for easier analysis'.format(
-                #     scores.size(), compiled_scores.size())))
-                cropped_size = (compiled_scores.size(2), compiled_scores.size(3))
-                cropped_scores = center_crop_to_reduced_size(scores, cropped_size, rc_axes=(2, 3))
-                try:
-                    assert cropped_scores.size() == \
-                           compiled_scores[(batch_idx * batch_size):((batch_idx + 1) * batch_size), ...].size()
-                except:
-                    import ipdb;
-                    ipdb.set_trace()
-                    raise
-                compiled_scores[(batch_idx * batch_size):((batch_idx + 1) * batch_size), ...] = cropped_scores.data
-        if component_loss_function is not None:
-            pred_permutations_batch, loss_batch, loss_components = component_loss_function(scores, sem_lbl, inst_lbl)
-            compiled_loss_components[(batch_idx * batch_size):((batch_idx + 1) * batch_size), :] = loss_components.data
-            compiled_losses[(batch_idx * batch_size):((batch_idx + 1) * batch_size)] = loss_batch.data
+        pred_permutations_batch, loss_batch, loss_components = component_loss_function(scores, sem_lbl, inst_lbl)
+        yield scores.data, sem_lbl.data, inst_lbl.data, pred_permutations_batch, loss_batch.data, \
+            loss_components.data
 
     if training:
         model.train()
-    return compiled_scores, compiled_losses, compiled_loss_components
@@ -0,0 +1,149 @@
+import time
+
+import torch
+
+from instanceseg.utils.background import BackgroundWorker
+
+
+class TelemetryWriter(object):
+    """
+    Rate-limited, asynchronous front end to a tensorboardX SummaryWriter for per-iteration training telemetry.
+
+    - Every tag is written every <interval> iterations: intervals_by_tag maps tag prefixes to intervals (the longest
+      matching prefix wins); other tags use the interval of their kind (scalar, summary or histogram).  An interval of
+      0 turns the tag off.
+    - Summaries (add_channel_summaries) are per-channel min / max / mean, reduced where the tensor lives (e.g. - the
+      GPU), in place of full histograms.
+    - Values are handed to a background thread that copies them to the host and writes them, so the trainer only
+      pays for the reductions (and for blocking on a full queue).
+    - The time the trainer spends in here is compared with the step time every report_interval steps (see end_step)
+      and written as Z_telemetry/overhead_percent.  If it's over overhead_budget_percent, every interval is doubled.
+      Other optional work the trainer times (add_timing) is reported the same way, as Z_telemetry/<name>_percent.
+    """
+    def __init__(self, tensorboard_writer, scalar_interval=1, summary_interval=1, histogram_interval=100,
+                 intervals_by_tag=None, overhead_budget_percent=5.0, report_interval=100, background=True,
+                 max_queue_size=100):
+        self.tensorboard_writer = tensorboard_writer
+        self.intervals_by_kind = {'scalar': scalar_interval, 'summary': summary_interval,
+                                  'histogram': histogram_interval}
+        self.intervals_by_tag = intervals_by_tag or {}
+        self.interval_multiplier = 1
+        self.overhead_budget_percent = overhead_budget_percent
+        self.report_interval = report_interval
+        self.worker = BackgroundWorker(max_queue_size, name='telemetry') \
+            if (background and tensorboard_writer is not None) else None
+        self.telemetry_seconds = 0.0
+        self.step_seconds = 0.0
+        self.n_steps = 0
+        self.last_overhead_percent = None
+        self.seconds_by_timing_name = {}
+        self.last_percent_by_timing_name = {}
+
+    def get_interval(self, tag, kind='scalar'):
+        matching_prefixes = [prefix for prefix in self.intervals_by_tag.keys() if tag.startswith(prefix)]
+        interval = self.intervals_by_tag[max(matching_prefixes, key=len)] if matching_prefixes \
+            else self.intervals_by_kind[kind]
+        return interval * self.interval_multiplier
+
+    def should_write(self, tag, iteration, kind='scalar'):
+        if self.tensorboard_writer is None:
+            return False
+        interval = self.get_interval(tag, kind)
+        return interval > 0 and iteration % interval == 0
+
+    def add_scalar(self, tag, value, iteration):
+        """
+        value: a number, or a one-element tensor (only copied to the host by the writer thread)
+        """
+        t = time.time()
+        if self.should_write(tag, iteration, 'scalar'):
+            self._submit(lambda: self.tensorboard_writer.add_scalar(tag, float(value), iteration))
+        self.telemetry_seconds += time.time() - t
+
+    def add_scalars(self, tags, values, iteration):
+        """
+        One scalar per tag from a 1-D tensor (or sequence) of values, copied to the host in one piece.
+        """
+        t = time.time()
+        tags_to_write = [(idx, tag) for idx, tag in enumerate(tags) if self.should_write(tag, iteration, 'scalar')]
+        if len(tags_to_write) > 0:
+            def write():
+                host_values = values.cpu().numpy() if torch.is_tensor(values) else values
+                for idx, tag in tags_to_write:
+                    self.tensorboard_writer.add_scalar(tag, float(host_values[idx]), iteration)
+            self._submit(write)
+        self.telemetry_seconds += time.time() - t
+
+    def add_channel_summaries(self, tag, tensor, iteration):
+        """
+        Writes <tag>/<channel_idx>/{min,max,mean} for each channel (first dimension) of tensor.
+        """
+        t = time.time()
+        if self.should_write(tag, iteration, 'summary'):
+            flat_tensor = tensor.contiguous().view(tensor.size(0), -1)
+            summaries = torch.stack([flat_tensor.min(dim=1)[0], flat_tensor.max(dim=1)[0], flat_tensor.mean(dim=1)],
+                                    dim=1)
+
+            def write():
+                for channel_idx, channel_summary in enumerate(summaries.cpu().numpy()):
+                    for stat_name, value in zip(('min', 'max', 'mean'), channel_summary):
+                        self.tensorboard_writer.add_scalar('{}/{}/{}'.format(tag, channel_idx, stat_name),
+                                                           float(value), iteration)
+            self._submit(write)
+        self.telemetry_seconds += time.time() - t
+
+    def add_channel_histograms(self, tag, tensor, iteration):
+        """
+        Writes a histogram <tag>/<channel_idx> for each channel (first dimension) of tensor.
+        """
+        t = time.time()
+        if self.should_write(tag, iteration, 'histogram'):
+            snapshot = tensor.clone()  # e.g. - gradients are zeroed in place before the writer gets to them
+
+            def write():
+                for channel_idx, channel_values in enumerate(snapshot.cpu().numpy()):
+                    self.tensorboard_writer.add_histogram('{}/{}'.format(tag, channel_idx), channel_values,
+                                                          iteration)
+            self._submit(write)
+        self.telemetry_seconds += time.time() - t
+
+    def add_timing(self, name, seconds):
+        """
+        Adds seconds of this step spent on <name> (reported as a percent of step time by end_step).
+        """
+        self.seconds_by_timing_name[name] = self.seconds_by_timing_name.get(name, 0.0) + seconds
+
+    def end_step(self, step_seconds, iteration):
+        """
+        step_seconds: the whole training step, telemetry included
+        """
+        self.step_seconds += step_seconds
+        self.n_steps += 1
+        if self.n_steps < self.report_interval or self.step_seconds == 0:
+            return
+        self.last_overhead_percent = 100.0 * self.telemetry_seconds / self.step_seconds
+        self.last_percent_by_timing_name = {name: 100.0 * seconds / self.step_seconds
+                                            for name, seconds in self.seconds_by_timing_name.items()}
+        if self.tensorboard_writer is not None:
+            percents_by_tag = {'Z_telemetry/{}_percent'.format(name): percent
+                               for name, percent in self.last_percent_by_timing_name.items()}
+            percents_by_tag['Z_telemetry/overhead_percent'] = self.last_overhead_percent
+            self._submit(lambda: [self.tensorboard_writer.add_scalar(tag, percent, iteration)
+                                  for tag, percent in percents_by_tag.items()])
+        if self.last_overhead_percent > self.overhead_budget_percent:
+            self.interval_multiplier *= 2
+            print(Warning('Telemetry took {:.1f}% of step time (budget: {}%); writing it {}x less often than '
+                          'configured from now on.'.format(self.last_overhead_percent, self.overhead_budget_percent,
+                                                           self.interval_multiplier)))
+        self.telemetry_seconds, self.step_seconds, self.n_steps = 0.0, 0.0, 0
+        self.seconds_by_timing_name = {}
+
+    def _submit(self, write):
+        if self.worker is None:
+            write()
+        else:
+            self.worker.submit(write)
+
+    def flush(self):
+        if self.worker is not None:
+            self.worker.flush()
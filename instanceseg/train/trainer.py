@@ -1,4 +1,5 @@
 import math
+import time
 
 import numpy as np
 import torch
@@ -11,11 +12,13 @@ import instanceseg
 import instanceseg.losses.loss
 import instanceseg.utils.export
 import instanceseg.utils.misc
+from instanceseg.datasets.collate import LBL_PAD_VALUE
 from instanceseg.utils.instance_utils import InstanceProblemConfig
 from instanceseg.models.fcn8s_instance import FCN8sInstance
 from instanceseg.models.model_utils import is_nan, any_nan
 from instanceseg.train import metrics, trainer_exporter
 from instanceseg.utils import datasets
+from instanceseg.utils import precision as precision_utils
 
 DEBUG_ASSERTS = True
 
@@ -41,7 +44,11 @@ class Trainer(object):
                  use_semantic_loss=False, augment_input_with_semantic_masks=False, write_instance_metrics=True,
                  generate_new_synthetic_data_each_epoch=False,
                  export_activations=False, activation_layers_to_export=(),
-                 lr_scheduler: ReduceLROnPlateau = None):
+                 lr_scheduler: ReduceLROnPlateau = None, matching_solver='scipy', matching_solver_threads=1,
+                 instance_metrics_in_background=False, instance_metrics_queue_size=2,
+                 telemetry_scalar_interval=1, telemetry_summary_interval=10, telemetry_histogram_interval=100,
+                 telemetry_overhead_budget=5.0, loss_updates_interval=1, loss_updates_mode='forward',
+                 train_metrics_interval=1, precision='fp32', channels_last=False, grad_accumulation_steps=1):
 
         # System parameters
         self.cuda = cuda
@@ -67,6 +74,8 @@ class Trainer(object):
         self.size_average = size_average
         self.matching_loss = matching_loss
         self.loss_type = loss_type
+        self.matching_solver = matching_solver
+        self.matching_solver_threads = matching_solver_threads
 
         # Data loading parameters
         self.loader_semantic_lbl_only = loader_semantic_lbl_only
@@ -77,6 +86,28 @@ class Trainer(object):
 
         self.write_instance_metrics = write_instance_metrics
 
+        # Loss updates: the loss / matching right after an optimizer step, every loss_updates_interval iterations
+        # (0: never).  'forward': with an extra forward pass in eval mode; 'next_forward': with the next iteration's
+        # forward pass, if it's on the same batch (e.g. - overfitting a single image).
+        assert loss_updates_mode in ('forward', 'next_forward'), \
+            ValueError('loss_updates_mode must be \'forward\' or \'next_forward\'; got {}'.format(loss_updates_mode))
+        self.loss_updates_interval = loss_updates_interval
+        self.loss_updates_mode = loss_updates_mode
+        self.pending_loss_update = None
+        self.n_loss_updates_dropped = 0
+
+        # Reduced precision / memory format (see utils.precision): the forward pass runs under autocast; losses and
+        # matching costs are computed in fp32.
+        self.precision = precision_utils.resolve_precision(precision, cuda)
+        self.loss_scaler = precision_utils.LossScaler(self.precision)
+        self.channels_last = channels_last
+
+        # Gradient accumulation: the gradients of grad_accumulation_steps mini-batches (iterations) are averaged into
+        # one optimizer step.  Matching is per image either way.
+        assert grad_accumulation_steps >= 1, ValueError('grad_accumulation_steps must be at least 1; got {}'.format(
+            grad_accumulation_steps))
+        self.grad_accumulation_steps = grad_accumulation_steps
+
         # Stored values
         self.last_val_loss = None
 
@@ -104,7 +135,14 @@ class Trainer(object):
         }
         export_config = trainer_exporter.ExportConfig(export_activations=export_activations,
                                                       activation_layers_to_export=activation_layers_to_export,
-                                                      write_instance_metrics=write_instance_metrics)
+                                                      write_instance_metrics=write_instance_metrics,
+                                                      instance_metrics_in_background=instance_metrics_in_background,
+                                                      instance_metrics_queue_size=instance_metrics_queue_size,
+                                                      telemetry_scalar_interval=telemetry_scalar_interval,
+                                                      telemetry_summary_interval=telemetry_summary_interval,
+                                                      telemetry_histogram_interval=telemetry_histogram_interval,
+                                                      telemetry_overhead_budget=telemetry_overhead_budget,
+                                                      train_metrics_interval=train_metrics_interval)
         self.exporter = trainer_exporter.TrainerExporter(
             out_dir=out_dir, instance_problem=instance_problem,
             export_config=export_config, tensorboard_writer=tensorboard_writer, metric_makers=metric_makers)
@@ -123,11 +161,14 @@ class Trainer(object):
             sem_lbl = target
             inst_lbl = torch.zeros_like(sem_lbl)
             inst_lbl[sem_lbl == -1] = -1
+            inst_lbl[sem_lbl == LBL_PAD_VALUE] = LBL_PAD_VALUE
 
         if self.cuda:
             img_data, (sem_lbl, inst_lbl) = img_data.cuda(), (sem_lbl.cuda(), inst_lbl.cuda())
         full_input = img_data if not self.augment_input_with_semantic_masks \
             else self.augment_image(img_data, sem_lbl)
+        if self.channels_last:
+            full_input = precision_utils.to_channels_last(full_input)
         full_input, sem_lbl, inst_lbl = \
             Variable(full_input, volatile=(not requires_grad)), \
             Variable(sem_lbl, requires_grad=requires_grad), \
@@ -139,10 +180,10 @@ class Trainer(object):
 
         matching = matching_override if matching_override is not None else self.matching_loss
 
-        my_loss_object = instanceseg.losses.loss.loss_object_factory(self.loss_type,
-                                                                     self.instance_problem.semantic_instance_class_list,
-                                                                     self.instance_problem.instance_count_id_list,
-                                                                     matching, self.size_average)
+        my_loss_object = instanceseg.losses.loss.loss_object_factory(
+            self.loss_type, self.instance_problem.semantic_instance_class_list,
+            self.instance_problem.instance_count_id_list, matching, self.size_average,
+            matching_solver=self.matching_solver, matching_solver_threads=self.matching_solver_threads)
         return my_loss_object
 
     def compute_loss(self, score, sem_lbl, inst_lbl, val_matching_override=False):
@@ -159,7 +200,8 @@ class Trainer(object):
         return permutations, avg_loss, loss_components
 
     def augment_image(self, img, sem_lbl):
-        semantic_one_hot = datasets.labels_to_one_hot(sem_lbl, self.instance_problem.n_semantic_classes)
+        # padding (collate.LBL_PAD_VALUE) gets no channel, like void
+        semantic_one_hot = datasets.labels_to_one_hot(sem_lbl.clamp(min=-1), self.instance_problem.n_semantic_classes)
         return datasets.augment_channels(img, BINARY_AUGMENT_MULTIPLIER * semantic_one_hot -
                                          (0.5 if BINARY_AUGMENT_CENTERED else 0), dim=1)
 
@@ -188,8 +230,14 @@ class Trainer(object):
         self.model.eval()
 
         val_loss = 0
+        self.eval_loss_object_with_matching.reset_solver_call_counts()
+        self.eval_loss_object_with_matching.n_bytes_to_host = 0
         segmentation_visualizations, score_visualizations = [], []
-        label_trues, label_preds, scores, pred_permutations = [], [], [], []
+        confusion_accumulator = metrics.ConfusionAccumulator(self.instance_problem.n_classes)
+        instance_metrics = self.exporter.metric_makers['val' if split == 'val' else 'train_for_val'] \
+            if write_instance_metrics else None
+        if instance_metrics is not None:
+            instance_metrics.reset_stream()
         num_images_to_visualize = min(len(data_loader), 9)
         for batch_idx, (img_data, lbls) in tqdm.tqdm(
                 enumerate(data_loader), total=len(data_loader),
@@ -200,16 +248,15 @@ class Trainer(object):
             if not (should_compute_basic_metrics or should_visualize):
                 # Don't waste computation if we don't need to run on the remaining images
                 continue
-            true_labels_sb, pred_labels_sb, score_sb, pred_permutations_sb, val_loss_sb, \
-            segmentation_visualizations_sb, score_visualizations_sb = \
+            score_sb, pred_permutations_sb, val_loss_sb, segmentation_visualizations_sb, score_visualizations_sb = \
                 self.validate_single_batch(img_data, lbls[0], lbls[1], data_loader=data_loader,
-                                           should_visualize=should_visualize)
-
-            label_trues += true_labels_sb
-            label_preds += pred_labels_sb
+                                           should_visualize=should_visualize,
+                                           confusion_accumulator=confusion_accumulator
+                                           if should_compute_basic_metrics else None,
+                                           instance_metrics=instance_metrics,
+                                           n_images_to_visualize=num_images_to_visualize -
+                                           len(segmentation_visualizations))
             val_loss += val_loss_sb
-            scores += [score_sb]
-            pred_permutations += [pred_permutations_sb]
             segmentation_visualizations += segmentation_visualizations_sb
             score_visualizations += score_visualizations_sb
 
@@ -218,11 +265,16 @@ class Trainer(object):
                                                       self.state.iteration, split)
         val_loss /= len(data_loader)
         self.last_val_loss = val_loss
+        self.exporter.n_bytes_to_host += self.eval_loss_object_with_matching.n_bytes_to_host
+        if instance_metrics is not None:
+            self.exporter.n_bytes_to_host += instance_metrics.n_bytes_to_host
 
-        val_metrics = self.exporter.run_post_val_epoch(label_preds, label_trues, pred_permutations,
+        val_metrics = self.exporter.run_post_val_epoch(confusion_accumulator,
                                                        should_compute_basic_metrics, split, val_loss, val_metrics,
                                                        write_basic_metrics, write_instance_metrics,
                                                        self.state.epoch, self.state.iteration, self.model)
+        self.export_solver_call_counts(self.eval_loss_object_with_matching, 'val' if split == 'val' else
+                                       'train_for_val', self.state.iteration)
         if save_checkpoint:
             self.save_checkpoint_and_update_if_best(mean_iu=val_metrics[2])
 
@@ -240,21 +292,38 @@ class Trainer(object):
             self.best_mean_iu = mean_iu
             self.exporter.copy_checkpoint_as_best(current_checkpoint_file)
 
-    def validate_single_batch(self, img_data, sem_lbl, inst_lbl, data_loader, should_visualize):
-
+    def validate_single_batch(self, img_data, sem_lbl, inst_lbl, data_loader, should_visualize,
+                              confusion_accumulator=None, instance_metrics=None, n_images_to_visualize=None):
+        """
+        confusion_accumulator: metrics.ConfusionAccumulator to fold this batch's predictions into.  The argmax,
+            permutation and histogram all stay on the model's device; images are only copied back to the host if
+            they're visualized.
+        instance_metrics: metrics.InstanceMetrics to stream this batch's scores, labels and losses to
+        n_images_to_visualize: visualize at most this many images from the batch (all of them if None)
+        """
         full_input, sem_lbl, inst_lbl = self.prepare_data_for_forward_pass(img_data, (sem_lbl, inst_lbl),
                                                                            requires_grad=False)
-        imgs = img_data.cpu()
 
         score = self.model(full_input)
-        pred_permutations, loss, _ = self.compute_loss(score, sem_lbl, inst_lbl, val_matching_override=True)
+        pred_permutations, loss, loss_components = self.compute_loss(score, sem_lbl, inst_lbl,
+                                                                     val_matching_override=True)
         val_loss = float(loss.data[0])
-        true_labels, pred_labels, segmentation_visualizations, score_visualizations = \
-            self.exporter.run_post_val_iteration(
-                imgs, inst_lbl, pred_permutations, score, sem_lbl, should_visualize,
-                data_to_img_transformer=lambda i, l: self.exporter.untransform_data(data_loader, i, l))
-        return true_labels, pred_labels, score, pred_permutations, val_loss, segmentation_visualizations, \
-               score_visualizations
+        if instance_metrics is not None:
+            instance_metrics.update(score.data, sem_lbl.data, inst_lbl.data, pred_permutations,
+                                    total_loss=val_loss * score.size(0), loss_components=loss_components.data)
+        if confusion_accumulator is not None:
+            true_labels = self.instance_problem.combine_semantic_and_instance_labels(sem_lbl.data, inst_lbl.data)
+            pred_labels = score.data.max(dim=1)[1]
+            confusion_accumulator.update(true_labels, pred_labels, pred_permutations)
+        if should_visualize:
+            segmentation_visualizations, score_visualizations = \
+                self.exporter.run_post_val_iteration(
+                    img_data.cpu(), inst_lbl, pred_permutations, score, sem_lbl, should_visualize,
+                    data_to_img_transformer=lambda i, l: self.exporter.untransform_data(data_loader, i, l),
+                    n_images_to_visualize=n_images_to_visualize)
+        else:
+            segmentation_visualizations, score_visualizations = [], []
+        return score, pred_permutations, val_loss, segmentation_visualizations, score_visualizations
 
     def train_epoch(self):
         self.model.train()
@@ -287,12 +356,30 @@ class Trainer(object):
             if self.state.training_complete():
                 self.validate_all_splits()
                 break
+        self.export_solver_call_counts(self.loss_object, 'train', self.state.epoch)
+
+    def export_solver_call_counts(self, loss_object, split, step):
+        """
+        split: 'train' (the training iterations of an epoch; step is the epoch), or 'val' / 'train_for_val' (one
+            validation pass; step is the iteration)
+        """
+        if self.exporter.tensorboard_writer is not None:
+            self.exporter.tensorboard_writer.add_scalar('B_intermediate_metrics/{}/matching_solver_calls'.format(
+                split), loss_object.n_solver_calls, step)
+            self.exporter.tensorboard_writer.add_scalar(
+                'B_intermediate_metrics/{}/matching_solver_calls_avoided'.format(split),
+                loss_object.n_solver_calls_avoided, step)
+        loss_object.reset_solver_call_counts()
 
     def train_iteration(self, img_data, target):
         assert self.model.training
+        step_start_time = time.time()
         full_input, sem_lbl, inst_lbl = self.prepare_data_for_forward_pass(img_data, target, requires_grad=True)
-        self.optim.zero_grad()
-        score = self.model(full_input)
+        if self.starts_accumulation():
+            self.optim.zero_grad()
+        with precision_utils.autocast(self.precision, self.cuda):
+            score = self.model(full_input)
+        score = score.float()
         pred_permutations, loss, loss_components = self.compute_loss(score, sem_lbl, inst_lbl)
         debug_check_values_are_valid(loss, score, self.state.iteration)
 
@@ -302,53 +389,95 @@ class Trainer(object):
         #         prediction[0, ...], sem_lbl[0, ...], inst_lbl[0, ...])
         #
         #     import ipdb; ipdb.set_trace()
-        loss.backward()
-        self.optim.step()
-
-        try:
-            iteration = self.state.iteration
-            upscore8_grad = self.model.upscore8.weight.grad
-            for channel_idx, channel_name in enumerate(self.instance_problem.get_channel_labels()):
-                self.exporter.tensorboard_writer.add_histogram('Z_upscore8_gradients/{}'.format(channel_idx),
-                                                               upscore8_grad[channel_idx, :, :, :], self.state.iteration)
-            score_pool4_weight_grad = self.model.score_pool4.weight.grad
-            score_pool4_bias_grad = self.model.score_pool4.bias.grad
-            assert len(score_pool4_bias_grad) == self.instance_problem.n_classes
-            for channel_idx, channel_name in enumerate(self.instance_problem.get_channel_labels()):
-                self.exporter.tensorboard_writer.add_histogram('Z_score_pool4_weight_gradients/{}'.format(channel_idx),
-                                                               score_pool4_weight_grad[channel_idx, :, :, :], self.state.iteration)
-                self.exporter.tensorboard_writer.add_histogram('score_pool4_bias_gradients/{}'.format(channel_idx),
-                                                               score_pool4_bias_grad[channel_idx], self.state.iteration)
-        except:
-            import ipdb;
-            ipdb.set_trace()
-            raise
-
-        if self.exporter.run_loss_updates:
-            self.model.eval()
-            new_score = self.model(full_input)
-            new_pred_permutations, new_loss, new_loss_components = self.compute_loss(new_score, sem_lbl,
-                                                                                     inst_lbl)
-            # num_reassignments = np.sum(new_pred_permutations != pred_permutations)
-            # if not num_reassignments == 0:
-            #     self.debug_loss(score, sem_lbl, inst_lbl, new_score, new_loss, loss_components, new_loss_components)
+        self.loss_scaler.scale(loss / self.grad_accumulation_steps).backward()
 
-            self.model.train()
+        if self.pending_loss_update is not None:
+            loss_updates_start_time = time.time()
+            self.finish_pending_loss_update(img_data, pred_permutations, loss)
+            self.exporter.telemetry.add_timing('loss_updates', time.time() - loss_updates_start_time)
+        new_pred_permutations, new_loss = None, None
+        if self.ends_accumulation():
+            new_pred_permutations, new_loss = self.step_optimizer(img_data, full_input, sem_lbl, inst_lbl,
+                                                                  pred_permutations, loss)
 
-        else:
-            new_pred_permutations, new_loss = None, None
-
-        group_lrs = []
-        for grp_idx, param_group in enumerate(self.optim.param_groups):
-            group_lr = self.optim.param_groups[grp_idx]['lr']
-            group_lrs.append(group_lr)
         self.exporter.run_post_train_iteration(full_input=full_input,
                                                inst_lbl=inst_lbl, sem_lbl=sem_lbl,
                                                loss=loss, loss_components=loss_components,
                                                pred_permutations=pred_permutations, score=score,
                                                epoch=self.state.epoch, iteration=self.state.iteration,
                                                new_pred_permutations=new_pred_permutations, new_loss=new_loss,
-                                               get_activations_fcn=self.model.get_activations, lrs_by_group=group_lrs)
+                                               get_activations_fcn=self.model.get_activations,
+                                               lrs_by_group=self.get_group_lrs())
+        self.exporter.telemetry.end_step(time.time() - step_start_time, self.state.iteration)
+
+    def step_optimizer(self, img_data, full_input, sem_lbl, inst_lbl, pred_permutations, loss):
+        """
+        Optimizer step on the accumulated gradients, followed by gradient telemetry and (if it's time) loss updates.
+        Returns the loss and matching after the step (None if they weren't computed in this iteration).
+        """
+        self.loss_scaler.step(self.optim)
+        self.loss_scaler.update()
+
+        self.exporter.write_gradient_telemetry(self.model, self.state.iteration)
+
+        new_pred_permutations, new_loss = None, None
+        if self.should_run_loss_updates():
+            if self.loss_updates_mode == 'forward':
+                loss_updates_start_time = time.time()
+                self.model.eval()
+                with precision_utils.autocast(self.precision, self.cuda):
+                    new_score = self.model(full_input)
+                new_score = new_score.float()
+                self.loss_object.count_solver_calls = False  # only the training iterations' calls are counted
+                new_pred_permutations, new_loss, new_loss_components = self.compute_loss(new_score, sem_lbl,
+                                                                                         inst_lbl)
+                self.loss_object.count_solver_calls = True
+                # num_reassignments = np.sum(new_pred_permutations != pred_permutations)
+                # if not num_reassignments == 0:
+                #     self.debug_loss(score, sem_lbl, inst_lbl, new_score, new_loss, loss_components,
+                #                     new_loss_components)
+
+                self.model.train()
+                self.exporter.telemetry.add_timing('loss_updates', time.time() - loss_updates_start_time)
+            else:
+                # Evaluated by the next iteration's forward pass, if it gets the same batch
+                self.pending_loss_update = (self.state.iteration, img_data, pred_permutations, float(loss))
+        return new_pred_permutations, new_loss
+
+    def get_group_lrs(self):
+        return [param_group['lr'] for param_group in self.optim.param_groups]
+
+    def starts_accumulation(self):
+        return self.state.iteration % self.grad_accumulation_steps == 0
+
+    def ends_accumulation(self):
+        """
+        True if this iteration's mini-batch is the last one before an optimizer step (the last of its
+        grad_accumulation_steps, or the last of training).
+        """
+        return (self.state.iteration + 1) % self.grad_accumulation_steps == 0 or self.state.training_complete()
+
+    def should_run_loss_updates(self):
+        """
+        Every loss_updates_interval optimizer steps
+        """
+        n_steps = self.state.iteration // self.grad_accumulation_steps
+        return self.exporter.run_loss_updates and self.loss_updates_interval > 0 and \
+            n_steps % self.loss_updates_interval == 0
+
+    def finish_pending_loss_update(self, img_data, pred_permutations, loss):
+        """
+        'next_forward' loss updates: the loss and matching after an update are this iteration's (in training mode),
+        as long as this iteration has the same batch.  Otherwise, the loss update is dropped.
+        """
+        iteration, old_img_data, old_pred_permutations, old_loss = self.pending_loss_update
+        self.pending_loss_update = None
+        if old_img_data.size() != img_data.size() or not torch.equal(old_img_data, img_data):
+            self.n_loss_updates_dropped += 1
+            return
+        self.exporter.write_loss_updates(old_loss=old_loss, new_loss=float(loss),
+                                         old_pred_permutations=old_pred_permutations,
+                                         new_pred_permutations=pred_permutations, iteration=iteration)
 
     def debug_loss(self, score, sem_lbl, inst_lbl, new_score, new_loss, loss_components, new_loss_components):
         predictions = self.loss_object.transform_scores_to_predictions(score)
@@ -373,6 +502,7 @@ class Trainer(object):
             self.train_epoch()
             if self.state.training_complete():
                 break
+        self.exporter.flush()
 
     def validate_all_splits(self):
         val_loss, val_metrics, _ = self.validate_split('val')
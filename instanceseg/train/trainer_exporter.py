@@ -1,4 +1,6 @@
+import copy
 import datetime
+import functools
 import os
 import os.path as osp
 import shutil
@@ -14,7 +16,10 @@ import instanceseg.utils.display as display_pyutils
 import instanceseg.utils.export
 from instanceseg.analysis import visualization_utils
 from instanceseg.datasets import runtime_transformations
+from instanceseg.train import metrics
+from instanceseg.train.telemetry import TelemetryWriter
 from instanceseg.utils import instance_utils
+from instanceseg.utils.background import BackgroundWorker
 from instanceseg.utils.misc import flatten_dict
 from tensorboardX import SummaryWriter
 
@@ -35,10 +40,25 @@ DEBUG_ASSERTS = True
 
 class ExportConfig(object):
     def __init__(self, export_activations=None, activation_layers_to_export=(), write_instance_metrics=False,
-                 run_loss_updates=True):
+                 run_loss_updates=True, instance_metrics_in_background=False, instance_metrics_queue_size=2,
+                 telemetry_scalar_interval=1, telemetry_summary_interval=10, telemetry_histogram_interval=100,
+                 telemetry_overhead_budget=5.0, train_metrics_interval=1):
         self.export_activations = export_activations
         self.activation_layers_to_export = activation_layers_to_export
         self.write_instance_metrics = write_instance_metrics
+        # Compute / write instance metrics on a background thread, with at most instance_metrics_queue_size
+        # validations waiting
+        self.instance_metrics_in_background = instance_metrics_in_background
+        self.instance_metrics_queue_size = instance_metrics_queue_size
+        # Per-iteration training telemetry (see telemetry.TelemetryWriter): write every <interval> iterations (0: never)
+        self.telemetry_scalar_interval = telemetry_scalar_interval
+        self.telemetry_summary_interval = telemetry_summary_interval  # gradient min / max / mean per channel
+        self.telemetry_histogram_interval = telemetry_histogram_interval  # gradient histograms per channel
+        self.telemetry_overhead_budget = telemetry_overhead_budget  # % of step time
+        # Training accuracy / mIOU are accumulated over (and written every) train_metrics_interval iterations (0: never)
+        self.train_metrics_interval = train_metrics_interval
+        self.log_csv_flush_lines = 100
+        self.log_csv_flush_seconds = 60.0
         self.run_loss_updates = run_loss_updates
 
         self.write_activation_condition = should_write_activations
@@ -77,6 +97,11 @@ class TrainerExporter(object):
 
         # Helper objects
         self.tensorboard_writer = tensorboard_writer
+        self.telemetry = TelemetryWriter(tensorboard_writer,
+                                         scalar_interval=self.export_config.telemetry_scalar_interval,
+                                         summary_interval=self.export_config.telemetry_summary_interval,
+                                         histogram_interval=self.export_config.telemetry_histogram_interval,
+                                         overhead_budget_percent=self.export_config.telemetry_overhead_budget)
 
         # Log directory / log files
         self.out_dir = out_dir
@@ -86,6 +111,9 @@ class TrainerExporter(object):
         if not osp.exists(osp.join(self.out_dir, 'log.csv')):
             with open(osp.join(self.out_dir, 'log.csv'), 'w') as f:
                 f.write(','.join(self.log_headers) + '\n')
+        self.log_csv_writer = instanceseg.utils.export.BufferedLineWriter(
+            osp.join(self.out_dir, 'log.csv'), max_lines=self.export_config.log_csv_flush_lines,
+            max_seconds=self.export_config.log_csv_flush_seconds)
 
         # Logging parameters
         self.timestamp_start = datetime.datetime.now(pytz.timezone(MY_TIMEZONE))
@@ -97,28 +125,38 @@ class TrainerExporter(object):
 
         self.metric_makers = metric_makers
 
+        self.instance_metrics_worker = BackgroundWorker(self.export_config.instance_metrics_queue_size,
+                                                        name='instance_metrics') \
+            if self.export_config.instance_metrics_in_background else None
+
+        # Training metrics since they were last written
+        self.train_confusion_accumulator = metrics.ConfusionAccumulator(self.instance_problem.n_classes)
+        self.train_loss_sum, self.n_train_iterations_accumulated = 0, 0
+
+        # Profiling: bytes copied from the model's device to the host during the current validation epoch
+        self.n_bytes_to_host = 0
+
         # Writing activations
 
         self.run_loss_updates = True
 
     def write_eval_metrics(self, eval_metrics, loss, split, epoch, iteration):
-        with open(osp.join(self.out_dir, 'log.csv'), 'a') as f:
-            elapsed_time = (
-                    datetime.datetime.now(pytz.timezone(MY_TIMEZONE)) -
-                    self.timestamp_start).total_seconds()
-            if split == 'val':
-                log = [epoch, iteration] + [''] * 5 + \
-                      [loss] + list(eval_metrics) + [elapsed_time]
-            elif split == 'train':
-                try:
-                    eval_metrics_as_list = eval_metrics.tolist()
-                except:
-                    eval_metrics_as_list = list(eval_metrics)
-                log = [epoch, iteration] + [loss] + eval_metrics_as_list + [''] * 5 + [elapsed_time]
-            else:
-                raise ValueError('split not recognized')
-            log = map(str, log)
-            f.write(','.join(log) + '\n')
+        elapsed_time = (
+                datetime.datetime.now(pytz.timezone(MY_TIMEZONE)) -
+                self.timestamp_start).total_seconds()
+        if split == 'val':
+            log = [epoch, iteration] + [''] * 5 + \
+                  [loss] + list(eval_metrics) + [elapsed_time]
+        elif split == 'train':
+            try:
+                eval_metrics_as_list = eval_metrics.tolist()
+            except:
+                eval_metrics_as_list = list(eval_metrics)
+            log = [epoch, iteration] + [loss] + eval_metrics_as_list + [''] * 5 + [elapsed_time]
+        else:
+            raise ValueError('split not recognized')
+        log = map(str, log)
+        self.log_csv_writer.write_line(','.join(log))
 
     def update_mpl_joint_train_val_loss_figure(self, train_loss, val_loss, iteration):
         assert train_loss is not None, ValueError
@@ -224,35 +262,60 @@ class TrainerExporter(object):
         self.tensorboard_writer.add_scalar('A_eval_metrics/reassignment', num_reassignments, iteration)
 
     def compute_and_write_instance_metrics(self, model, iteration):
+        """
+        Metric makers that were streamed this validation's batches (see InstanceMetrics.update) are computed from the
+        stream; the others run the model over their own loader first.
+        With export_config.instance_metrics_in_background, only that model pass happens here: each stream is handed
+        off to self.instance_metrics_worker, which computes and writes the metrics while training goes on.
+        """
         if self.tensorboard_writer is not None:
             for split, metric_maker in tqdm.tqdm(self.metric_makers.items(), desc='Computing instance metrics',
                                                  total=len(self.metric_makers.items()), leave=False):
-                metric_maker.clear()
-                metric_maker.compute_metrics(model)
-                metrics_as_nested_dict = metric_maker.get_aggregated_scalar_metrics_as_nested_dict()
-                metrics_as_flattened_dict = flatten_dict(metrics_as_nested_dict)
-                for name, metric in metrics_as_flattened_dict.items():
-                    self.tensorboard_writer.add_scalar('C_{}_{}'.format(name, split), metric,
-                                                       iteration)
-                histogram_metrics_as_nested_dict = metric_maker.get_aggregated_histogram_metrics_as_nested_dict()
-                histogram_metrics_as_flattened_dict = flatten_dict(histogram_metrics_as_nested_dict)
-                if iteration != 0:  # screws up the axes if we do it on the first iteration with weird inits
-                    for name, metric in tqdm.tqdm(histogram_metrics_as_flattened_dict.items(),
-                                                  total=len(histogram_metrics_as_flattened_dict.items()),
-                                                  desc='Writing histogram metrics', leave=False):
-                        if torch.is_tensor(metric):
-                            self.tensorboard_writer.add_histogram('C_instance_metrics_{}/{}'.format(split, name),
-                                                                  metric.numpy(), iteration, bins='auto')
-                        elif isinstance(metric, np.ndarray):
-                            self.tensorboard_writer.add_histogram('C_instance_metrics_{}/{}'.format(split, name),
-                                                                  metric, iteration, bins='auto')
-                        elif metric is None:
-                            import ipdb;
-                            ipdb.set_trace()
-                            pass
-                        else:
-                            raise ValueError('I\'m not sure how to write {} to tensorboard_writer (name is '
-                                             '{}'.format(type(metric), name))
+                if metric_maker.stream is None:
+                    metric_maker.stream_model(model)
+                if self.instance_metrics_worker is None:
+                    self.compute_and_write_instance_metrics_from_stream(metric_maker, split, iteration)
+                else:
+                    # The snapshot keeps this stream; the metric maker starts a new one at the next validation.
+                    snapshot = copy.copy(metric_maker)
+                    metric_maker.stream = None
+                    self.instance_metrics_worker.submit(functools.partial(
+                        self.compute_and_write_instance_metrics_from_stream, snapshot, split, iteration))
+
+    def compute_and_write_instance_metrics_from_stream(self, metric_maker, split, iteration):
+        metric_maker.compute_metrics_from_stream()
+        metrics_as_nested_dict = metric_maker.get_aggregated_scalar_metrics_as_nested_dict()
+        metrics_as_flattened_dict = flatten_dict(metrics_as_nested_dict)
+        for name, metric in metrics_as_flattened_dict.items():
+            self.tensorboard_writer.add_scalar('C_{}_{}'.format(name, split), metric,
+                                               iteration)
+        histogram_metrics_as_nested_dict = metric_maker.get_aggregated_histogram_metrics_as_nested_dict()
+        histogram_metrics_as_flattened_dict = flatten_dict(histogram_metrics_as_nested_dict)
+        if iteration != 0:  # screws up the axes if we do it on the first iteration with weird inits
+            for name, metric in tqdm.tqdm(histogram_metrics_as_flattened_dict.items(),
+                                          total=len(histogram_metrics_as_flattened_dict.items()),
+                                          desc='Writing histogram metrics', leave=False):
+                if torch.is_tensor(metric):
+                    self.tensorboard_writer.add_histogram('C_instance_metrics_{}/{}'.format(split, name),
+                                                          metric.numpy(), iteration, bins='auto')
+                elif isinstance(metric, np.ndarray):
+                    self.tensorboard_writer.add_histogram('C_instance_metrics_{}/{}'.format(split, name),
+                                                          metric, iteration, bins='auto')
+                elif metric is None:  # (this may run on the instance metrics thread, so don't stop to debug)
+                    print(Warning('Histogram metric {} ({}) is None; not writing it'.format(name, split)))
+                else:
+                    raise ValueError('I\'m not sure how to write {} to tensorboard_writer (name is '
+                                     '{}'.format(type(metric), name))
+
+    def flush(self):
+        """
+        Waits for any instance metrics / telemetry still being written in the background, and writes the buffered
+        log.csv lines.
+        """
+        if self.instance_metrics_worker is not None:
+            self.instance_metrics_worker.flush()
+        self.telemetry.flush()
+        self.log_csv_writer.flush()
 
     def save_checkpoint(self, epoch, iteration, model, optimizer, best_mean_iu, out_dir=None,
                         out_name='checkpoint.pth.tar'):
@@ -274,13 +337,16 @@ class TrainerExporter(object):
         shutil.copy(current_checkpoint_file, best_checkpoint_file)
         return best_checkpoint_file
 
-    def visualize_one_img_prediction(self, img_untransformed, lp, lt_combined, pp, softmax_scores, true_labels, idx):
+    def visualize_one_img_prediction(self, img_untransformed, lp, lt_combined, pp, softmax_score, true_labels):
+        """
+        softmax_score: C x H x W softmax of this image's score
+        """
         # Segmentations
         segmentation_viz = visualization_utils.visualize_segmentation(
             lbl_pred=lp, lbl_true=lt_combined, pred_permutations=pp, img=img_untransformed,
             n_class=self.instance_problem.n_classes, overlay=False)
         # Scores
-        sp = softmax_scores[idx, :, :, :]
+        sp = softmax_score
         # TODO(allie): Fix this -- bug(?!)
         lp = np.argmax(sp, axis=0)
         if self.export_config.which_heatmaps_to_visualize == 'same semantic':
@@ -320,19 +386,28 @@ class TrainerExporter(object):
         visualization_utils.export_visualizations(visualizations, out_dir, self.tensorboard_writer, iteration,
                                                   basename=basename, tile=tile)
 
-    def run_post_val_epoch(self, label_preds, label_trues, pred_permutations, should_compute_basic_metrics, split,
+    def run_post_val_epoch(self, confusion_accumulator, should_compute_basic_metrics, split,
                            val_loss, val_metrics, write_basic_metrics, write_instance_metrics, epoch, iteration, model):
+        """
+        confusion_accumulator: metrics.ConfusionAccumulator, already updated with every validated batch
+        """
         if should_compute_basic_metrics:
-            val_metrics = self.compute_eval_metrics(label_trues, label_preds, pred_permutations)
+            val_metrics = confusion_accumulator.get_scores()
+            self.n_bytes_to_host += confusion_accumulator.n_bytes_to_host
             if write_basic_metrics:
                 self.write_eval_metrics(val_metrics, val_loss, split, epoch=epoch, iteration=iteration)
                 if self.tensorboard_writer is not None:
                     self.tensorboard_writer.add_scalar('A_eval_metrics/{}/losses'.format(split), val_loss, iteration)
                     self.tensorboard_writer.add_scalar('A_eval_metrics/{}/mIOU'.format(split), val_metrics[2],
                                                        iteration)
+        if self.tensorboard_writer is not None:
+            self.tensorboard_writer.add_scalar('Z_profiling/{}/bytes_to_host'.format(split), self.n_bytes_to_host,
+                                               iteration)
+        self.n_bytes_to_host = 0
 
         if write_instance_metrics:
             self.compute_and_write_instance_metrics(model=model, iteration=iteration)
+        self.log_csv_writer.flush()
         return val_metrics
 
     def run_post_train_iteration(self, full_input, inst_lbl, loss, loss_components, pred_permutations, score, sem_lbl,
@@ -341,36 +416,39 @@ class TrainerExporter(object):
         """
         get_activations_fcn=self.model.get_activations
         """
-        inst_lbl_pred = score.data.max(1)[1].cpu().numpy()[:, :, :]
-        lbl_true_sem, lbl_true_inst = sem_lbl.data.cpu().numpy(), inst_lbl.data.cpu().numpy()
-        eval_metrics = []
-        for sem_lbl_np, inst_lbl_np, lp in zip(lbl_true_sem, lbl_true_inst, inst_lbl_pred):
-            lt_combined = self.gt_tuple_to_combined(sem_lbl_np, inst_lbl_np)
-            acc, acc_cls, mean_iu, fwavacc = \
-                self.compute_eval_metrics(
-                    label_trues=[lt_combined], label_preds=[lp], permutations=[pred_permutations])
-            eval_metrics.append((acc, acc_cls, mean_iu, fwavacc))
-        eval_metrics = np.mean(eval_metrics, axis=0)
-        self.write_eval_metrics(eval_metrics, loss, split='train', epoch=epoch, iteration=iteration)
-        if self.tensorboard_writer is not None:
-		# TODO(allie): Check dimensionality of loss to prevent potential bugs
-            self.tensorboard_writer.add_scalar('A_eval_metrics/train_minibatch_loss', loss.data.sum(),
-                                               iteration)
+        # Accumulated on the device; only the histogram is copied to the host, every train_metrics_interval iterations
+        # (never if it's 0)
+        eval_metrics = None
+        if self.export_config.train_metrics_interval > 0:
+            self.train_confusion_accumulator.update(
+                self.instance_problem.combine_semantic_and_instance_labels(sem_lbl.data, inst_lbl.data),
+                score.data.max(1)[1], pred_permutations)
+            self.train_loss_sum += loss.data.sum()
+            self.n_train_iterations_accumulated += 1
+            if iteration % self.export_config.train_metrics_interval == 0:
+                eval_metrics = np.array(self.train_confusion_accumulator.get_scores())
+                mean_loss = float(self.train_loss_sum) / self.n_train_iterations_accumulated
+                self.write_eval_metrics(eval_metrics, mean_loss, split='train', epoch=epoch, iteration=iteration)
+                self.train_confusion_accumulator.reset()
+                self.train_loss_sum, self.n_train_iterations_accumulated = 0, 0
+        # TODO(allie): Check dimensionality of loss to prevent potential bugs
+        self.telemetry.add_scalar('A_eval_metrics/train_minibatch_loss', loss.data.sum(), iteration)
 
         if self.export_config.write_lr:
-            for group_idx, lr in enumerate(lrs_by_group):
-                self.tensorboard_writer.add_scalar('Z_hyperparameters/lr_group{}'.format(group_idx), lr, iteration)
+            self.telemetry.add_scalars(['Z_hyperparameters/lr_group{}'.format(group_idx)
+                                        for group_idx in range(len(lrs_by_group))], lrs_by_group, iteration)
 
         if self.export_config.export_component_losses:
-            for c_idx, c_lbl in enumerate(self.instance_problem.get_model_channel_labels('{}_{}')):
-                self.tensorboard_writer.add_scalar('B_component_losses/train/{}'.format(c_lbl),
-                                                   loss_components.data[:, c_idx].sum(), iteration)
+            self.telemetry.add_scalars(['B_component_losses/train/{}'.format(c_lbl)
+                                        for c_lbl in self.instance_problem.get_model_channel_labels('{}_{}')],
+                                       loss_components.data.sum(dim=0), iteration)
 
         if self.export_config.run_loss_updates:
-            self.write_loss_updates(old_loss=loss.data[0], new_loss=new_loss.sum(),
-                                    old_pred_permutations=pred_permutations,
-                                    new_pred_permutations=new_pred_permutations,
-                                    iteration=iteration)
+            if new_loss is not None:  # only on loss update iterations (see Trainer.should_run_loss_updates)
+                self.write_loss_updates(old_loss=float(loss), new_loss=float(new_loss.sum()),
+                                        old_pred_permutations=pred_permutations,
+                                        new_pred_permutations=new_pred_permutations,
+                                        iteration=iteration)
 
             if self.export_config.export_activations and \
                     self.export_config.write_activation_condition(iteration, epoch):
@@ -378,38 +456,57 @@ class TrainerExporter(object):
                                                           get_activations_fcn=get_activations_fcn)
         return eval_metrics
 
+    def write_gradient_telemetry(self, model, iteration):
+        score_pool4_bias_grad = model.score_pool4.bias.grad
+        assert len(score_pool4_bias_grad) == self.instance_problem.n_classes
+        for tag, grad in [('Z_upscore8_gradients', model.upscore8.weight.grad),
+                          ('Z_score_pool4_weight_gradients', model.score_pool4.weight.grad),
+                          ('score_pool4_bias_gradients', score_pool4_bias_grad)]:
+            self.telemetry.add_channel_summaries(tag, grad.data, iteration)
+            self.telemetry.add_channel_histograms(tag, grad.data, iteration)
+
     def run_post_val_iteration(self, imgs, inst_lbl, pred_permutations, score, sem_lbl, should_visualize,
-                               data_to_img_transformer):
+                               data_to_img_transformer, n_images_to_visualize=None):
         """
         data_to_img_transformer: img_untransformed, lbl_untransformed = f(img, lbl) : e.g. - resizes, etc.
+        n_images_to_visualize: visualize the first n images of the batch (all of them if None).  The softmax is only
+            computed for those images, and only their scores and labels are copied to the host.
         """
-        true_labels = []
-        pred_labels = []
         segmentation_visualizations = []
         score_visualizations = []
+        if not should_visualize:
+            return segmentation_visualizations, score_visualizations
 
-        softmax_scores = F.softmax(score, dim=1).data.cpu().numpy()
-        inst_lbl_pred = score.data.max(dim=1)[1].cpu().numpy()[:, :, :]
-        lbl_true_sem, lbl_true_inst = (sem_lbl.data.cpu(), inst_lbl.data.cpu())
-        if DEBUG_ASSERTS:
-            assert inst_lbl_pred.shape == lbl_true_inst.shape
-        for idx, (img, sem_lbl, inst_lbl, lp) in enumerate(zip(imgs, lbl_true_sem, lbl_true_inst, inst_lbl_pred)):
+        true_labels = []
+        n_images = score.size(0) if n_images_to_visualize is None else min(n_images_to_visualize, score.size(0))
+        for idx in range(n_images):
+            softmax_score = self.copy_to_host(F.softmax(score[idx:(idx + 1), ...], dim=1).data[0]).numpy()
+            lp = self.copy_to_host(score.data[idx].max(dim=0)[1]).numpy()
+            lbl = (self.copy_to_host(sem_lbl.data[idx]), self.copy_to_host(inst_lbl.data[idx]))
+            if DEBUG_ASSERTS:
+                assert lp.shape == tuple(lbl[1].size())
             # runtime_transformation needs to still run the resize, even for untransformed img, lbl pair
-            img_untransformed, lbl_untransformed = data_to_img_transformer(img, (sem_lbl, inst_lbl)) \
+            img_untransformed, lbl_untransformed = data_to_img_transformer(imgs[idx], lbl) \
                 if data_to_img_transformer is not None \
-                else (img, (sem_lbl, inst_lbl))
+                else (imgs[idx], lbl)
             sem_lbl_np, inst_lbl_np = lbl_untransformed
 
             pp = pred_permutations[idx, :]
             lt_combined = self.gt_tuple_to_combined(sem_lbl_np, inst_lbl_np)
             true_labels.append(lt_combined)
-            pred_labels.append(lp)
-            if should_visualize:
-                segmentation_viz, score_viz = self.visualize_one_img_prediction(
-                    img_untransformed, lp, lt_combined, pp, softmax_scores, true_labels, idx)
-                score_visualizations.append(score_viz)
-                segmentation_visualizations.append(segmentation_viz)
-        return true_labels, pred_labels, segmentation_visualizations, score_visualizations
+            segmentation_viz, score_viz = self.visualize_one_img_prediction(
+                img_untransformed, lp, lt_combined, pp, softmax_score, true_labels)
+            score_visualizations.append(score_viz)
+            segmentation_visualizations.append(segmentation_viz)
+        return segmentation_visualizations, score_visualizations
+
+    def copy_to_host(self, tensor):
+        """
+        tensor.cpu(), counted in self.n_bytes_to_host (whether or not tensor was on the GPU, so the count doesn't
+        depend on the device we profile on).
+        """
+        self.n_bytes_to_host += tensor.numel() * tensor.element_size()
+        return tensor.cpu()
 
     def compute_eval_metrics(self, label_trues, label_preds, permutations=None, single_batch=False):
         if permutations is not None:
@@ -418,8 +515,11 @@ class TrainerExporter(object):
             assert type(permutations) == list, \
                 NotImplementedError('I''m assuming permutations are a list of ndarrays from multiple batches, '
                                     'not type {}'.format(type(permutations)))
-            label_preds_permuted = [instance_utils.permute_labels(label_pred, perms)
-                                    for label_pred, perms in zip(label_preds, permutations)]
+            permutations = np.concatenate(permutations, axis=0)  # one row per image
+            assert len(permutations) == len(label_preds), \
+                'Got permutations for {} images, but {} label maps'.format(len(permutations), len(label_preds))
+            label_preds_permuted = [instance_utils.permute_labels(label_pred, permutations[idx:(idx + 1), :])
+                                    for idx, label_pred in enumerate(label_preds)]
         else:
             label_preds_permuted = label_preds
         eval_metrics_list = instanceseg.utils.misc.label_accuracy_score(label_trues, label_preds_permuted,
@@ -427,11 +527,7 @@ class TrainerExporter(object):
         return eval_metrics_list
 
     def gt_tuple_to_combined(self, sem_lbl, inst_lbl):
-        semantic_instance_class_list = self.instance_problem.semantic_instance_class_list
-        instance_count_id_list = self.instance_problem.instance_count_id_list
-        return instance_utils.combine_semantic_and_instance_labels(sem_lbl, inst_lbl,
-                                                                   semantic_instance_class_list,
-                                                                   instance_count_id_list)
+        return self.instance_problem.combine_semantic_and_instance_labels(sem_lbl, inst_lbl)
 
     @staticmethod
     def untransform_data(data_loader, img, lbl):
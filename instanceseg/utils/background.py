@@ -0,0 +1,57 @@
+import queue
+import threading
+import traceback
+
+
+class BackgroundWorker(object):
+    """
+    Runs jobs (functions of no arguments) in the order they're submitted, on one daemon thread.
+    The queue is bounded: submit blocks while max_queue_size jobs are waiting, so a slow worker slows the trainer down
+    (back-pressure) instead of letting their inputs pile up in memory.
+    An exception raised by a job is printed, and re-raised in the trainer's thread on the next submit / flush / close.
+    """
+    def __init__(self, max_queue_size=2, name='background_worker'):
+        assert max_queue_size > 0, ValueError('max_queue_size must be positive; got {}'.format(max_queue_size))
+        self.jobs = queue.Queue(maxsize=max_queue_size)
+        self.exception = None
+        self.thread = threading.Thread(target=self._run, name=name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                if job is None:  # close
+                    return
+                job()
+            except Exception as exception:
+                traceback.print_exc()
+                if self.exception is None:
+                    self.exception = exception
+            finally:
+                self.jobs.task_done()
+
+    def submit(self, job):
+        self.raise_if_failed()
+        if not self.thread.is_alive():
+            raise Exception('Background worker {} was closed'.format(self.thread.name))
+        self.jobs.put(job)
+
+    def flush(self):
+        """
+        Blocks until every submitted job has finished.
+        """
+        self.jobs.join()
+        self.raise_if_failed()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.jobs.put(None)
+            self.thread.join()
+        self.raise_if_failed()
+
+    def raise_if_failed(self):
+        if self.exception is not None:
+            exception, self.exception = self.exception, None
+            raise exception
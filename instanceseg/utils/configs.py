@@ -39,7 +39,27 @@ CONFIG_KEY_REPLACEMENTS_FOR_FILENAME = {'max_iteration': 'itr',
                                         'dataset_instance_cap': 'datacap',
                                         'export_activations': 'exp_act',
                                         'write_instance_metrics': 'instmet',
+                                        'instance_metrics_in_background': 'bgmet',
+                                        'instance_metrics_queue_size': 'metq',
+                                        'telemetry_scalar_interval': 'tel_sc',
+                                        'telemetry_summary_interval': 'tel_sum',
+                                        'telemetry_histogram_interval': 'tel_hist',
+                                        'telemetry_overhead_budget': 'tel_budget',
+                                        'loss_updates_interval': 'lu_int',
+                                        'loss_updates_mode': 'lu_mode',
+                                        'train_metrics_interval': 'trmet_int',
+                                        'precision': 'prec',
+                                        'channels_last': 'chlast',
+                                        'batch_size': 'bs',
+                                        'val_batch_size': 'val_bs',
+                                        'collate_mode': 'collate',
+                                        'bucket_by_size': 'bucket',
+                                        'bucket_size_granularity': 'bucket_gran',
+                                        'pack_dataset': 'packed',
+                                        'grad_accumulation_steps': 'accum',
                                         'loss_type': 'loss',
+                                        'matching_solver': 'solver',
+                                        'matching_solver_threads': 'solver_thr',
                                         'ordering': 'order',
                                         'reset_optim': 'ropt'
                                         }
@@ -1,3 +1,4 @@
+import functools
 import shutil
 
 import PIL.Image
@@ -146,21 +147,80 @@ def permute_instance_order(inst_lbl, n_max_per_class):
     return inst_lbl
 
 
+class LabelRemapTable(object):
+    """
+    Remaps label values (numpy array or torch tensor) with a lookup table: one gather over the label instead of a
+    masked write per value.  Build it once (e.g. - per transformer) and call remap on every label.
+    Values missing from old_values map to default_value (or to themselves, if default_value is None).
+    """
+    def __init__(self, old_values, new_values, default_value=None):
+        old_values = np.asarray(old_values, dtype=np.int64)
+        new_values = np.asarray(new_values, dtype=np.int64)
+        assert len(old_values) == len(new_values) > 0, ValueError('Need one new value per old value')
+        assert len(np.unique(old_values)) == len(old_values), ValueError('old_values has repeats: {}'.format(
+            old_values))
+        self.min_value, self.max_value = int(old_values.min()), int(old_values.max())
+        self.default_value = default_value
+        self.table = np.arange(self.min_value, self.max_value + 1, dtype=np.int64) if default_value is None \
+            else np.full(self.max_value - self.min_value + 1, default_value, dtype=np.int64)
+        self.table[old_values - self.min_value] = new_values
+        self.torch_tables = {}  # copies of table, by device
+
+    def remap(self, lbl):
+        """
+        Returns a remapped copy of lbl (same type and dtype); lbl is left untouched.
+        """
+        if torch.is_tensor(lbl):
+            return self.remap_tensor(lbl)
+        if lbl.size > 0 and lbl.min() >= self.min_value and lbl.max() <= self.max_value:
+            new_lbl = self.table[lbl if self.min_value == 0 else lbl - self.min_value]
+        else:
+            in_range = (lbl >= self.min_value) & (lbl <= self.max_value)
+            new_lbl = np.where(in_range, self.table[np.clip(lbl, self.min_value, self.max_value) - self.min_value],
+                               lbl if self.default_value is None else self.default_value)
+        return new_lbl.astype(lbl.dtype, copy=False)
+
+    def remap_tensor(self, lbl):
+        device_key = lbl.get_device() if lbl.is_cuda else -1
+        if device_key not in self.torch_tables:
+            table = torch.from_numpy(self.table)
+            self.torch_tables[device_key] = table.cuda(device_key) if lbl.is_cuda else table
+        table = self.torch_tables[device_key]
+        idxs = lbl.long()
+        if lbl.numel() > 0 and int(lbl.min()) >= self.min_value and int(lbl.max()) <= self.max_value:
+            new_lbl = torch.take(table, idxs if self.min_value == 0 else idxs - self.min_value)
+        else:
+            in_range = (idxs >= self.min_value) & (idxs <= self.max_value)
+            new_lbl = torch.take(table, idxs.clamp(self.min_value, self.max_value) - self.min_value)
+            new_lbl = torch.where(in_range, new_lbl, idxs if self.default_value is None
+                                  else torch.full_like(idxs, self.default_value))
+        return new_lbl.type_as(lbl)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['torch_tables'] = {}  # e.g. - CUDA tables when handed to loader workers
+        return state
+
+
 def remap(lbl, new_idxs):
-    if torch.is_tensor(lbl):
-        old_lbl = lbl.clone()
-    else:
-        old_lbl = lbl.copy()
-    lbl[...] = -2
-    lbl[old_lbl == -1] = -1
-    for old_class_idx, new_idx in enumerate(new_idxs):
-        lbl[old_lbl == old_class_idx] = new_idx
+    new_lbl = LabelRemapTable(old_values=list(range(len(new_idxs))) + [-1], new_values=list(new_idxs) + [-1],
+                              default_value=-2).remap(lbl)
 
     if DEBUG_ASSERT:
-        if any(lbl == -2):
-            untouched_values = old_lbl[lbl == -2]
+        if (new_lbl == -2).sum() > 0:
+            untouched_values = lbl[new_lbl == -2]
             import ipdb; ipdb.set_trace()
             raise Exception('mapping was not thorough.  No value specified for {}'.format(untouched_values[0]))
+    lbl[...] = new_lbl
+
+
+@functools.lru_cache(maxsize=None)
+def get_reduced_semantic_classes_remap_table(reduced_class_idxs):
+    """
+    reduced_class_idxs: tuple (so it can be cached).  -1 (void) stays -1; classes outside the subset go to 0.
+    """
+    return LabelRemapTable(old_values=list(reduced_class_idxs) + [-1],
+                           new_values=list(range(len(reduced_class_idxs))) + [-1], default_value=0)
 
 
 def remap_to_reduced_semantic_classes(lbl, reduced_class_idxs, map_other_classes_to_bground=True):
@@ -169,8 +229,8 @@ def remap_to_reduced_semantic_classes(lbl, reduced_class_idxs, map_other_classes
     """
     # Make sure all lbl classes can be mapped appropriately.
     if not map_other_classes_to_bground:
-        original_classes_in_this_img = [i for i in range(lbl.min(), lbl.max() + 1)
-                                        if torch.sum(lbl == i) > 0]
+        original_classes_in_this_img = [int(i) for i in (torch.unique(lbl) if torch.is_tensor(lbl)
+                                                         else np.unique(lbl))]
         bool_unique_class_in_reduced_classes = [lbl_cls in reduced_class_idxs
                                                 for lbl_cls in original_classes_in_this_img
                                                 if lbl_cls != -1]
@@ -181,15 +241,7 @@ def remap_to_reduced_semantic_classes(lbl, reduced_class_idxs, map_other_classes
             raise Exception('Image has class labels outside the subset.\n Subset: {}\n'
                             'Classes in the image:{}'.format(reduced_class_idxs,
                                                              original_classes_in_this_img))
-    if torch.is_tensor(lbl):
-        old_lbl = lbl.clone()
-    else:
-        old_lbl = lbl.copy()
-    lbl[...] = 0
-    lbl[old_lbl == -1] = -1
-    for new_idx, old_class_idx in enumerate(reduced_class_idxs):
-        lbl[old_lbl == old_class_idx] = new_idx
-    return lbl
+    return get_reduced_semantic_classes_remap_table(tuple(reduced_class_idxs)).remap(lbl)
 
 
 def get_semantic_names_and_idxs(semantic_subset, full_set):
@@ -292,33 +344,31 @@ def generate_ordered_instance_file(inst_lbl_file_unordered, sem_lbl_file, out_in
 
 
 def make_ordered_copy_of_inst_lbl(inst_lbl, sem_lbl, ordering, increasing):
-    old_inst_lbl = inst_lbl.copy()
-    unique_sem_lbls = np.unique(sem_lbl)
-    for sem_val in unique_sem_lbls[unique_sem_lbls > 0]:
-        unique_instance_idxs = np.unique(old_inst_lbl[sem_lbl == sem_val])
-        # TODO(allie): Verify it's okay that we get rid of this assert statement
-        # if DEBUG_ASSERT:
-        #     assert not np.any(unique_instance_idxs == 0)
-        unique_instance_idxs = unique_instance_idxs[np.logical_and(unique_instance_idxs > 0, unique_instance_idxs <
-                                                                   255)]  # don't remap void
-        attribute_values = []
-        for old_inst_val in unique_instance_idxs:
-            if ordering == 'size':
-                ordering_attribute = get_instance_size(sem_lbl, sem_val, old_inst_lbl, old_inst_val)
-            elif ordering == 'lr':
-                ordering_attribute = get_instance_centroid(sem_lbl, sem_val, old_inst_lbl, old_inst_val)[1]
-            else:
-                raise NotImplementedError
-            attribute_values.append(ordering_attribute)
-        increasing_ordering = [x for x in np.argsort([val for val in attribute_values])]
+    """
+    Renumbers the instances (0 < value < 255) of each semantic class (> 0) 1, 2, ... in order of size ('size') or of
+    the column of their centroid ('lr').  Writes into inst_lbl, which is returned.
+    Instance sizes and centroids come from one bincount over the combined (semantic, instance) id; the new instance
+    values are written with one lookup into a remap table.
+    """
+    is_instance = (sem_lbl > 0) & (inst_lbl > 0) & (inst_lbl < 255)  # don't remap void
+    combined_ids = sem_lbl[is_instance].astype(np.int64) * 255 + inst_lbl[is_instance]
+    sizes = np.bincount(combined_ids)
+    present_ids = np.nonzero(sizes)[0]  # sorted by semantic value, then instance value
+    if ordering == 'size':
+        attribute_values = sizes[present_ids]
+    elif ordering == 'lr':
+        column_sums = np.bincount(combined_ids, weights=np.nonzero(is_instance)[1])
+        attribute_values = column_sums[present_ids] / sizes[present_ids]
+    else:
+        raise NotImplementedError
+    remap_table = np.zeros(len(sizes), dtype=inst_lbl.dtype)
+    present_sem_vals = present_ids // 255
+    for sem_val in np.unique(present_sem_vals):
+        sem_cls_ids = present_ids[present_sem_vals == sem_val]
+        increasing_ordering = np.argsort(attribute_values[present_sem_vals == sem_val])
         size_ordering = increasing_ordering if increasing else increasing_ordering[::-1]
-        if not all([x == y for x, y in zip(size_ordering, list(range(len(size_ordering))))]):
-            print('debug: confirmed we reordered at least one instance')
-        old_inst_vals = [unique_instance_idxs[x] for x in size_ordering]
-
-        for new_inst_val_minus_1, old_inst_val in enumerate(old_inst_vals):
-            new_inst_val = new_inst_val_minus_1 + 1
-            inst_lbl[np.logical_and(sem_lbl == sem_val, old_inst_lbl == old_inst_val)] = new_inst_val
+        remap_table[sem_cls_ids[size_ordering]] = np.arange(1, len(size_ordering) + 1)
+    inst_lbl[is_instance] = remap_table[combined_ids]
     return inst_lbl
 
 
@@ -1,3 +1,6 @@
+import atexit
+import time
+
 import numpy as np
 from matplotlib import pyplot as plt
 
@@ -34,4 +37,30 @@ def log_plots(writer, tag, plot_handles, step, numbers=None):
 
         # Create an Image object
         if writer is not None:
-            writer.add_image('%s/%d' % (tag, numbers[nr]), plt_as_np_array, global_step=step)
\ No newline at end of file
+            writer.add_image('%s/%d' % (tag, numbers[nr]), plt_as_np_array, global_step=step)
+
+
+class BufferedLineWriter(object):
+    """
+    Appends lines to a file in batches instead of reopening it for every line.  Buffered lines are written every
+    max_lines lines or max_seconds seconds (whichever comes first), on flush(), and when the interpreter exits.
+    """
+    def __init__(self, filename, max_lines=100, max_seconds=60.0):
+        self.filename = filename
+        self.max_lines = max_lines
+        self.max_seconds = max_seconds
+        self.lines = []
+        self.last_flush_time = time.time()
+        atexit.register(self.flush)
+
+    def write_line(self, line):
+        self.lines.append(line)
+        if len(self.lines) >= self.max_lines or time.time() - self.last_flush_time >= self.max_seconds:
+            self.flush()
+
+    def flush(self):
+        if len(self.lines) > 0:
+            with open(self.filename, 'a') as f:
+                f.write(''.join(line + '\n' for line in self.lines))
+            self.lines = []
+        self.last_flush_time = time.time()
@@ -50,6 +50,9 @@ class InstanceProblemConfig(object):
 
         self.instance_count_id_list = get_instance_count_id_list(self.semantic_instance_class_list,
                                                                  include_channel0=self.include_instance_channel0)
+        self.semantic_instance_lookup_table = get_semantic_instance_lookup_table(self.semantic_instance_class_list,
+                                                                                 self.instance_count_id_list)
+        self.semantic_instance_lookup_table_tensors = {}  # copies of semantic_instance_lookup_table, by device
         self.model_instance_count_id_list = get_instance_count_id_list(self.model_semantic_instance_class_list,
                                                                        include_channel0=self.include_instance_channel0)
         self.instance_to_semantic_mapping_matrix = get_instance_to_semantic_mapping(
@@ -86,36 +89,92 @@ class InstanceProblemConfig(object):
         assert class_names is None or (len(class_names) == self.n_semantic_classes)
         self.semantic_class_names = class_names
 
+    def combine_semantic_and_instance_labels(self, sem_lbl, inst_lbl):
+        return apply_semantic_instance_lookup_table(sem_lbl, inst_lbl, self.semantic_instance_lookup_table,
+                                                    lookup_table_tensors=self.semantic_instance_lookup_table_tensors)
+
     def decouple_instance_result(self, instance_scores):
         # TODO(allie): implement.
         raise NotImplementedError
 
 
 def combine_semantic_and_instance_labels(sem_lbl, inst_lbl, semantic_instance_class_list, instance_count_id_list,
-                                         set_extras_to_void=True, void_value=-1):
+                                         set_extras_to_void=True, void_value=-1, lookup_table=None,
+                                         lookup_table_tensors=None):
     """
     sem_lbl is size(img); inst_lbl is size(img).  inst_lbl is just the original instance
     image (inst_lbls at coordinates of person 0 are 0)
+    lookup_table: get_semantic_instance_lookup_table(semantic_instance_class_list, instance_count_id_list) (computed
+        here if None)
+    lookup_table_tensors: see apply_semantic_instance_lookup_table
     """
     # TODO(allie): handle class overflow (from ground truth)
     assert set_extras_to_void == True, NotImplementedError
     assert sem_lbl.shape == inst_lbl.shape
+    if lookup_table is None:
+        lookup_table = get_semantic_instance_lookup_table(semantic_instance_class_list, instance_count_id_list)
+    return apply_semantic_instance_lookup_table(sem_lbl, inst_lbl, lookup_table, void_value=void_value,
+                                                lookup_table_tensors=lookup_table_tensors)
+
+
+def get_semantic_instance_lookup_table(semantic_instance_class_list, instance_count_id_list):
+    """
+    lookup_table[sem_val, inst_val] = channel index of (sem_val, inst_val); -1 where no channel has that pair.
+    Example:
+        input: [0, 1, 1, 2], [0, 1, 2, 1]
+        returns: [[0, -1, -1],
+                  [-1, 1, 2],
+                  [-1, 3, -1]]
+    """
+    semantic_vals = np.array(semantic_instance_class_list, dtype=int)
+    instance_vals = np.array(instance_count_id_list, dtype=int)
+    lookup_table = np.full((semantic_vals.max() + 1, instance_vals.max() + 1), -1, dtype=np.int64)
+    lookup_table[semantic_vals, instance_vals] = np.arange(len(semantic_vals))
+    return lookup_table
+
+
+def apply_semantic_instance_lookup_table(sem_lbl, inst_lbl, lookup_table, void_value=-1, lookup_table_tensors=None):
+    """
+    Maps every (sem_lbl, inst_lbl) pixel to its channel with one indexing pass; pixels whose pair has no channel (or
+    falls outside the table, e.g. - void) get void_value.  Works on numpy arrays and torch tensors; the result has
+    inst_lbl's type.
+    lookup_table_tensors: dict of lookup_table's tensor copies, by device (filled in here), so a table is only copied
+        to each device once
+    """
+    n_semantic_vals, n_instance_vals = lookup_table.shape
     if torch.is_tensor(inst_lbl):
-        y = inst_lbl.clone()
+        sem_lbl_long, inst_lbl_long = sem_lbl.long(), inst_lbl.long()
+        in_table = (sem_lbl_long >= 0) * (sem_lbl_long < n_semantic_vals) * \
+                   (inst_lbl_long >= 0) * (inst_lbl_long < n_instance_vals)
+        flat_idxs = sem_lbl_long.clamp(0, n_semantic_vals - 1) * n_instance_vals + \
+                    inst_lbl_long.clamp(0, n_instance_vals - 1)
+        lookup_table_tensor = get_lookup_table_tensor(lookup_table, inst_lbl, lookup_table_tensors)
+        y = lookup_table_tensor.view(-1).index_select(0, flat_idxs.view(-1)).view(inst_lbl.size())
+        y[y == -1] = void_value
+        y.masked_fill_(in_table == 0, void_value)
+        return y.type_as(inst_lbl)
     else:
-        y = inst_lbl.copy()
-    y[...] = void_value
-    unique_semantic_vals, inst_counts = np.unique(semantic_instance_class_list, return_counts=True)
-    for sem_val, n_instances_for_this_sem_cls in zip(unique_semantic_vals, inst_counts):
-        sem_inst_idxs = [i for i, s in enumerate(semantic_instance_class_list) if s == sem_val]
-        for sem_inst_idx in sem_inst_idxs:
-            inst_val = instance_count_id_list[sem_inst_idx]
-            try:
-                y[(sem_lbl == int(sem_val)) * (inst_lbl == int(inst_val))] = sem_inst_idx
-            except:
-                import ipdb; ipdb.set_trace()
-                raise
-    return y
+        sem_lbl_int, inst_lbl_int = np.asarray(sem_lbl).astype(int), np.asarray(inst_lbl).astype(int)
+        in_table = (sem_lbl_int >= 0) & (sem_lbl_int < n_semantic_vals) & \
+                   (inst_lbl_int >= 0) & (inst_lbl_int < n_instance_vals)
+        y = lookup_table[np.clip(sem_lbl_int, 0, n_semantic_vals - 1), np.clip(inst_lbl_int, 0, n_instance_vals - 1)]
+        y[(y == -1) | ~in_table] = void_value
+        return y.astype(np.asarray(inst_lbl).dtype)
+
+
+def get_lookup_table_tensor(lookup_table, lbl, lookup_table_tensors=None):
+    """
+    lookup_table as a tensor on lbl's device; taken from / added to lookup_table_tensors (by device) if given.
+    """
+    device_key = lbl.get_device() if lbl.is_cuda else -1
+    if lookup_table_tensors is not None and device_key in lookup_table_tensors:
+        return lookup_table_tensors[device_key]
+    lookup_table_tensor = torch.from_numpy(lookup_table)
+    if lbl.is_cuda:
+        lookup_table_tensor = lookup_table_tensor.cuda(device_key)
+    if lookup_table_tensors is not None:
+        lookup_table_tensors[device_key] = lookup_table_tensor
+    return lookup_table_tensor
 
 
 def get_semantic_instance_class_list(n_channels_by_semantic_id):
@@ -191,20 +250,57 @@ def get_instance_to_semantic_mapping(n_instances_by_semantic_id, as_numpy=False)
 
 
 def permute_scores(score, pred_permutations):
-    score_permuted_to_match = score.clone()
-    for ch in range(score.size(1)):  # NOTE(allie): iterating over channels, but maybe should iterate over
-        # batch size?
-        score_permuted_to_match[:, ch, :, :] = score[:, pred_permutations[:, ch], :, :]
-    return score_permuted_to_match
+    """
+    score: N x C x H x W; pred_permutations: N x C
+    score_permuted_to_match[n, c, :, :] = score[n, pred_permutations[n, c], :, :] (one gather for the whole batch)
+    """
+    n_images, n_channels = pred_permutations.shape
+    assert score.size(0) == n_images and score.size(1) == n_channels
+    channel_idxs = torch.from_numpy(np.asarray(pred_permutations, dtype=np.int64))
+    if score.is_cuda:
+        channel_idxs = channel_idxs.cuda()
+    channel_idxs = channel_idxs.view(n_images, n_channels, 1, 1).expand_as(score)
+    return score.gather(1, channel_idxs)
+
+
+def get_inverse_permutations(permutations):
+    """
+    permutations: N x C (each row a permutation of range(C))
+    returns inverse_permutations, where inverse_permutations[n, permutations[n, c]] = c
+    """
+    permutations = np.asarray(permutations, dtype=int)
+    inverse_permutations = np.empty_like(permutations)
+    image_idxs = np.arange(permutations.shape[0])[:, np.newaxis]
+    inverse_permutations[image_idxs, permutations] = np.arange(permutations.shape[1])[np.newaxis, :]
+    return inverse_permutations
 
 
 def permute_labels(label_preds, permutations):
+    """
+    Relabels predictions so pixels predicted as channel permutations[n, c] get label c.
+    label_preds: N x H x W with permutations N x C (row n permutes image n), or a single H x W image with 1 x C
+    Labels outside range(C) are left as they are.
+    """
+    inverse_permutations = get_inverse_permutations(permutations)
+    n_images, n_channels = inverse_permutations.shape
+    single_image = len(label_preds.shape) == 2
+    if single_image:
+        assert n_images == 1, 'A single image should come with a single (1 x C) permutation'
+    else:
+        assert label_preds.shape[0] == n_images, \
+            'Got {} permutations for {} images'.format(n_images, label_preds.shape[0])
+    # Index into the flattened inverse permutations: row n starts at n * C
+    image_offsets = (np.arange(n_images) * n_channels).reshape((-1,) + (1,) * (len(label_preds.shape) - 1)) \
+        if not single_image else 0
     if torch.is_tensor(label_preds):
-        label_preds_permuted = label_preds.clone()
+        in_range = (label_preds >= 0) * (label_preds < n_channels)
+        flat_idxs = label_preds.long().clamp(0, n_channels - 1) + \
+            (torch.from_numpy(image_offsets).type_as(label_preds.long()) if not single_image else 0)
+        inverse_permutations = torch.from_numpy(inverse_permutations.reshape(-1)).type_as(label_preds)
+        label_preds_permuted = inverse_permutations.index_select(0, flat_idxs.view(-1)).view(label_preds.size())
+        return torch.where(in_range, label_preds_permuted, label_preds)
     else:
-        label_preds_permuted = label_preds.copy()
-    for idx in range(permutations.shape[0]):
-        permutation = permutations[idx, :]
-        for new_channel, old_channel in enumerate(permutation):
-            label_preds_permuted[label_preds == old_channel] = new_channel
-    return label_preds_permuted
+        in_range = (label_preds >= 0) & (label_preds < n_channels)
+        flat_idxs = np.clip(label_preds, 0, n_channels - 1) + image_offsets
+        label_preds_permuted = np.take(inverse_permutations.reshape(-1), flat_idxs).astype(label_preds.dtype)
+        return np.where(in_range, label_preds_permuted, label_preds)
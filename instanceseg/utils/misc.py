@@ -32,6 +32,11 @@ def label_accuracy_score(label_trues, label_preds, n_class=None):
     hist = np.zeros((n_class, n_class))
     for lt, lp in zip(label_trues, label_preds):
         hist += _fast_hist(lt.flatten(), lp.flatten(), n_class)
+    return label_accuracy_score_from_hist(hist)
+
+
+def label_accuracy_score_from_hist(hist):
+    """Same as label_accuracy_score, from an already-accumulated n_class x n_class histogram (see _fast_hist)."""
     acc = np.diag(hist).sum() / hist.sum()
     acc_cls = np.diag(hist) / hist.sum(axis=1)
     acc_cls = np.nanmean(acc_cls)
@@ -0,0 +1,82 @@
+"""
+Opt-in reduced precision / channels-last training.  Everything here falls back to plain fp32 (with a warning) on torch
+versions without the feature (torch.autocast, torch.channels_last, torch.cuda.amp.GradScaler).
+"""
+import contextlib
+
+import torch
+
+PRECISIONS = ('fp32', 'bf16', 'fp16', 'auto')  # 'auto': fp16 on the GPU, bf16 on the CPU
+
+
+def supports_autocast():
+    return hasattr(torch, 'autocast')
+
+
+def supports_channels_last():
+    return hasattr(torch, 'channels_last')
+
+
+def get_autocast_dtype_name(precision, cuda):
+    assert precision in PRECISIONS, ValueError('precision must be one of {}; got {}'.format(PRECISIONS, precision))
+    if precision == 'auto':
+        return 'fp16' if cuda else 'bf16'
+    return precision
+
+
+def resolve_precision(precision, cuda):
+    """
+    The precision we'll actually train in: precision, or 'fp32' if this torch can't autocast to it.
+    """
+    precision = get_autocast_dtype_name(precision, cuda)
+    if precision != 'fp32' and not supports_autocast():
+        print(Warning('torch {} has no autocast; training in fp32 instead of {}'.format(torch.__version__, precision)))
+        return 'fp32'
+    if precision == 'fp16' and not cuda:
+        print(Warning('fp16 autocast needs a GPU; training in bf16 instead'))
+        return 'bf16'
+    return precision
+
+
+@contextlib.contextmanager
+def no_op_context():
+    yield
+
+
+def autocast(precision, cuda):
+    """
+    Context to run the forward pass in; precision from resolve_precision.
+    Losses (in particular, the matching costs) should be computed outside it, on scores cast back to fp32.
+    """
+    if precision == 'fp32':
+        return no_op_context()
+    return torch.autocast(device_type='cuda' if cuda else 'cpu',
+                          dtype=torch.float16 if precision == 'fp16' else torch.bfloat16)
+
+
+def to_channels_last(module_or_tensor):
+    if not supports_channels_last():
+        return module_or_tensor
+    return module_or_tensor.to(memory_format=torch.channels_last)
+
+
+class LossScaler(object):
+    """
+    Dynamic loss scaling for fp16 (torch.cuda.amp.GradScaler); a pass-through for every other precision.
+    Usage: scaler.scale(loss).backward(); scaler.step(optimizer); scaler.update()
+    """
+    def __init__(self, precision):
+        self.grad_scaler = torch.cuda.amp.GradScaler() if precision == 'fp16' else None
+
+    def scale(self, loss):
+        return loss if self.grad_scaler is None else self.grad_scaler.scale(loss)
+
+    def step(self, optimizer):
+        if self.grad_scaler is None:
+            optimizer.step()
+        else:
+            self.grad_scaler.step(optimizer)  # unscales the gradients first; skips the step if they overflowed
+
+    def update(self):
+        if self.grad_scaler is not None:
+            self.grad_scaler.update()
@@ -0,0 +1,50 @@
+"""
+Micro-benchmark of the linear assignment backends used by the matching loss (instanceseg.losses.linear_assignment).
+Times one solve per random K x K cost matrix for K (instances per class) in 2..50, and checks every available backend
+finds an assignment with the same total cost as the first one.
+"""
+import argparse
+import timeit
+
+import numpy as np
+
+from instanceseg.losses import linear_assignment, match
+
+
+def available_solvers():
+    solvers = ['numpy']
+    if linear_assignment.linear_sum_assignment is not None:
+        solvers.append('scipy')
+    if match.pywrapgraph is not None:
+        solvers.append('ortools')
+    return solvers
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_instances', type=int, nargs='+', default=[2, 5, 10, 20, 50])
+    parser.add_argument('--n_trials', type=int, default=100)
+    args = parser.parse_args()
+
+    solvers = available_solvers()
+    rng = np.random.RandomState(0)
+    print('{:>6s} '.format('K') + ' '.join('{:>14s}'.format(s + ' (us)') for s in solvers))
+    for n_instances in args.n_instances:
+        cost_matrices = [rng.rand(n_instances, n_instances) for _ in range(args.n_trials)]
+        for cost_matrix in cost_matrices:
+            total_costs = []
+            for solver_name in solvers:
+                pred_for_gt = linear_assignment.get_matching_solver(solver_name)(cost_matrix)
+                total_costs.append(cost_matrix[pred_for_gt, np.arange(n_instances)].sum())
+            assert np.allclose(total_costs, total_costs[0]), \
+                ValueError('Solvers disagree on optimal cost: {}'.format(dict(zip(solvers, total_costs))))
+        timings = []
+        for solver_name in solvers:
+            solver = linear_assignment.get_matching_solver(solver_name)
+            seconds = timeit.timeit(lambda: [solver(c) for c in cost_matrices], number=1)
+            timings.append(1e6 * seconds / args.n_trials)
+        print('{:>6d} '.format(n_instances) + ' '.join('{:>14.1f}'.format(t) for t in timings))
+
+
+if __name__ == '__main__':
+    main()
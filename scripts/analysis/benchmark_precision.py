@@ -0,0 +1,81 @@
+"""
+CPU benchmark of FCN8sInstance training steps (forward, fp32 loss, backward, SGD step) in fp32 and the reduced
+precision / channels-last modes of instanceseg.utils.precision.  Reports time per step, the speedup over fp32 and how
+far each mode's scores are from fp32's.
+"""
+import argparse
+import timeit
+
+import torch
+import torch.nn.functional as F
+
+import instanceseg
+from instanceseg.utils import precision as precision_utils
+
+
+def make_model(n_semantic_classes, n_instances_per_class):
+    semantic_instance_class_list = [0] + [sem_cls for sem_cls in range(1, n_semantic_classes)
+                                          for _ in range(n_instances_per_class)]
+    torch.manual_seed(0)
+    return instanceseg.models.FCN8sInstance(semantic_instance_class_list=semantic_instance_class_list,
+                                            map_to_semantic=False, include_instance_channel0=False)
+
+
+def train_step(model, optim, loss_scaler, img, target, precision):
+    optim.zero_grad()
+    with precision_utils.autocast(precision, cuda=False):
+        score = model(img)
+    loss = F.cross_entropy(score.float(), target)
+    loss_scaler.scale(loss).backward()
+    loss_scaler.step(optim)
+    loss_scaler.update()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--image_size', type=int, nargs=2, default=[128, 128])
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--n_semantic_classes', type=int, default=3)
+    parser.add_argument('--n_instances_per_class', type=int, default=4)
+    parser.add_argument('--n_steps', type=int, default=5)
+    parser.add_argument('--n_threads', type=int, default=None)
+    args = parser.parse_args()
+    if args.n_threads is not None:
+        torch.set_num_threads(args.n_threads)
+
+    img = torch.randn(args.batch_size, 3, *args.image_size)
+    modes = [('fp32', False), ('fp32', True)]
+    if precision_utils.supports_autocast():
+        modes += [('bf16', False), ('bf16', True)]
+    else:
+        print('torch {} has no autocast; only benchmarking fp32'.format(torch.__version__))
+
+    reference_scores, fp32_seconds = None, None
+    print('{:>8s} {:>13s} {:>12s} {:>8s} {:>14s}'.format('mode', 'channels_last', 'ms / step', 'speedup',
+                                                          'max |score diff|'))
+    for precision, channels_last in modes:
+        model = make_model(args.n_semantic_classes, args.n_instances_per_class)
+        mode_img = precision_utils.to_channels_last(img) if channels_last else img
+        if channels_last:
+            model = precision_utils.to_channels_last(model)
+        model.eval()
+        with torch.no_grad(), precision_utils.autocast(precision, cuda=False):
+            scores = model(mode_img).float()
+        if reference_scores is None:
+            reference_scores = scores
+        target = reference_scores.max(dim=1)[1]
+        model.train()
+        optim = torch.optim.SGD(model.parameters(), lr=1e-10, momentum=0.99)
+        loss_scaler = precision_utils.LossScaler(precision)
+        train_step(model, optim, loss_scaler, mode_img, target, precision)  # warm up
+        seconds = timeit.timeit(lambda: train_step(model, optim, loss_scaler, mode_img, target, precision),
+                                number=args.n_steps) / args.n_steps
+        if fp32_seconds is None:
+            fp32_seconds = seconds
+        print('{:>8s} {:>13s} {:>12.1f} {:>7.2f}x {:>14.4f}'.format(
+            precision, str(channels_last), 1e3 * seconds, fp32_seconds / seconds,
+            float((scores - reference_scores).abs().max())))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""
+CPU benchmark of the runtime transformation (runtime_transformer_factory) on one synthetic sample, with the label
+transformers run one by one and fused into one lookup (GenericSequenceRuntimeDatasetTransformer's
+fuse_label_transformers).  Reports time per sample and checks the two give the same output.
+"""
+import argparse
+import timeit
+
+import numpy as np
+import torch
+
+from instanceseg.datasets import runtime_transformations
+
+
+def make_sample(image_size, n_semantic_classes, n_instances, seed=0):
+    """
+    img: random HxWx3 uint8; lbl: n_instances rectangles of random semantic classes on background, with a void border
+    """
+    rng = np.random.RandomState(seed)
+    height, width = image_size
+    img = rng.randint(0, 255, size=(height, width, 3)).astype(np.uint8)
+    sem_lbl = np.zeros((height, width), dtype=np.int32)
+    inst_lbl = np.zeros((height, width), dtype=np.int32)
+    n_instances_by_class = [0 for _ in range(n_semantic_classes)]
+    for _ in range(n_instances):
+        sem_val = rng.randint(1, n_semantic_classes)
+        n_instances_by_class[sem_val] += 1
+        y, x = rng.randint(0, height // 2), rng.randint(0, width // 2)
+        h, w = rng.randint(height // 20, height // 2), rng.randint(width // 20, width // 2)
+        sem_lbl[y:(y + h), x:(x + w)] = sem_val
+        inst_lbl[y:(y + h), x:(x + w)] = n_instances_by_class[sem_val]
+    sem_lbl[:2, :], inst_lbl[:2, :] = -1, -1
+    return img, (sem_lbl, inst_lbl)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--image_size', type=int, nargs=2, default=[1024, 2048])
+    parser.add_argument('--n_semantic_classes', type=int, default=9)
+    parser.add_argument('--n_instances', type=int, default=40)
+    parser.add_argument('--semantic_subset', type=int, nargs='+', default=[0, 1, 2, 3, 5, 8])
+    parser.add_argument('--n_inst_cap_per_class', type=int, default=10)
+    parser.add_argument('--n_samples', type=int, default=10)
+    args = parser.parse_args()
+
+    img, (sem_lbl, inst_lbl) = make_sample(args.image_size, args.n_semantic_classes, args.n_instances)
+    outputs, sequential_seconds = [], None
+    print('{:>10s} {:>14s} {:>8s} {:>21s}'.format('labels', 'ms / sample', 'speedup', 'labels only: ms / sample'))
+    for fuse_label_transformers in (False, True):
+        runtime_transformation = runtime_transformations.runtime_transformer_factory(
+            resize=False, reduced_class_idxs=args.semantic_subset, map_other_classes_to_bground=True,
+            n_inst_cap_per_class=args.n_inst_cap_per_class)
+        runtime_transformation.fuse_label_transformers = fuse_label_transformers
+        # the label transformers alone (everything after the conversion to tensors)
+        label_transformation = runtime_transformations.GenericSequenceRuntimeDatasetTransformer(
+            runtime_transformation.transformer_sequence[1:], fuse_label_transformers=fuse_label_transformers)
+        sem_lbl_tensor, inst_lbl_tensor = torch.from_numpy(sem_lbl).long(), torch.from_numpy(inst_lbl).long()
+
+        def transform_sample():
+            return runtime_transformation.transform(img, (sem_lbl.copy(), inst_lbl.copy()))
+
+        def transform_lbl():
+            return label_transformation.transform(None, (sem_lbl_tensor.clone(), inst_lbl_tensor.clone()))
+        outputs.append(transform_sample())  # warm up (builds the fused lookup)
+        transform_lbl()
+        seconds = timeit.timeit(transform_sample, number=args.n_samples) / args.n_samples
+        lbl_seconds = timeit.timeit(transform_lbl, number=args.n_samples) / args.n_samples
+        if sequential_seconds is None:
+            sequential_seconds = seconds
+        print('{:>10s} {:>14.1f} {:>7.2f}x {:>21.1f}'.format('fused' if fuse_label_transformers else 'sequential',
+                                                          1e3 * seconds, sequential_seconds / seconds,
+                                                          1e3 * lbl_seconds))
+    (sequential_img, sequential_lbl), (fused_img, fused_lbl) = outputs
+    assert torch.equal(sequential_img, fused_img) and \
+        all(torch.equal(s, f) for s, f in zip(sequential_lbl, fused_lbl)), \
+        ValueError('Fused output differs from the sequential output')
+    print('Fused output is identical to the sequential output.')
+
+
+if __name__ == '__main__':
+    main()
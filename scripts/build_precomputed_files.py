@@ -0,0 +1,59 @@
+"""
+Builds the precomputed files (see instanceseg.datasets.precomputed_file_builder) of each split of a dataset, so
+training only looks them up.  Rerun it after the labels change: only the files whose sources changed get rebuilt.
+    python scripts/build_precomputed_files.py cityscapes --n_processes 8
+"""
+import argparse
+import os
+
+from instanceseg.datasets import cityscapes, dataset_registry, precomputed_file_builder, voc
+from instanceseg.datasets.precomputed_file_transformations import GenericSequencePrecomputedDatasetFileTransformer, \
+    precomputed_file_transformer_factory
+
+DEFAULT_SPLITS = {'voc': ['train', 'seg11valid'], 'cityscapes': ['train', 'val']}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('dataset', choices=sorted(DEFAULT_SPLITS.keys()))
+    parser.add_argument('--splits', nargs='+', default=None)
+    parser.add_argument('--dataset_path', default=None, help='defaults to the dataset\'s default path')
+    parser.add_argument('--ordering', default=None, help='defaults to the dataset\'s default config')
+    parser.add_argument('--n_processes', type=int, default=None, help='defaults to the number of CPUs')
+    return parser.parse_args()
+
+
+def get_raw_files_and_transformation(dataset, dataset_path, split, ordering):
+    """
+    The files before any precomputed file transformation, and every transformation the dataset runs on them (for
+    Cityscapes, the raw dataset's own conversion to train ids, then the configured one).
+    """
+    transformation = precomputed_file_transformer_factory(ordering=ordering)
+    if dataset == 'voc':
+        return voc.get_raw_voc_files(dataset_path, split), transformation
+    elif dataset == 'cityscapes':
+        transformer_sequence = list(cityscapes.RawCityscapesBase.precomputed_file_transformer.transformer_sequence)
+        if transformation is not None:
+            transformer_sequence.append(transformation)
+        return cityscapes.get_raw_cityscapes_files(dataset_path, split), \
+            GenericSequencePrecomputedDatasetFileTransformer(transformer_sequence=transformer_sequence)
+    else:
+        raise ValueError('No precomputed files for dataset {}'.format(dataset))
+
+
+def main():
+    args = parse_args()
+    registered_dataset = dataset_registry.REGISTRY[args.dataset]
+    dataset_path = args.dataset_path or registered_dataset.dataset_path
+    ordering = args.ordering or registered_dataset.default_config['ordering']
+    for split in args.splits or DEFAULT_SPLITS[args.dataset]:
+        data_files, transformation = get_raw_files_and_transformation(args.dataset, dataset_path, split, ordering)
+        manifest_file = os.path.join(dataset_path, 'precomputed_manifest_{}.json'.format(split))
+        print('Building the precomputed files of {} {} ({} images; manifest: {})'.format(
+            args.dataset, split, len(data_files), manifest_file))
+        precomputed_file_builder.build_precomputed_files(transformation, data_files, manifest_file,
+                                                         n_processes=args.n_processes)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,17 @@
 class PARAM_CLASSIFICATIONS(object):
-    optim = {'optim', 'max_iteration', 'lr', 'momentum', 'weight_decay', 'clip', 'reset_optim'}
-    export = {'interval_validate', 'export_activations', 'activation_layers_to_export', 'write_instance_metrics'}
-    loss = {'matching', 'size_average', 'loss_type', 'lr_scheduler'}
+    optim = {'optim', 'max_iteration', 'lr', 'momentum', 'weight_decay', 'clip', 'reset_optim',
+             'grad_accumulation_steps'}
+    export = {'interval_validate', 'export_activations', 'activation_layers_to_export', 'write_instance_metrics',
+              'instance_metrics_in_background', 'instance_metrics_queue_size', 'telemetry_scalar_interval',
+              'telemetry_summary_interval', 'telemetry_histogram_interval', 'telemetry_overhead_budget',
+              'loss_updates_interval', 'loss_updates_mode', 'train_metrics_interval'}
+    loss = {'matching', 'size_average', 'loss_type', 'lr_scheduler', 'matching_solver', 'matching_solver_threads'}
     data = {'semantic_only_labels', 'set_extras_to_void', 'semantic_subset', 'ordering', 'sampler', 'dataset',
-            'dataset_instance_cap', 'resize', 'resize_size', 'dataset_path'}
+            'dataset_instance_cap', 'resize', 'resize_size', 'dataset_path', 'batch_size', 'val_batch_size',
+            'collate_mode', 'bucket_by_size', 'bucket_size_granularity', 'pack_dataset'}
     problem_config = {'n_instances_per_class', 'single_instance'}
     model = {'initialize_from_semantic', 'bottleneck_channel_capacity', 'score_multiplier', 'freeze_vgg',
-             'map_to_semantic', 'augment_semantic', 'use_conv8', 'use_attn_layer'}
+             'map_to_semantic', 'augment_semantic', 'use_conv8', 'use_attn_layer', 'precision', 'channels_last'}
     misc = {'interactive_dataloader'}
 
 
@@ -18,16 +23,19 @@ _default_config = dict(
     matching=True,
     size_average=True,
     loss_type='cross_entropy',  # 'cross_entropy' ('xent'), 'softiou'
+    matching_solver='scipy',  # 'numpy', 'scipy', 'ortools' (see instanceseg.losses.linear_assignment)
+    matching_solver_threads=1,  # > 1: solve a batch's assignment problems on a thread pool (pays off for big batches)
 
     # optim
     optim='sgd',
     reset_optim=True,  # with resume
-    max_iteration=100000,
+    max_iteration=100000,  # (mini-batches)
     lr=1.0e-12,
     momentum=0.99,
     weight_decay=0.0005,
     clip=1e20,
     lr_scheduler=None,  #'plateau',
+    grad_accumulation_steps=1,  # one optimizer step per n mini-batches (effective batch size: n * batch_size)
 
     # export
     interval_validate=4000,
@@ -36,6 +44,15 @@ _default_config = dict(
                                  'conv3.pool', 'conv4.pool', 'conv5.pool', 'drop6', 'fc7', 'drop7', 'upscore8'),
                                 # 'conv1x1_instance_to_semantic'
     write_instance_metrics=False,
+    instance_metrics_in_background=False,  # compute / write instance metrics on a background thread
+    instance_metrics_queue_size=2,  # validations that can wait for the background thread before training blocks
+    telemetry_scalar_interval=1,  # per-iteration training scalars, every n iterations (0: never)
+    telemetry_summary_interval=10,  # per-channel gradient min / max / mean
+    telemetry_histogram_interval=100,  # per-channel gradient histograms, every n iterations (0: never)
+    telemetry_overhead_budget=5.0,  # % of step time; telemetry is written less often if it takes longer
+    loss_updates_interval=1,  # log the loss improvement / reassignments of an optimizer step every n iterations
+    loss_updates_mode='forward',  # 'forward' (extra eval-mode forward pass), 'next_forward' (reuse the next one)
+    train_metrics_interval=1,  # training accuracy / mIOU are accumulated over and logged every n iterations (0: off)
 
     # data
     dataset=None,
@@ -46,6 +63,12 @@ _default_config = dict(
     sampler=None,
     resize=False,
     resize_size=None,
+    batch_size=1,  # training mini-batch size (matching is still per image)
+    val_batch_size=1,  # for val and train_for_val
+    collate_mode='pad',  # 'pad' (labels with a pad value, not void), 'crop': how different image sizes are batched
+    bucket_by_size=False,  # only batch together images of the same size (sizes cached next to the dataset)
+    bucket_size_granularity=1,  # ... after rounding them up to a multiple of this
+    pack_dataset=False,  # decode (and resize) every image once into a memory-mapped pack next to the dataset
     # semantic_only_labels=False,
     # set_extras_to_void=True,
 
@@ -62,6 +85,8 @@ _default_config = dict(
     augment_semantic=False,
     use_conv8=False,
     use_attn_layer=False,
+    precision='fp32',  # 'fp32', 'bf16', 'fp16', 'auto' (fp16 on GPU, bf16 on CPU); autocast forward pass
+    channels_last=False,  # channels-last memory format for the model and its input
 )
 
 
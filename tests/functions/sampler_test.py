@@ -1,9 +1,10 @@
 import os
 
+import numpy as np
 import torch.utils.data
 import tqdm
 
-from instanceseg.datasets import dataset_generator_registry
+from instanceseg.datasets import dataset_generator_registry, dataset_statistics
 from scripts.configurations import voc_cfg
 from instanceseg.datasets import sampler
 
@@ -60,6 +61,44 @@ def test_single_image_sampler(train_dataset, loader_kwargs, image_index=0):
                                                                           train_loader_shuffled)])
 
 
+def check_size_bucket_sampler(train_dataset, loader_kwargs, n_images=20, batch_size=4):
+    bool_index_subset = [idx < n_images for idx in range(len(train_dataset))]
+    sequential_sampler = sampler.sampler_factory(sequential=True, bool_index_subset=bool_index_subset)(train_dataset)
+    image_sizes = dataset_statistics.compute_image_sizes([train_dataset[idx] for idx in range(n_images)])
+    batch_sampler = sampler.SizeBucketBatchSampler(sequential_sampler, batch_size, image_sizes)
+    train_loader = torch.utils.data.DataLoader(train_dataset, batch_sampler=batch_sampler, **loader_kwargs)
+
+    batches = list(batch_sampler)
+    assert batches == list(batch_sampler)  # deterministic
+    assert sorted([idx for batch in batches for idx in batch]) == list(range(n_images))
+    assert len(train_loader) == len(batches)
+    for batch, (d, (sem_lbl, inst_lbl)) in zip(batches, train_loader):  # same-size images: no collation needed
+        assert d.size(0) == len(batch)
+        assert all([tuple(image_sizes[idx]) == tuple(d.size()[-2:]) for idx in batch])
+
+
+def test_size_bucket_sampler():
+    """
+    check_size_bucket_sampler on a small synthetic dataset of known image sizes (no dataset on disk needed)
+    """
+    sizes = [(8, 10), (6, 12), (8, 10), (5, 5), (6, 12), (8, 10), (8, 10), (8, 10), (5, 5), (6, 12), (8, 10)]
+    train_dataset = [(torch.randn(3, height, width), (torch.zeros(height, width).long(),
+                                                      torch.zeros(height, width).long()))
+                     for height, width in sizes]
+    check_size_bucket_sampler(train_dataset, {}, n_images=len(sizes) - 1, batch_size=2)
+
+    # Buckets fill in the order the index sampler returns the indices; shuffled passes still cover every index once
+    image_sizes = np.array(sizes)
+    batch_sampler = sampler.SizeBucketBatchSampler(sampler.sampler_factory(sequential=False)(train_dataset), 3,
+                                                   image_sizes)
+    batches = list(batch_sampler)
+    assert not batch_sampler.sequential
+    assert len(batches) == len(batch_sampler) == 4  # (8, 10): 3 + 3; (6, 12): 3; (5, 5): 2
+    assert sorted([idx for batch in batches for idx in batch]) == list(range(len(sizes)))
+    assert all([len(set(tuple(image_sizes[idx]) for idx in batch)) == 1 for batch in batches])
+    assert len(sampler.SizeBucketBatchSampler(range(len(sizes)), 3, image_sizes, drop_last=True)) == 3
+
+
 def main():
     # Setup
     cfg = voc_cfg.get_default_config()
@@ -77,6 +116,8 @@ def main():
     test_single_image_sampler(train_dataset, loader_kwargs, image_index=10)
     print('Running vanilla test')
     test_vanilla_sampler(train_dataset, loader_kwargs)
+    print('Running size bucket test')
+    check_size_bucket_sampler(train_dataset, loader_kwargs)
 
 
 if __name__ == '__main__':
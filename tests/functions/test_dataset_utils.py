@@ -1,6 +1,7 @@
 import os.path as osp
 from instanceseg.utils import datasets
 import numpy as np
+import torch
 
 here = osp.dirname(__file__)
 
@@ -51,6 +52,41 @@ def test_lr_ordering_voc():
     print('PASSED')
 
 
+def test_size_ordering():
+    sem_lbl = np.zeros((20, 30), dtype=np.int32)
+    inst_lbl = np.zeros((20, 30), dtype=np.int32)
+    # semantic class 1: instances 1, 2, 3 with 4, 30, 12 pixels; semantic class 2: instances 1, 2 with 6, 2 pixels
+    for sem_val, inst_val, (y, x, height, width) in [(1, 1, (0, 0, 2, 2)), (1, 2, (5, 0, 5, 6)), (1, 3, (0, 10, 3, 4)),
+                                                      (2, 1, (15, 15, 2, 3)), (2, 2, (15, 25, 1, 2))]:
+        sem_lbl[y:(y + height), x:(x + width)] = sem_val
+        inst_lbl[y:(y + height), x:(x + width)] = inst_val
+    inst_lbl[19, 29] = -1  # void stays void
+    inst_lbl_ordered = datasets.make_ordered_copy_of_inst_lbl(inst_lbl.copy(), sem_lbl, ordering='size',
+                                                             increasing=False)
+    expected_remapping = {(1, 1): 3, (1, 2): 1, (1, 3): 2, (2, 1): 1, (2, 2): 2, (0, 0): 0, (0, -1): -1}
+    for (sem_val, inst_val), new_inst_val in expected_remapping.items():
+        assert np.all(inst_lbl_ordered[(sem_lbl == sem_val) & (inst_lbl == inst_val)] == new_inst_val), \
+            ValueError('Instance {} of class {} should have become {}'.format(inst_val, sem_val, new_inst_val))
+    print('PASSED')
+
+
+def test_label_remap_table():
+    remap_table = datasets.LabelRemapTable(old_values=[-1, 0, 3, 5], new_values=[-1, 0, 1, 2], default_value=0)
+    identity_remap_table = datasets.LabelRemapTable(old_values=[3, 5], new_values=[5, 3])
+    lbl = np.array([[-1, 0, 3, 4], [5, 6, 3, 100]], dtype=np.int32)
+    for remap_table, expected_lbl in [(remap_table, [[-1, 0, 1, 0], [2, 0, 1, 0]]),
+                                      (identity_remap_table, [[-1, 0, 5, 4], [3, 6, 5, 100]])]:
+        for l in (lbl, torch.from_numpy(lbl).long()):
+            remapped_lbl = remap_table.remap(l)
+            assert type(remapped_lbl) == type(l) and remapped_lbl.dtype == l.dtype
+            assert np.array_equal(np.array(remapped_lbl), np.array(expected_lbl)), ValueError(
+                'Expected {}; got {}'.format(expected_lbl, remapped_lbl))
+    assert lbl[0, 2] == 3, ValueError('remap should leave the label untouched')
+    print('PASSED')
+
+
 if __name__ == '__main__':
     test_lr_ordering_voc()
+    test_size_ordering()
+    test_label_remap_table()
 
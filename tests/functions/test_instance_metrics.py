@@ -0,0 +1,158 @@
+"""
+Unit tests of the streamed instance metrics (they don't need a dataset or a trainer).
+"""
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.utils.data import DataLoader
+
+from instanceseg.datasets import collate
+from instanceseg.train import metrics
+from instanceseg.utils import instance_utils, misc
+
+
+def test_padded_stream_matches_per_image_baseline_with_void():
+    problem_config = instance_utils.InstanceProblemConfig(n_instances_by_semantic_id=[1, 3, 2])
+    semantic_instance_labels = problem_config.semantic_instance_class_list
+    n_channels = len(semantic_instance_labels)
+    samples = []
+    for height, width in [(10, 12), (8, 15), (11, 9)]:
+        sem_lbl = torch.from_numpy(np.random.randint(-1, 3, size=(height, width))).long()
+        inst_lbl = torch.from_numpy(np.random.randint(1, 3, size=(height, width))).long()
+        inst_lbl[sem_lbl == 0] = 0
+        inst_lbl[sem_lbl == -1] = -1
+        samples.append((torch.randn(n_channels, height, width), [sem_lbl, inst_lbl]))
+    data_loader = DataLoader(samples, batch_size=len(samples), collate_fn=collate.pad_collate)
+    instance_metrics = metrics.InstanceMetrics(data_loader, problem_config, component_loss_function=lambda *a: None)
+    instance_metrics.reset_stream()
+    for scores, (sem_lbl, inst_lbl) in data_loader:  # pixelwise 'model': the scores themselves
+        assert (sem_lbl == collate.LBL_PAD_VALUE).sum() > 0 and (sem_lbl == -1).sum() > 0
+        instance_metrics.update(scores, sem_lbl, inst_lbl)
+    instance_metrics.compute_metrics_from_stream()
+
+    # What compile_scores_and_losses + get_aggregated_scalar_metrics_as_nested_dict gave: every pixel of every image
+    # (void included) counts
+    scores = torch.cat([img_scores.view(n_channels, -1) for img_scores, _ in samples], dim=1)
+    assignments = scores.max(dim=0)[1]
+    softmaxed_scores = F.softmax(scores, dim=0)
+    sem_cls_of_channel = torch.LongTensor(semantic_instance_labels)
+    softmax_per_sem_cls = torch.zeros(problem_config.n_semantic_classes, scores.size(1)).index_add_(
+        0, sem_cls_of_channel, softmaxed_scores)
+    for idx, (img_scores, _) in enumerate(samples):
+        img_assignments = img_scores.max(dim=0)[1]
+        for channel_idx in range(n_channels):
+            assert int(instance_metrics.n_pixels_assigned_per_channel[idx, channel_idx]) == \
+                int((img_assignments == channel_idx).sum())
+    for channel_idx, sem_cls in enumerate(semantic_instance_labels):
+        is_assigned = assignments == channel_idx
+        if is_assigned.sum() == 0:
+            expected = [0, 0, 0]
+        else:
+            expected = [float(softmaxed_scores[channel_idx][is_assigned].mean()),
+                        float((softmaxed_scores[channel_idx][is_assigned] /
+                               softmax_per_sem_cls[sem_cls][is_assigned]).mean()),
+                        float(scores[channel_idx][is_assigned].mean())]
+        streamed = [float(instance_metrics.mean_softmax_for_assigned_pixels[channel_idx]),
+                    float(instance_metrics.mean_fraction_of_sem_cls_for_assigned_pixels[channel_idx]),
+                    float(instance_metrics.mean_score_for_assigned_pixels[channel_idx])]
+        assert np.allclose(streamed, expected, rtol=1e-4, atol=1e-6)
+
+
+def get_majority_assignment_stats_with_mode(problem_config, assignments, sem_lbls, inst_lbls, majority_fraction=0.5):
+    """
+    The per-instance torch.mode loop _compute_majority_assignment_stats replaced
+    """
+    n_images, n_channels = assignments.size(0), len(problem_config.semantic_instance_class_list)
+    n_found_per_sem_cls = torch.IntTensor(n_images, problem_config.n_semantic_classes).zero_()
+    n_missed_per_sem_cls = torch.IntTensor(n_images, problem_config.n_semantic_classes).zero_()
+    channels_of_majority_assignments = torch.IntTensor(n_images, n_channels).zero_()
+    for data_idx in range(n_images):
+        already_matched_pred_channels = torch.zeros(n_channels).byte()
+        for gt_channel_idx, (sem_cls, inst_id) in enumerate(zip(problem_config.semantic_instance_class_list,
+                                                                problem_config.instance_count_id_list)):
+            instance_mask = (sem_lbls[data_idx] == sem_cls) * (inst_lbls[data_idx] == inst_id)
+            if instance_mask.sum() == 0:
+                continue
+            instance_assignments = assignments[data_idx][instance_mask]
+            pred_channel_idx = int(torch.mode(instance_assignments)[0])
+            if already_matched_pred_channels[pred_channel_idx]:
+                n_missed_per_sem_cls[data_idx, sem_cls] += 1
+            else:
+                n_pixels_assigned = (instance_assignments == pred_channel_idx).float().sum()
+                if n_pixels_assigned >= instance_mask.float().sum() * majority_fraction:
+                    n_found_per_sem_cls[data_idx, sem_cls] += 1
+                    channels_of_majority_assignments[data_idx, pred_channel_idx] += 1
+                    already_matched_pred_channels[pred_channel_idx] = 1
+                else:
+                    n_missed_per_sem_cls[data_idx, sem_cls] += 1
+                    n_found_per_sem_cls[data_idx, sem_cls] += 1
+    return n_found_per_sem_cls, n_missed_per_sem_cls, channels_of_majority_assignments
+
+
+def test_majority_assignment_stats_match_mode():
+    problem_config = instance_utils.InstanceProblemConfig(n_instances_by_semantic_id=[1, 3, 2])
+    n_channels = len(problem_config.semantic_instance_class_list)
+    samples = []
+    for height, width in [(6, 7), (5, 9), (7, 4), (6, 6)]:
+        sem_lbl = torch.from_numpy(np.random.randint(-1, 3, size=(height, width))).long()
+        inst_lbl = torch.from_numpy(np.random.randint(1, 3, size=(height, width))).long()
+        inst_lbl[sem_lbl == 0] = 0
+        inst_lbl[sem_lbl == -1] = -1
+        samples.append((torch.zeros(1, height, width), [sem_lbl, inst_lbl]))
+    # A tied majority: half of instance (1, 1) in channel 3, half in channel 2 (the lower one wins)
+    tie_sem_lbl, tie_inst_lbl = torch.zeros(2, 4).long(), torch.zeros(2, 4).long()
+    tie_sem_lbl[0, :], tie_inst_lbl[0, :] = 1, 1
+    samples.append((torch.zeros(1, 2, 4), [tie_sem_lbl, tie_inst_lbl]))
+    _, (sem_lbl, inst_lbl) = collate.pad_collate(samples)
+    assignments = torch.from_numpy(np.random.randint(0, n_channels, size=sem_lbl.size())).long()
+    assignments[-1, 0, :4] = torch.LongTensor([3, 2, 2, 3])
+    assignments[-1, 1, :4] = 0  # the background instance
+    assert (sem_lbl == collate.LBL_PAD_VALUE).sum() > 0
+
+    instance_metrics = metrics.InstanceMetrics(DataLoader(samples), problem_config,
+                                               component_loss_function=lambda *a: None)
+    instance_metrics.reset_stream()
+    stats = instance_metrics._compute_majority_assignment_stats(assignments, sem_lbl, inst_lbl)
+    expected_stats = get_majority_assignment_stats_with_mode(problem_config, assignments, sem_lbl, inst_lbl)
+    for stat, expected_stat in zip(stats, expected_stats):
+        assert torch.equal(stat, expected_stat)
+    assert int(stats[2][-1, 2]) == 1 and int(stats[2][-1, 3]) == 0
+
+
+def permute_labels_with_loop(label_preds, permutations):
+    """
+    Reference for instance_utils.permute_labels: pixels predicted as channel permutations[n, c] get label c.
+    """
+    label_preds_permuted = [lp.copy() for lp in label_preds]
+    for lp, lp_permuted, permutation in zip(label_preds, label_preds_permuted, permutations):
+        for channel, predicted_channel in enumerate(permutation):
+            lp_permuted[lp == predicted_channel] = channel
+    return label_preds_permuted
+
+
+def test_confusion_accumulator_matches_label_accuracy_score():
+    rng = np.random.RandomState(0)
+    n_class, n_images, batch_size = 6, 5, 2
+    label_trues = [rng.randint(-1, n_class, size=(7, 9)) for _ in range(n_images)]
+    label_trues[0][0, :] = collate.LBL_PAD_VALUE  # padded pixels count as much as void: not at all
+    label_preds = [rng.randint(0, n_class, size=(7, 9)) for _ in range(n_images)]
+    label_preds[1][label_trues[1] >= 0] = label_trues[1][label_trues[1] >= 0]  # one perfect image
+    permutations = np.stack([rng.permutation(n_class) for _ in range(n_images)])
+    expected_unpermuted = misc.label_accuracy_score(label_trues, label_preds, n_class)
+    expected_permuted = misc.label_accuracy_score(label_trues, permute_labels_with_loop(label_preds, permutations),
+                                                  n_class)
+
+    for batch_permutations, expected_scores in [(None, expected_unpermuted), (permutations, expected_permuted)]:
+        list_accumulator, tensor_accumulator = metrics.ConfusionAccumulator(n_class), \
+            metrics.ConfusionAccumulator(n_class)
+        for start in range(0, n_images, batch_size):
+            batch = slice(start, start + batch_size)
+            batch_permutation = batch_permutations[batch] if batch_permutations is not None else None
+            list_accumulator.update(label_trues[batch], label_preds[batch], batch_permutation)
+            tensor_accumulator.update(torch.from_numpy(np.stack(label_trues[batch])).long(),
+                                      torch.from_numpy(np.stack(label_preds[batch])).long(), batch_permutation)
+        for accumulator in (list_accumulator, tensor_accumulator):
+            assert np.allclose(accumulator.get_scores(), expected_scores)
+        assert np.array_equal(list_accumulator.hist, tensor_accumulator.hist)
+        assert tensor_accumulator.n_bytes_to_host == n_class ** 2 * 8  # the histogram, copied once
+    assert not np.allclose(expected_unpermuted, expected_permuted)
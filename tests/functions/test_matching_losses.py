@@ -0,0 +1,121 @@
+"""
+Unit tests of the matching losses (they don't need a dataset or a trainer).
+"""
+import numpy as np
+import pytest
+import torch
+
+from instanceseg.datasets import collate
+from instanceseg.losses import cost_blocks, linear_assignment, loss, match
+
+
+def test_cost_blocks_match_pairwise_costs():
+    semantic_instance_labels, instance_id_labels = [0, 1, 1, 1, 2, 2], [0, 1, 2, 3, 1, 2]
+    sem_lbl = torch.from_numpy(np.random.randint(-1, 3, size=(10, 12))).long()
+    inst_lbl = torch.from_numpy(np.random.randint(0, 4, size=(10, 12))).long()
+    inst_lbl[sem_lbl == -1] = -1
+    inst_lbl[sem_lbl == 0] = 0
+    for loss_type, size_average in [('cross_entropy', True), ('soft_iou', False)]:
+        loss_object = loss.loss_object_factory(loss_type, semantic_instance_labels, instance_id_labels,
+                                               matching=True, size_average=size_average)
+        predictions = loss_object.transform_scores_to_predictions(
+            torch.autograd.Variable(torch.randn(1, len(semantic_instance_labels), 10, 12)))[0, ...]
+        cost_blocks = loss_object.build_cost_blocks(predictions, torch.autograd.Variable(sem_lbl),
+                                                    torch.autograd.Variable(inst_lbl))
+        for sem_val in range(max(semantic_instance_labels) + 1):
+            cost_list_2d = match.create_pytorch_cost_matrix(loss_object.component_loss, predictions,
+                                                            torch.autograd.Variable(sem_lbl),
+                                                            torch.autograd.Variable(inst_lbl),
+                                                            semantic_instance_labels, instance_id_labels, sem_val,
+                                                            size_average=size_average)
+            n_channels_for_this_class = len(cost_list_2d)
+            for r_pred in range(n_channels_for_this_class):
+                for c_gt in range(n_channels_for_this_class):
+                    assert np.isclose(float(cost_blocks[sem_val, r_pred, c_gt]), float(cost_list_2d[r_pred][c_gt]),
+                                      rtol=1e-4, atol=1e-6)
+
+
+def test_channel_labels_copy_the_lookup_table_once():
+    semantic_instance_labels, instance_id_labels = [0, 1, 1, 1, 2, 2], [0, 1, 2, 3, 1, 2]
+    loss_object = loss.loss_object_factory('cross_entropy', semantic_instance_labels, instance_id_labels,
+                                           matching=True, size_average=True)
+    scores = torch.autograd.Variable(torch.randn(2, len(semantic_instance_labels), 10, 12))
+    sem_lbl = torch.from_numpy(np.random.randint(-1, 3, size=(2, 10, 12))).long()
+    inst_lbl = torch.from_numpy(np.random.randint(0, 4, size=(2, 10, 12))).long()
+    for _ in range(2):
+        loss_object.loss_fcn(scores, torch.autograd.Variable(sem_lbl), torch.autograd.Variable(inst_lbl))
+    assert list(loss_object.semantic_instance_lookup_table_tensors.keys()) == [-1]
+    channel_lbl = cost_blocks.get_channel_labels(
+        sem_lbl, inst_lbl, semantic_instance_labels, instance_id_labels,
+        lookup_table=loss_object.semantic_instance_lookup_table,
+        lookup_table_tensors=loss_object.semantic_instance_lookup_table_tensors)
+    assert np.array_equal(channel_lbl.numpy(), cost_blocks.get_channel_labels(
+        sem_lbl.numpy(), inst_lbl.numpy(), semantic_instance_labels, instance_id_labels))
+
+
+def check_matching_solver_agrees(solver_name):
+    for n_instances in [1, 2, 5, 20]:
+        cost_matrix = np.random.rand(n_instances, n_instances)
+        pred_for_gt = linear_assignment.solve_with_numpy(cost_matrix)
+        assert np.all(pred_for_gt == linear_assignment.get_matching_solver(solver_name)(cost_matrix))
+
+
+def test_scipy_matching_solver_agrees():
+    pytest.importorskip('scipy.optimize')
+    check_matching_solver_agrees('scipy')
+
+
+def test_ortools_matching_solver_agrees():
+    pytest.importorskip('ortools.graph.pywrapgraph')  # optional (see match.py)
+    check_matching_solver_agrees('ortools')
+
+
+def test_pooled_cost_block_solver_agrees():
+    block_sizes = [1, 3, 2, 4]
+    cost_blocks = np.random.rand(5, len(block_sizes), max(block_sizes), max(block_sizes))
+    present_blocks = np.random.rand(5, len(block_sizes)) > 0.3
+    solver = linear_assignment.get_matching_solver('numpy')
+    pred_for_gt = linear_assignment.solve_cost_blocks(solver, cost_blocks, block_sizes, present_blocks=present_blocks)
+    pooled_pred_for_gt = linear_assignment.solve_cost_blocks(solver, cost_blocks, block_sizes,
+                                                             present_blocks=present_blocks,
+                                                             pool=linear_assignment.get_solver_pool(3))
+    assert np.all(pred_for_gt == pooled_pred_for_gt)
+    for i in range(cost_blocks.shape[0]):
+        for sem_val, n_channels in enumerate(block_sizes):
+            expected = solver(cost_blocks[i, sem_val, :n_channels, :n_channels]) \
+                if n_channels > 1 and present_blocks[i, sem_val] else np.arange(n_channels)
+            assert np.all(pred_for_gt[i, sem_val, :n_channels] == expected)
+            assert np.all(pred_for_gt[i, sem_val, n_channels:] == -1)
+
+
+def test_padded_batch_matches_per_image_losses():
+    semantic_instance_labels, instance_id_labels = [0, 1, 1, 1, 2, 2], [0, 1, 2, 3, 1, 2]
+    samples = []
+    for height, width in [(10, 12), (8, 15), (11, 9)]:
+        sem_lbl = torch.from_numpy(np.random.randint(-1, 3, size=(height, width))).long()
+        inst_lbl = torch.from_numpy(np.random.randint(1, 4, size=(height, width))).long()
+        inst_lbl[sem_lbl == 0] = 0
+        inst_lbl[sem_lbl == -1] = -1
+        samples.append((torch.randn(len(semantic_instance_labels), height, width), [sem_lbl, inst_lbl]))
+    scores, (sem_lbl, inst_lbl) = collate.pad_collate(samples)  # pixelwise 'model': the scores themselves
+    for loss_type, size_average in [('cross_entropy', True), ('soft_iou', False)]:
+        for matching in [True, False]:
+            loss_object = loss.loss_object_factory(loss_type, semantic_instance_labels, instance_id_labels,
+                                                   matching=matching, size_average=size_average)
+            pred_permutations, total_loss, loss_components = loss_object.loss_fcn(scores, sem_lbl, inst_lbl)
+            for idx, (img_scores, (img_sem_lbl, img_inst_lbl)) in enumerate(samples):
+                img_pred_permutations, img_loss, img_loss_components = loss_object.loss_fcn(
+                    img_scores[None, ...], img_sem_lbl[None, ...], img_inst_lbl[None, ...])
+                assert np.all(pred_permutations[idx] == img_pred_permutations[0])
+                assert np.allclose(loss_components[idx].data.numpy(), img_loss_components[0].data.numpy(),
+                                   rtol=1e-4, atol=1e-5)
+                total_loss = total_loss - img_loss
+            if matching:  # (without matching, the total is over the whole batch rather than a sum over images)
+                assert abs(float(total_loss)) < 1e-4
+
+
+if __name__ == '__main__':
+    test_cost_blocks_match_pairwise_costs()
+    test_scipy_matching_solver_agrees()
+    test_ortools_matching_solver_agrees()
+    test_padded_batch_matches_per_image_losses()
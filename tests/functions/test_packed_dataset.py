@@ -0,0 +1,107 @@
+"""
+Unit tests of the packed dataset cache, on a few synthetic items held in memory.
+"""
+import numpy as np
+import torch
+
+from instanceseg.datasets import packed_dataset, runtime_transformations
+from instanceseg.datasets.instance_dataset import TransformedInstanceDataset
+
+
+class InMemoryRawDataset(object):
+    semantic_class_names = ['background', 'a', 'b', 'c']
+
+    def __init__(self, items):
+        self.items = items
+        self.files = [{'img': idx, 'sem_lbl': idx, 'inst_lbl': idx} for idx in range(len(items))]
+
+    def __len__(self):
+        return len(self.items)
+
+
+class InMemoryDataset(TransformedInstanceDataset):
+    def load_files(self, img_file, sem_lbl_file, inst_lbl_file):
+        img, (sem_lbl, inst_lbl) = self.raw_dataset.items[img_file]
+        return img.copy(), (sem_lbl.copy(), inst_lbl.copy())
+
+
+def make_items(n_items=5, max_inst_val=3, seed=0):
+    rng = np.random.RandomState(seed)
+    items = []
+    for idx in range(n_items):
+        height, width = 6 + idx, 8 + 2 * idx  # different sizes, so offsets into the shards differ
+        img = rng.randint(0, 255, size=(height, width, 3)).astype(np.uint8)
+        sem_lbl = rng.randint(-1, 4, size=(height, width)).astype(np.int32)
+        inst_lbl = rng.randint(1, max_inst_val + 1, size=(height, width)).astype(np.int32)
+        inst_lbl[sem_lbl == 0] = 0
+        inst_lbl[sem_lbl == -1] = -1
+        items.append((img, (sem_lbl, inst_lbl)))
+    return items
+
+
+def make_dataset(items, **factory_kwargs):
+    """
+    The (no-op) resize is packed; the rest of the runtime transformation runs on every item
+    """
+    runtime_transformation = runtime_transformations.runtime_transformer_factory(
+        resize=True, resize_size=None, mean_bgr=np.array([104.0, 117.0, 123.0]), **factory_kwargs)
+    return InMemoryDataset(InMemoryRawDataset(items), runtime_transformation=runtime_transformation)
+
+
+def assert_same_items(packed, dataset):
+    assert len(packed) == len(dataset)
+    for idx in range(len(dataset)):
+        (img, (sem_lbl, inst_lbl)), (packed_img, (packed_sem_lbl, packed_inst_lbl)) = dataset[idx], packed[idx]
+        assert torch.equal(img, packed_img)
+        assert torch.equal(sem_lbl, packed_sem_lbl) and torch.equal(inst_lbl, packed_inst_lbl)
+
+
+def test_packed_items_match_dataset(tmpdir):
+    dataset = make_dataset(make_items(), reduced_class_idxs=[0, 1, 3], n_inst_cap_per_class=2)
+    pack_dir = str(tmpdir.join('pack'))
+    packed = packed_dataset.PackedInstanceDataset(dataset, pack_dir)
+    assert packed_dataset.is_packed(pack_dir)
+    assert packed.lbl_dtype == np.int16
+    assert_same_items(packed, dataset)
+    # Twice: the runtime transformations work in place, and mustn't change the (copy-on-write) pack
+    assert_same_items(packed, dataset)
+    # Small shards: one item per shard
+    small_shard_dir = str(tmpdir.join('small_shards'))
+    packed_dataset.pack_dataset(dataset, small_shard_dir, shard_size_bytes=1)
+    packed = packed_dataset.PackedInstanceDataset(dataset, small_shard_dir)
+    assert list(packed.index[:, 0]) == list(range(len(dataset)))
+    assert_same_items(packed, dataset)
+
+
+def test_labels_that_dont_fit_are_packed_as_int32(tmpdir):
+    dataset = make_dataset(make_items(max_inst_val=2 ** 16))
+    pack_dir = str(tmpdir.join('pack'))
+    packed = packed_dataset.PackedInstanceDataset(dataset, pack_dir)
+    assert packed.lbl_dtype == np.int32
+    assert packed[0][1][1].max() > np.iinfo(np.int16).max
+    assert_same_items(packed, dataset)
+
+
+def test_split_packs_only_leading_resizes():
+    resize, resize_2 = runtime_transformations.ResizeRuntimeDatasetTransformer(resize_size=(8, 8)), \
+        runtime_transformations.ResizeRuntimeDatasetTransformer(resize_size=(4, 4))
+    basic = runtime_transformations.BasicRuntimeDatasetTransformer()
+    cap = runtime_transformations.InstanceNumberCapRuntimeDatasetTransformer(n_inst_cap_per_class=2)
+    sequence = runtime_transformations.GenericSequenceRuntimeDatasetTransformer
+
+    packed, unpacked = packed_dataset.split_runtime_transformation(sequence([resize, basic, cap]))
+    assert packed is resize
+    assert unpacked.transformer_sequence == [basic, cap]
+
+    packed, unpacked = packed_dataset.split_runtime_transformation(sequence([resize, resize_2, basic, cap]))
+    assert packed.transformer_sequence == [resize, resize_2]
+    assert unpacked.transformer_sequence == [basic, cap]
+
+    # A resize after a non-resize transformer runs on every item
+    packed, unpacked = packed_dataset.split_runtime_transformation(sequence([basic, resize, cap]))
+    assert packed is None
+    assert unpacked.transformer_sequence == [basic, resize, cap]
+
+    assert packed_dataset.split_runtime_transformation(resize) == (resize, None)
+    assert packed_dataset.split_runtime_transformation(basic) == (None, basic)
+    assert packed_dataset.split_runtime_transformation(None) == (None, None)
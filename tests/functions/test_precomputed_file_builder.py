@@ -0,0 +1,117 @@
+"""
+Unit tests of the incremental precomputed file builder, on small text files standing in for the labels.
+"""
+import os
+
+from instanceseg.datasets import precomputed_file_builder
+from instanceseg.datasets.instance_dataset import TransformedInstanceDataset
+from instanceseg.datasets.precomputed_file_transformations import GenericSequencePrecomputedDatasetFileTransformer, \
+    PrecomputedDatasetFileTransformerBase, write_atomically
+
+
+class SuffixStep(PrecomputedDatasetFileTransformerBase):
+    """
+    Writes inst_lbl_file + suffix from the semantic and instance files; counts the files it generates.
+    """
+    def __init__(self, suffix):
+        self.suffix = suffix
+        self.generated = []
+
+    def get_transformed_files(self, img_file, sem_lbl_file, inst_lbl_file):
+        return img_file, sem_lbl_file, inst_lbl_file.replace('.txt', self.suffix + '.txt')
+
+    def generate_transformed_files(self, img_file, sem_lbl_file, inst_lbl_file):
+        out_file = self.get_transformed_files(img_file, sem_lbl_file, inst_lbl_file)[2]
+        contents = read(sem_lbl_file) + read(inst_lbl_file) + self.suffix
+
+        def write_fcn(filename):
+            with open(filename, 'w') as f:
+                f.write(contents)
+        write_atomically(write_fcn, out_file)
+        self.generated.append(out_file)
+
+
+def read(filename):
+    with open(filename, 'r') as f:
+        return f.read()
+
+
+def write(filename, contents, mtime_offset=0):
+    with open(filename, 'w') as f:
+        f.write(contents)
+    mtime = os.path.getmtime(filename) + mtime_offset
+    os.utime(filename, (mtime, mtime))
+
+
+def make_data_files(directory, n_items=3):
+    data_files = []
+    for idx in range(n_items):
+        files = {name: os.path.join(str(directory), '{}_{}.txt'.format(name, idx))
+                 for name in ('img', 'sem_lbl', 'inst_lbl')}
+        for name, filename in files.items():
+            write(filename, '{}{}'.format(name, idx))
+        data_files.append(files)
+    return data_files
+
+
+def test_incremental_build(tmpdir):
+    data_files = make_data_files(tmpdir)
+    steps = [SuffixStep('_a'), SuffixStep('_b')]
+    transformation = GenericSequencePrecomputedDatasetFileTransformer(transformer_sequence=steps)
+    manifest_file = os.path.join(str(tmpdir), 'manifest.json')
+
+    def build():
+        for step in steps:
+            step.generated = []
+        return precomputed_file_builder.build_precomputed_files(transformation, data_files, manifest_file,
+                                                                n_processes=0)
+
+    # First build: every file of every step
+    transformed_files = build()
+    assert [len(step.generated) for step in steps] == [3, 3]
+    for files, data_file in zip(transformed_files, data_files):
+        assert files[2] == data_file['inst_lbl'].replace('.txt', '_a_b.txt')
+        sem_contents, inst_contents = read(data_file['sem_lbl']), read(data_file['inst_lbl'])
+        assert read(files[2]) == sem_contents + sem_contents + inst_contents + '_a_b'
+
+    # Nothing changed: nothing is regenerated
+    assert build() == transformed_files
+    assert [len(step.generated) for step in steps] == [0, 0]
+
+    # A newer mtime with the same contents: the md5 still matches
+    write(data_files[0]['inst_lbl'], read(data_files[0]['inst_lbl']), mtime_offset=10)
+    build()
+    assert [len(step.generated) for step in steps] == [0, 0]
+
+    # New contents: only that item's files, and the later step that depends on them, are rebuilt
+    write(data_files[1]['inst_lbl'], 'changed', mtime_offset=10)
+    build()
+    assert steps[0].generated == [transformed_files[1][2].replace('_a_b.txt', '_a.txt')]
+    assert steps[1].generated == [transformed_files[1][2]]
+    assert read(transformed_files[1][2]) == read(data_files[1]['sem_lbl']) + read(data_files[1]['sem_lbl']) + \
+        'changed_a_b'
+
+    # A deleted output is rebuilt
+    os.remove(transformed_files[2][2])
+    build()
+    assert [len(step.generated) for step in steps] == [0, 1]
+
+
+class FileListDataset(object):
+    def __init__(self, files):
+        self.files = files
+
+    def __len__(self):
+        return len(self.files)
+
+
+def test_dataset_only_builds_missing_files(tmpdir):
+    data_files = make_data_files(tmpdir)
+    step = SuffixStep('_a')
+    dataset = TransformedInstanceDataset(FileListDataset(data_files), precomputed_file_transformation=step)
+    assert all([os.path.isfile(files[2]) for files in dataset.precomputed_files])
+
+    os.remove(dataset.precomputed_files[1][2])
+    TransformedInstanceDataset(FileListDataset(data_files), precomputed_file_transformation=step)
+    assert os.path.isfile(dataset.precomputed_files[1][2])
+    assert read(dataset.precomputed_files[0][2]) == 'sem_lbl0inst_lbl0_a'
@@ -0,0 +1,67 @@
+"""
+Unit tests of the runtime transformations: the fused label transformers give the same output as running them one by one.
+"""
+import numpy as np
+import torch
+
+from instanceseg.datasets import runtime_transformations
+
+
+def make_sample(image_size=(40, 60), n_semantic_classes=9, n_instances=20, seed=0):
+    """
+    img: random HxWx3 uint8; lbl: n_instances rectangles of random semantic classes on background, with void pixels
+    """
+    rng = np.random.RandomState(seed)
+    height, width = image_size
+    img = rng.randint(0, 255, size=(height, width, 3)).astype(np.uint8)
+    sem_lbl = np.zeros((height, width), dtype=np.int32)
+    inst_lbl = np.zeros((height, width), dtype=np.int32)
+    n_instances_by_class = [0 for _ in range(n_semantic_classes)]
+    for _ in range(n_instances):
+        sem_val = rng.randint(1, n_semantic_classes)
+        n_instances_by_class[sem_val] += 1
+        y, x = rng.randint(0, height - 4), rng.randint(0, width - 4)
+        h, w = rng.randint(2, height // 2), rng.randint(2, width // 2)
+        sem_lbl[y:(y + h), x:(x + w)] = sem_val
+        inst_lbl[y:(y + h), x:(x + w)] = n_instances_by_class[sem_val]
+    sem_lbl[:2, :], inst_lbl[:2, :] = -1, -1  # void border
+    inst_lbl[rng.rand(height, width) < 0.05] = -1  # void instance pixels inside objects
+    return img, (sem_lbl, inst_lbl)
+
+
+def transform(fuse_label_transformers, sample, **factory_kwargs):
+    runtime_transformation = runtime_transformations.runtime_transformer_factory(resize=False, **factory_kwargs)
+    runtime_transformation.fuse_label_transformers = fuse_label_transformers
+    img, (sem_lbl, inst_lbl) = sample
+    return runtime_transformation.transform(img.copy(), (sem_lbl.copy(), inst_lbl.copy()))
+
+
+def test_fused_label_transformers_match_sequential():
+    sample = make_sample()
+    for factory_kwargs in [dict(reduced_class_idxs=[0, 1, 2, 3, 5, 8], n_inst_cap_per_class=2),
+                           dict(reduced_class_idxs=list(range(9)), map_other_classes_to_bground=False,
+                                n_inst_cap_per_class=1),
+                           dict(n_inst_cap_per_class=2, map_to_single_instance_problem=True)]:
+        sequential_img, sequential_lbl = transform(False, sample, **factory_kwargs)
+        fused_img, fused_lbl = transform(True, sample, **factory_kwargs)
+        assert torch.equal(sequential_img, fused_img)
+        for sequential, fused in zip(sequential_lbl, fused_lbl):
+            assert torch.equal(sequential, fused), factory_kwargs
+        sem_lbl, inst_lbl = sequential_lbl
+        assert (sem_lbl == -1).any() and (inst_lbl == -1).any()  # the void values made it through
+        if 'reduced_class_idxs' in factory_kwargs:
+            assert sem_lbl.max() < len(factory_kwargs['reduced_class_idxs'])
+        assert inst_lbl.max() <= factory_kwargs['n_inst_cap_per_class']
+
+
+def test_fused_lookup_is_built_once():
+    sample = make_sample()
+    runtime_transformation = runtime_transformations.runtime_transformer_factory(
+        resize=False, reduced_class_idxs=[0, 1, 2, 3, 5, 8], n_inst_cap_per_class=2)
+    img, lbl = sample
+    runtime_transformation.transform(img.copy(), (lbl[0].copy(), lbl[1].copy()))
+    compiled_sequence = runtime_transformation.compiled_transformer_sequence
+    assert any([isinstance(t, runtime_transformations.FusedLabelRuntimeDatasetTransformer)
+                for t in compiled_sequence])
+    runtime_transformation.transform(img.copy(), (lbl[0].copy(), lbl[1].copy()))
+    assert runtime_transformation.compiled_transformer_sequence is compiled_sequence